@@ -1,7 +1,7 @@
 import pandas as pd
 import numpy as np
 from matplotlib import pyplot as plt
-from scipy import linalg
+import TerracePlotter
 
 """
 lp = pd.read_csv('Rio_Toro_baseline_channel_info.csv')
@@ -19,6 +19,13 @@ plt.plot(x_lp, z_lp, 'k-', linewidth=2)
 terraces = pd.read_csv('Eel_DEM_clip_terrace_info.csv')
 #channel = pd.read_csv('Eel_DEM_clip_baseline_channel_info.csv')
 terraceIDs = sorted(list(set(list(terraces.TerraceID))))
+# fit a plane to every terrace at once with least squares. Change this to 'huber'
+# or 'ransac' to ignore the riser and hillslope pixels that have been picked up
+# with the terraces
+# form: Z = C[0]*X + C[1]*Y + C[2]
+fit_method = 'lstsq'
+planes = TerracePlotter.fit_terrace_planes(terraces, by='TerraceID', method=fit_method)
+plane_index = dict(zip(planes['keys']['TerraceID'].values, range(len(planes['C']))))
 xTerraces = [] # along-channel x
 zTerraces = []
 yTerraces = [] # cross-channel y
@@ -38,19 +45,19 @@ for terraceID in terraceIDs:
     _X = terraces['X'].values[_terrace_subset]
     _Y = terraces['Y'].values[_terrace_subset]
     if len(_z) > 40000:
-        # fit a plane to these points
-        # form: Z = C[0]*X + C[1]*Y + C[2]
-        _XY = np.vstack((_X, _Y, np.ones(len(_Y)))).transpose()
-        C,_,_,_ = linalg.lstsq(_XY, _z)
+        # the plane for these points
+        C = planes['C'][plane_index[terraceID]]
+        if fit_method != 'lstsq':
+            print(terraceID, 'inlier fraction', planes['inlier_fraction'][plane_index[terraceID]])
         # Get dip and dip direction
         _dip_slope = (C[0]**2 + C[1]**2)**.5
         _dip = np.arctan(_dip_slope)
         # Dip orientation is +/- this (pos/neg, not approx.)
-        print C[0], _dip
+        print(C[0], _dip)
         _dip_orientation_pm = np.arccos(C[0] / _dip_slope)
         # Test which solution (+/-) is required
         _isplus = (np.round(_dip * np.cos(_dip_orientation_pm),6) == np.round(C[0],6))
-        #print _dip * np.cos(_dip_orientation_pm), C[0]
+        #print(_dip * np.cos(_dip_orientation_pm), C[0])
         # + C[1] * np.sin(_dip_orientation_pm)
         _sign = 2 * _isplus - 1
         _dip_orientation = _sign * _dip_orientation_pm
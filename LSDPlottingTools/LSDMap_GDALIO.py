@@ -13,6 +13,7 @@ import numpy as np
 from osgeo import osr
 from os.path import exists
 from osgeo.gdalconst import GA_ReadOnly
+from . import instrumentation
 
 #==============================================================================
 def getNoDataValue(rasterfn):
@@ -420,6 +421,7 @@ def CheckNoData(FileName):
 
 
 #==============================================================================
+@instrumentation.timed('read_raster')
 def ReadRasterArrayBlocks(raster_file,raster_band=1):
     """This reads a raster file (from GDAL) into an array. The "blocks" bit makes it efficient.
     Args:
@@ -499,6 +501,7 @@ def ReadRasterArrayBlocks(raster_file,raster_band=1):
 #==============================================================================
 
 #==============================================================================
+@instrumentation.timed('read_raster_numpy')
 def ReadRasterArrayBlocks_numpy(raster_file,raster_band=1):
     """
     This reads a raster file into an array using numpy. The "blocks" bit makes it efficient.
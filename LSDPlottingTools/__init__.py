@@ -3,19 +3,82 @@
 Created on Fri Oct 30 10:37:16 2015
 
 @author: smudd
+
+The submodules are loaded when they are first used rather than when the package
+is imported, as they pull in GDAL, pyproj, shapely and matplotlib. The names that
+used to be star-imported from the submodules (e.g. LSDPlottingTools.ReadRasterArrayBlocks)
+still work: the first time one is used, the submodules are imported and the name
+is looked up in them in the same order as the star imports.
 """
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-from .LSDMap_BasicPlotting import *
-from .LSDMap_GDALIO import *
-from .LSDMap_BasicManipulation import *
-from .LSDMap_PointTools import *
-from .LSDMap_OSystemTools import *
-from .LSDMap_VectorTools import *
-from .adjust_text import *
-
-from . import colours as lsdcolours
-from . import labels as lsdlabels
-#from . import scalebar as lsdscalebar
-from . import statsutilities as lsdstatsutilities
+import importlib as _importlib
+import importlib.util as _importlib_util
+import pkgutil as _pkgutil
+
+# the submodules whose public names are part of the package, in the order that they
+# used to be star-imported: if a name is in more than one, the last one wins
+_star_modules = ['LSDMap_BasicPlotting', 'LSDMap_GDALIO', 'LSDMap_BasicManipulation', 'LSDMap_PointTools',
+                 'LSDMap_OSystemTools', 'LSDMap_VectorTools', 'adjust_text']
+
+# the submodules that are available under another name
+_module_aliases = {'lsdcolours': 'colours', 'lsdlabels': 'labels', 'lsdstatsutilities': 'statsutilities'}
+
+_not_found = object()
+
+def _is_submodule(name):
+    """
+    Check if there is a submodule with this name
+    """
+    return _importlib_util.find_spec(__name__+'.'+name) is not None
+
+def _get_public_names(module):
+    """
+    Get the names that a star import of a submodule gives
+    """
+    public_names = getattr(module, '__all__', None)
+    if public_names is None:
+        public_names = [key for key in vars(module) if not key.startswith('_')]
+    return public_names
+
+def _find_star_name(name):
+    """
+    Find a name that a star import of the submodules would give. The submodules
+    are searched from the last to the first, as the last star import wins.
+    """
+    for module_name in reversed(_star_modules):
+        module = _importlib.import_module('.'+module_name, __name__)
+        public_names = _get_public_names(module)
+        # importing the submodule sets it as an attribute of the package, which hides
+        # a name that it defines with the same name as itself (e.g. the adjust_text
+        # function). Put the name back, as the star import did.
+        if module_name in public_names:
+            globals()[module_name] = getattr(module, module_name)
+        if name in public_names:
+            return getattr(module, name)
+    return _not_found
+
+def __getattr__(name):
+    # a star import never gives private names, so don't import anything for them
+    if name.startswith('_'):
+        raise AttributeError("module %r has no attribute %r" %(__name__, name))
+
+    if name in _module_aliases:
+        value = _importlib.import_module('.'+_module_aliases[name], __name__)
+    elif _is_submodule(name):
+        value = _importlib.import_module('.'+name, __name__)
+        # a star-imported submodule can define a name that is the same as itself
+        # (e.g. the adjust_text function), which the star import gave instead
+        if name in _star_modules and name in _get_public_names(value):
+            value = getattr(value, name)
+    else:
+        value = _find_star_name(name)
+        if value is _not_found:
+            raise AttributeError("module %r has no attribute %r" %(__name__, name))
+    # keep it so that the next lookup doesn't come here
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_module_aliases) | set(module.name for module in _pkgutil.iter_modules(__path__)))
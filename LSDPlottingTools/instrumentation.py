@@ -0,0 +1,265 @@
+"""
+A lightweight way to find out where the time and memory go in a run. Stages are
+marked with the stage context manager or the timed decorator, which record the
+wall time, CPU time, number of rows and memory of each stage. The records
+can be written to a json and csv profile, and one stage can be run under
+cProfile to see which functions it spends its time in.
+
+Only uses the standard library, so it can be imported anywhere.
+
+    Author: FJC
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import contextlib
+import csv
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # resource isn't available on windows
+    resource = None
+
+# the records of all the stages, in the order they finished
+_records = []
+_lock = threading.Lock()
+# the stack of the stages that are running in each thread, for nesting
+_local = threading.local()
+# the stage to run under cProfile and where to put the output
+_cprofile_settings = {'stage': None, 'out_prefix': ''}
+
+enabled = True
+
+def get_rss():
+    """
+    Get the current resident memory of this process, in MB, from /proc/self/statm.
+    This is None if it can't be found on this system (it is only there on linux).
+
+    Author: FJC
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages*os.sysconf('SC_PAGE_SIZE')/(1024.*1024)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+def get_peak_rss():
+    """
+    Get the peak resident memory of this process and of its finished child
+    processes, in MB. These are None if it can't be found on this system.
+    This is the high-water mark since the process started, not of any one stage.
+
+    Author: FJC
+    """
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kB on linux and bytes on mac
+    scale = 1./(1024*1024) if sys.platform == 'darwin' else 1./1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss*scale)
+
+def enable_cprofile(stage_name, out_prefix=''):
+    """
+    Run the stage with this name under cProfile. The stats are written to
+    <out_prefix><stage_name>.prof, which can be read with pstats or snakeviz, and the
+    30 slowest functions to <out_prefix><stage_name>_cprofile.txt.
+
+    Args:
+        stage_name (str): the name of the stage, or None to turn it off
+        out_prefix (str): the start of the output file names, e.g. the directory and DEM prefix
+
+    Author: FJC
+    """
+    _cprofile_settings['stage'] = stage_name
+    _cprofile_settings['out_prefix'] = out_prefix
+
+@contextlib.contextmanager
+def stage(name, rows=None):
+    """
+    Record the time and memory of a stage:
+
+        with instrumentation.stage('project', rows=len(terraces)) as record:
+            ...
+            record['rows'] = n  # if the number of rows is only known at the end
+
+    Args:
+        name (str): the name of the stage
+        rows (int): the number of rows that the stage processes, if known
+
+    Author: FJC
+    """
+    if not enabled:
+        yield {}
+        return
+
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    record = {'stage': name, 'parent': stack[-1] if stack else '', 'rows': rows,
+              'thread': threading.current_thread().name, 'status': 'ok'}
+    stack.append(name)
+
+    profiler = None
+    if _cprofile_settings['stage'] == name:
+        import cProfile
+        profiler = cProfile.Profile()
+
+    record['rss_start_mb'] = get_rss()
+    start_peak_mb, _ = get_peak_rss()
+    record['start_time'] = time.time()
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield record
+    except BaseException:
+        record['status'] = 'failed'
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        record['wall_time'] = time.perf_counter() - start_wall
+        # this is the CPU time of the whole process, so includes other threads
+        record['cpu_time'] = time.process_time() - start_cpu
+        # the memory in use at the start and end of the stage, and how far the stage raised the
+        # high-water mark of the process (0 if it stayed below the peak of an earlier stage)
+        record['rss_end_mb'] = get_rss()
+        record['rss_change_mb'] = _difference(record['rss_end_mb'], record['rss_start_mb'])
+        record['process_peak_rss_mb'], record['children_peak_rss_mb'] = get_peak_rss()
+        record['peak_rss_increase_mb'] = _difference(record['process_peak_rss_mb'], start_peak_mb)
+        stack.pop()
+        with _lock:
+            _records.append(record)
+        if profiler is not None:
+            _write_cprofile(profiler, name)
+
+def _difference(end, start):
+    """
+    The difference between two memory readings, or None if either is missing
+    """
+    if end is None or start is None:
+        return None
+    return end - start
+
+def _write_cprofile(profiler, name):
+    """
+    Write the cProfile stats for a stage
+    """
+    import io
+    import pstats
+
+    out_stem = _cprofile_settings['out_prefix']+name
+    profiler.dump_stats(out_stem+'.prof')
+    text = io.StringIO()
+    pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(30)
+    with open(out_stem+'_cprofile.txt', 'w') as f:
+        f.write(text.getvalue())
+
+def timed(name=None, rows_from=None):
+    """
+    Decorator that records each call of a function as a stage:
+
+        @instrumentation.timed('summarize', rows_from='terrace_df')
+        def get_terrace_summary(terrace_df, ...):
+
+    Args:
+        name (str): the name of the stage. Default = the name of the function
+        rows_from (str): the name of an argument whose length is the number of rows
+
+    Author: FJC
+    """
+    def _decorator(function):
+        stage_name = name or function.__name__
+        signature = inspect.signature(function) if rows_from else None
+
+        @functools.wraps(function)
+        def _wrapper(*args, **kwargs):
+            rows = None
+            if rows_from:
+                try:
+                    rows = len(signature.bind_partial(*args, **kwargs).arguments[rows_from])
+                except (KeyError, TypeError):
+                    rows = None
+            with stage(stage_name, rows):
+                return function(*args, **kwargs)
+        return _wrapper
+    return _decorator
+
+def get_records():
+    """
+    Get a copy of the records of the stages so far
+
+    Author: FJC
+    """
+    with _lock:
+        return [dict(record) for record in _records]
+
+def reset():
+    """
+    Clear the records
+
+    Author: FJC
+    """
+    with _lock:
+        del _records[:]
+
+PROFILE_COLUMNS = ['stage', 'parent', 'rows', 'wall_time', 'cpu_time', 'rss_start_mb', 'rss_end_mb', 'rss_change_mb',
+                   'peak_rss_increase_mb', 'process_peak_rss_mb', 'children_peak_rss_mb', 'start_time', 'thread', 'status']
+
+def summarise_records(records):
+    """
+    Add up the records for each stage, e.g. for a stage that is run once for every figure
+
+    Returns:
+        list of dicts with the number of calls, rows, total times and total change in
+        memory of each stage, and the most memory in use at the end of a call
+
+    Author: FJC
+    """
+    summary = {}
+    for record in records:
+        this_stage = summary.setdefault(record['stage'], {'stage': record['stage'], 'calls': 0, 'rows': 0,
+                                                         'wall_time': 0., 'cpu_time': 0., 'rss_change_mb': None,
+                                                         'peak_rss_increase_mb': None, 'max_rss_end_mb': None})
+        this_stage['calls'] += 1
+        this_stage['rows'] += record['rows'] or 0
+        this_stage['wall_time'] += record['wall_time']
+        this_stage['cpu_time'] += record['cpu_time']
+        for col in ['rss_change_mb', 'peak_rss_increase_mb']:
+            if record.get(col) is not None:
+                this_stage[col] = (this_stage[col] or 0) + record[col]
+        if record.get('rss_end_mb') is not None:
+            this_stage['max_rss_end_mb'] = max(this_stage['max_rss_end_mb'] or 0, record['rss_end_mb'])
+    return sorted(summary.values(), key=lambda s: -s['wall_time'])
+
+def write_profile(fname_stem):
+    """
+    Write the records to <fname_stem>.json (with a summary of each stage) and
+    <fname_stem>.csv (one row for each time a stage was run).
+
+    Args:
+        fname_stem (str): the name of the profile without the extension
+
+    Returns:
+        the records
+
+    Author: FJC
+    """
+    records = get_records()
+    with open(fname_stem+'.json', 'w') as f:
+        json.dump({'stages': records, 'summary': summarise_records(records)}, f, indent=2)
+    with open(fname_stem+'.csv', 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=PROFILE_COLUMNS, extrasaction='ignore', lineterminator='\n')
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+    return records
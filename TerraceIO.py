@@ -0,0 +1,722 @@
+#------------------------------------------------------------------------------#
+# terrace-long-profiler
+# Functions for reading, writing and caching the intermediate terrace tables
+# Authors: F. Clubb
+#------------------------------------------------------------------------------#
+
+# import modules
+import pandas as pd
+import numpy as np
+import hashlib
+import json
+import os
+import time
+
+import TerracePlotter
+from LSDPlottingTools import instrumentation
+
+# the columns added by the baseline projection, and the parameters that the
+# projection depends on. Change the version if the projection code changes so
+# that old caches aren't used.
+PROJECTION_COLUMNS = ['DistAlongBaseline_new', 'DistToBaseline_new', 'BaselineSide']
+PROJECTION_PARAMS = {'function': 'project_points_to_baseline', 'version': 1}
+
+#---------------------------------------------------------------------------------------------#
+# HASHING
+#---------------------------------------------------------------------------------------------#
+
+def hash_arrays(*arrays):
+    """
+    Get a hash of the contents of some arrays. The arrays are converted to float64
+    first so that the hash doesn't depend on how the table was read in.
+
+    Args:
+        arrays: the arrays to hash
+
+    Returns:
+        the hex digest of the hash
+
+    Author: FJC
+    """
+    h = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array, dtype=np.float64)
+        h.update(str(array.shape).encode())
+        h.update(array.tobytes())
+    return h.hexdigest()
+
+def hash_files(fnames, block_size=1<<20):
+    """
+    Get a hash of the contents of some files
+
+    Args:
+        fnames: list of the file names
+        block_size (int): the number of bytes to read at once
+
+    Returns:
+        the hex digest of the hash
+
+    Author: FJC
+    """
+    h = hashlib.sha1()
+    for fname in fnames:
+        h.update(os.path.basename(fname).encode())
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                h.update(block)
+    return h.hexdigest()
+
+def write_json(data, fname):
+    """
+    Write a dict to a json file. The file is written to a temporary file first
+    and then moved into place, so a half-written file is never left behind.
+
+    Author: FJC
+    """
+    tmp_fname = fname+'.tmp'
+    with open(tmp_fname, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(tmp_fname, fname)
+
+def append_to_report(report_fname, key, value):
+    """
+    Add a line to the _report.csv written by make_terrace_plots
+
+    Author: FJC
+    """
+    with open(report_fname, 'a') as output:
+        output.write(str(key)+','+str(value)+'\n')
+
+#---------------------------------------------------------------------------------------------#
+# TABLES
+# Read and write the terrace tables as csv or in a typed, columnar binary format:
+# "npy" (a directory with one .npy file per column, which can be memory-mapped and
+# doesn't need any extra packages), "feather" or "parquet" (these need pyarrow).
+#---------------------------------------------------------------------------------------------#
+
+TABLE_FORMATS = ['csv', 'npy', 'feather', 'parquet']
+
+def get_table_fname(fname_stem, table_format='csv'):
+    """
+    Get the name of the file (or directory, for npy) of a table
+
+    Args:
+        fname_stem (str): the name of the table without the extension, e.g. DataDirectory+fname_prefix+'_terrace_info'
+        table_format (str): one of csv, npy, feather or parquet
+
+    Author: FJC
+    """
+    if table_format not in TABLE_FORMATS:
+        raise ValueError("Unknown table format "+str(table_format)+", choose from "+", ".join(TABLE_FORMATS))
+    if table_format == 'npy':
+        return fname_stem+'_columns'
+    return fname_stem+'.'+table_format
+
+def write_table(df, fname_stem, table_format='csv'):
+    """
+    Write a table in the chosen format.
+
+    Args:
+        df: the dataframe
+        fname_stem (str): the name of the table without the extension
+        table_format (str): one of csv, npy, feather or parquet
+
+    Returns:
+        the name of the file that was written
+
+    Author: FJC
+    """
+    fname = get_table_fname(fname_stem, table_format)
+    if table_format == 'csv':
+        df.to_csv(fname, index=False)
+    elif table_format == 'npy':
+        if not os.path.isdir(fname):
+            os.makedirs(fname)
+        schema = {'columns': [], 'n_rows': len(df)}
+        for col in df.columns:
+            values = df[col]
+            column = {'name': str(col), 'file': 'col_%d.npy' %len(schema['columns'])}
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                column['categories'] = [str(c) for c in values.cat.categories]
+                values = values.cat.codes.values
+            elif pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+                values = values.values
+            else:
+                # strings are stored as fixed width unicode so they can be memory-mapped
+                values = np.asarray(values.values, dtype=str)
+            np.save(os.path.join(fname, column['file']), np.ascontiguousarray(values))
+            schema['columns'].append(column)
+        # the schema is written last, so the table is only readable once it is complete
+        write_json(schema, os.path.join(fname, 'schema.json'))
+    elif table_format == 'feather':
+        df.reset_index(drop=True).to_feather(fname)
+    else:
+        df.to_parquet(fname, index=False)
+    return fname
+
+def read_columns(fname_stem, columns=None):
+    """
+    Read the columns of a table in npy format as memory-mapped arrays, so only
+    the parts of the columns that are used are read from disk.
+
+    Args:
+        fname_stem (str): the name of the table without the extension
+        columns: list of the columns to read. Default = all of them
+
+    Returns:
+        dict of column name: array, and dict of column name: categories for any categorical columns
+
+    Author: FJC
+    """
+    fname = get_table_fname(fname_stem, 'npy')
+    with open(os.path.join(fname, 'schema.json'), 'r') as f:
+        schema = json.load(f)
+    schema_columns = {column['name']: column for column in schema['columns']}
+    if columns is None:
+        columns = [column['name'] for column in schema['columns']]
+
+    arrays = {}
+    categories = {}
+    for col in columns:
+        column = schema_columns[col]
+        arrays[col] = np.load(os.path.join(fname, column['file']), mmap_mode='r')
+        if 'categories' in column:
+            categories[col] = column['categories']
+    return arrays, categories
+
+@instrumentation.timed('read_table')
+def read_table(fname_stem, table_format='csv', columns=None):
+    """
+    Read a table in the chosen format, only reading the columns that you need.
+
+    Args:
+        fname_stem (str): the name of the table without the extension
+        table_format (str): one of csv, npy, feather or parquet
+        columns: list of the columns to read. Default = all of them
+
+    Returns:
+        the dataframe
+
+    Author: FJC
+    """
+    fname = get_table_fname(fname_stem, table_format)
+    if table_format == 'csv':
+        return pd.read_csv(fname, usecols=columns)
+    elif table_format == 'npy':
+        arrays, categories = read_columns(fname_stem, columns)
+        df = pd.DataFrame({col: values.astype(object) if values.dtype.kind == 'U' else np.asarray(values) for col, values in arrays.items()})
+        for col, cats in categories.items():
+            df[col] = pd.Categorical.from_codes(df[col].values, categories=cats)
+        return df
+    elif table_format == 'feather':
+        return pd.read_feather(fname, columns=columns)
+    else:
+        return pd.read_parquet(fname, columns=columns)
+
+def table_exists(fname_stem, table_format='csv'):
+    """
+    Check if a table has been written in the chosen format
+
+    Author: FJC
+    """
+    return os.path.isfile(get_table_file(fname_stem, table_format))
+
+def get_table_file(fname_stem, table_format):
+    """
+    Get the file that marks a table as complete: the schema for npy tables, or
+    the table itself for the other formats
+
+    Author: FJC
+    """
+    fname = get_table_fname(fname_stem, table_format)
+    if table_format == 'npy':
+        return os.path.join(fname, 'schema.json')
+    return fname
+
+def get_table_files(fname_stem, table_format):
+    """
+    Get the list of files that make up a table: all the files in the directory for
+    npy tables, or the table itself for the other formats
+
+    Author: FJC
+    """
+    fname = get_table_fname(fname_stem, table_format)
+    if table_format == 'npy':
+        return [os.path.join(fname, f) for f in sorted(os.listdir(fname))]
+    return [fname]
+
+def load_table(fname_stem, table_format='csv', columns=None, typed=False):
+    """
+    Load a table, using the binary version if there is one that is at least as
+    new as the csv. If there isn't, the csv is read and the binary version is
+    written so that it can be used next time.
+
+    Args:
+        fname_stem (str): the name of the table without the extension
+        table_format (str): one of csv, npy, feather or parquet
+        columns: list of the columns to read. Default = all of them
+        typed (bool): if true, store the columns in smaller types with downcast_table
+
+    Returns:
+        the dataframe
+
+    Author: FJC
+    """
+    # the peak memory of the process before the table is loaded
+    start_peak_mb, _ = instrumentation.get_peak_rss()
+
+    # convert the csv if the binary version doesn't exist or is older
+    csv_fname = get_table_fname(fname_stem, 'csv')
+    convert = False
+    if table_format != 'csv':
+        convert = True
+        if table_exists(fname_stem, table_format):
+            binary_time = os.path.getmtime(get_table_file(fname_stem, table_format))
+            convert = os.path.isfile(csv_fname) and binary_time < os.path.getmtime(csv_fname)
+
+    if convert:
+        print("Converting "+csv_fname+" to "+table_format)
+        df = read_table(fname_stem, 'csv')
+    else:
+        df = read_table(fname_stem, table_format, columns)
+
+    if typed:
+        start_mb = get_table_memory(df)
+        df = downcast_table(df)
+        print("Loaded %s: %d rows, %.1f MB (%.1f MB with the default types)" %(os.path.basename(fname_stem), len(df), get_table_memory(df), start_mb))
+        peak_mb, _ = instrumentation.get_peak_rss()
+        if peak_mb is not None:
+            print("Peak memory of this process: %.0f MB before loading %s, %.0f MB after" %(start_peak_mb, os.path.basename(fname_stem), peak_mb))
+    if convert:
+        write_table(df, fname_stem, table_format)
+        if columns is not None:
+            df = df[columns]
+    return df
+
+#---------------------------------------------------------------------------------------------#
+# TYPES
+# By default pandas reads every number as float64 or int64 and every string as
+# an object. The terrace tables from LSDTopoTools have a known set of columns,
+# so they can be stored in smaller types.
+#---------------------------------------------------------------------------------------------#
+
+# the type of each column of the terrace and baseline tables: 'float' columns are
+# stored as float32 if that changes them by less than the tolerance (so elevations
+# and distances are), 'id' columns as int32 if they are whole numbers that fit, and
+# 'category' columns as categoricals. Columns that aren't listed are left as they are.
+# The X and Y coordinates are always kept as float64, so the projection onto the
+# baseline and the hash of the coordinates for its cache are the same whether or
+# not the table is typed.
+COLUMN_TYPES = {'Elevation': 'float', 'ChannelRelief': 'float',
+                'DistAlongBaseline': 'float', 'DistToBaseline': 'float', 'DistFromOutlet': 'float',
+                'DistAlongB': 'float', 'DistAlongBaseline_new': 'float', 'DistToBaseline_new': 'float',
+                'new_ID': 'id', 'TerraceID': 'id', 'BaselineNode': 'id', 'node': 'id',
+                'reach': 'category', 'layer': 'category'}
+
+def get_table_memory(df):
+    """
+    Get the memory used by a dataframe, in MB, including the strings in object columns
+
+    Author: FJC
+    """
+    return df.memory_usage(index=True, deep=True).sum()/1e6
+
+def downcast_column(values, column_type, tolerance=1e-3):
+    """
+    Convert a column to a smaller type if it can be done without losing precision.
+
+    Args:
+        values: the pandas series
+        column_type (str): 'float', 'id' or 'category'
+        tolerance: the largest change allowed when converting a float column to float32
+
+    Returns:
+        the converted series, or the same series if it can't be converted
+
+    Author: FJC
+    """
+    if len(values) == 0:
+        return values
+    if column_type == 'category':
+        # strings are objects in older versions of pandas and have their own type in newer ones
+        if not isinstance(values.dtype, pd.CategoricalDtype) and pd.api.types.is_string_dtype(values):
+            return values.astype('category')
+    elif column_type == 'id':
+        if pd.api.types.is_integer_dtype(values) or pd.api.types.is_float_dtype(values):
+            array = values.values
+            if np.all(np.isfinite(array)) and np.all(array == np.round(array)) \
+                    and array.min() >= np.iinfo(np.int32).min and array.max() <= np.iinfo(np.int32).max:
+                return values.astype(np.int32)
+    elif column_type == 'float':
+        if pd.api.types.is_float_dtype(values) and values.dtype != np.float32:
+            array = values.values
+            array32 = array.astype(np.float32)
+            error = np.abs(array32 - array)
+            if not np.any(error > tolerance):
+                return pd.Series(array32, index=values.index, name=values.name)
+    return values
+
+def downcast_table(df, tolerance=1e-3, column_types=None):
+    """
+    Store the columns of a terrace or baseline table in the smallest types that keep
+    their values: float32 for floats where this changes them by less than the tolerance,
+    int32 for IDs and categoricals for the reach names. The columns are converted one at
+    a time, in place, so only one extra column is in memory at once.
+
+    Args:
+        df: the dataframe
+        tolerance: the largest change allowed when converting a float column to float32 (m)
+        column_types: dict of column name: 'float', 'id' or 'category'. Default = COLUMN_TYPES
+
+    Returns:
+        the dataframe with the converted columns
+
+    Author: FJC
+    """
+    column_types = COLUMN_TYPES if column_types is None else column_types
+    for col in df.columns:
+        if col in column_types:
+            converted = downcast_column(df[col], column_types[col], tolerance)
+            if converted.dtype != df[col].dtype:
+                df[col] = converted
+    return df
+
+#---------------------------------------------------------------------------------------------#
+# CACHING
+#---------------------------------------------------------------------------------------------#
+
+def cached_distance_along_baseline(terraces, lp, cache_dir, cache_name, index_dir=None):
+    """
+    This function gets the distance along the baseline for each of the terrace
+    points, using a cache so that it is only calculated when the terrace
+    coordinates, the baseline or the projection code change. The cache key is
+    made from hashes of the terrace X and Y columns, the baseline vertices and
+    the projection parameters. The computed columns are stored in a .npz file
+    alongside a json manifest with the key.
+
+    Args:
+        terraces: the dataframe with the terrace info
+        lp: the dataframe with the baseline points
+        cache_dir (str): the directory for the cache files
+        cache_name (str): the name of this cache, e.g. the DEM prefix or the reach
+        index_dir (str): the directory of a saved baseline index to reuse, if the distances need calculating
+
+    Returns:
+        terrace dataframe with the projection columns, and "hit" or "miss"
+
+    Author: FJC
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    manifest_fname = os.path.join(cache_dir, cache_name+'_manifest.json')
+    columns_fname = os.path.join(cache_dir, cache_name+'_columns.npz')
+
+    key = {'terraces': hash_arrays(terraces['X'].values, terraces['Y'].values),
+           'baseline': hash_arrays(lp['X'].values, lp['Y'].values),
+           'params': PROJECTION_PARAMS}
+
+    # check if the cache is current
+    if os.path.isfile(manifest_fname) and os.path.isfile(columns_fname):
+        with open(manifest_fname, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('key') == key and manifest.get('n_rows') == len(terraces):
+            with np.load(columns_fname) as columns:
+                for col in manifest['columns']:
+                    terraces[col] = columns[col]
+            print("Using cached distances along the baseline for "+cache_name)
+            return terraces, 'hit'
+
+    # otherwise recompute and store the columns, then the manifest
+    print("Calculating distances along the baseline for "+cache_name)
+    if os.path.isfile(manifest_fname):
+        os.remove(manifest_fname)
+    terraces = TerracePlotter.get_distance_along_baseline_points(terraces, lp, index_dir)
+    np.savez(columns_fname, **{col: terraces[col].values for col in PROJECTION_COLUMNS})
+    write_json({'key': key, 'n_rows': len(terraces), 'columns': PROJECTION_COLUMNS}, manifest_fname)
+
+    return terraces, 'miss'
+
+#---------------------------------------------------------------------------------------------#
+# CHECKPOINTS
+# The projected terrace table of each reach is saved as a checkpoint, so a compiled
+# run that stops part of the way through can be resumed without reading and
+# projecting the reaches that were finished. A checkpoint is only used if the
+# terrace table, the baseline and the settings are the same, and if the hash of its
+# files matches the hash in its manifest, so a half-written checkpoint is never used.
+#---------------------------------------------------------------------------------------------#
+
+def get_source_key(fname_stem, table_format):
+    """
+    Get the name, size and modification time of the file that a terrace table is read
+    from (the csv if there is one), so it can be checked for changes without reading it
+
+    Author: FJC
+    """
+    source = get_table_fname(fname_stem, 'csv')
+    if not os.path.isfile(source):
+        source = get_table_file(fname_stem, table_format)
+    return {'source': os.path.basename(source), 'size': os.path.getsize(source), 'mtime': os.path.getmtime(source)}
+
+def get_checkpoint_key(fname_stem, table_format, lp, typed=False):
+    """
+    Get the key of the inputs of a checkpoint: the size and modification time of the
+    terrace table (so it doesn't need to be read), a hash of the baseline vertices, the
+    projection parameters and whether the table is typed.
+
+    Args:
+        fname_stem (str): the name of the terrace table without the extension
+        table_format (str): one of csv, npy, feather or parquet
+        lp: the dataframe with the baseline points
+        typed (bool): whether the table is downcast
+
+    Returns:
+        dict with the key
+
+    Author: FJC
+    """
+    key = get_source_key(fname_stem, table_format)
+    key.update({'baseline': hash_arrays(lp['X'].values, lp['Y'].values), 'params': PROJECTION_PARAMS, 'typed': bool(typed)})
+    return key
+
+def _read_manifest(manifest_fname):
+    """
+    Read a json manifest, or None if it is missing or can't be read (e.g. if it is truncated)
+    """
+    if not os.path.isfile(manifest_fname):
+        return None
+    try:
+        with open(manifest_fname, 'r') as f:
+            manifest = json.load(f)
+    except ValueError:
+        return None
+    return manifest if isinstance(manifest, dict) else None
+
+def write_checkpoint(terraces, checkpoint_stem, key, table_format='csv'):
+    """
+    Write the checkpoint of a table. The old manifest is removed first and the new
+    one, with the hash of the table files, is written last.
+
+    Args:
+        terraces: the dataframe
+        checkpoint_stem (str): the name of the checkpoint without the extension
+        key: the key of the inputs, from get_checkpoint_key
+        table_format (str): one of csv, npy, feather or parquet
+
+    Author: FJC
+    """
+    manifest_fname = checkpoint_stem+'_checkpoint.json'
+    if os.path.isfile(manifest_fname):
+        os.remove(manifest_fname)
+    write_table(terraces, checkpoint_stem, table_format)
+    write_json({'key': key, 'n_rows': len(terraces), 'table_format': table_format,
+                'hash': hash_files(get_table_files(checkpoint_stem, table_format))}, manifest_fname)
+
+def read_checkpoint(checkpoint_stem, key, table_format='csv', typed=False):
+    """
+    Read the checkpoint of a table if it is complete and was made from the same inputs
+
+    Args:
+        checkpoint_stem (str): the name of the checkpoint without the extension
+        key: the key of the inputs, from get_checkpoint_key
+        table_format (str): one of csv, npy, feather or parquet
+        typed (bool): if true, downcast the table
+
+    Returns:
+        the dataframe, or None if there isn't a valid checkpoint
+
+    Author: FJC
+    """
+    manifest = _read_checkpoint_manifest(checkpoint_stem, key, table_format)
+    if manifest is None:
+        return None
+    try:
+        if hash_files(get_table_files(checkpoint_stem, table_format)) != manifest['hash']:
+            print("The checkpoint "+checkpoint_stem+" doesn't match its hash, so I won't use it")
+            return None
+    except OSError:
+        return None
+    df = read_table(checkpoint_stem, table_format)
+    if len(df) != manifest['n_rows']:
+        return None
+    if typed:
+        df = downcast_table(df)
+    return df
+
+def _read_checkpoint_manifest(checkpoint_stem, key, table_format):
+    """
+    Read the manifest of a checkpoint, or None if there isn't one for these inputs
+    """
+    manifest = _read_manifest(checkpoint_stem+'_checkpoint.json')
+    if manifest is None or manifest.get('key') != key or manifest.get('table_format') != table_format:
+        return None
+    return manifest
+
+#---------------------------------------------------------------------------------------------#
+# REACHES
+# Load the terraces for all the reaches of the compiled (whole valley) mode
+#---------------------------------------------------------------------------------------------#
+
+def get_reach_fname(DataDirectory, reach):
+    """
+    Get the name of the terrace table of a reach, without the extension
+
+    Author: FJC
+    """
+    return DataDirectory+reach+os.path.sep+reach+'_final_terrace_info_filtered'
+
+def get_reaches_key(DataDirectory, reaches, lp_df, table_format='csv', typed=False):
+    """
+    Get the key of the inputs of the joined table of all the reaches: the list of
+    reaches, the size and modification time of the terrace table of each one, a hash
+    of the baseline vertices, the projection parameters and whether the table is typed.
+    Any change to a reach table (not just to its coordinates), or adding or removing a
+    reach, changes the key.
+
+    Args:
+        DataDirectory (str): the directory with a sub-directory for each reach
+        reaches: list of the reach names
+        lp_df: the merged baseline
+        table_format (str): one of csv, npy, feather or parquet
+        typed (bool): whether the table is downcast
+
+    Returns:
+        dict with the key
+
+    Author: FJC
+    """
+    return {'reaches': [dict(get_source_key(get_reach_fname(DataDirectory, reach), table_format), reach=reach) for reach in reaches],
+            'baseline': hash_arrays(lp_df['X'].values, lp_df['Y'].values), 'params': PROJECTION_PARAMS, 'typed': bool(typed)}
+
+def update_table(df, fname_stem, table_format, key):
+    """
+    Write a table that is made from some inputs, unless it has already been written
+    from the same inputs. The key of the inputs is stored in a manifest next to the
+    table. The old manifest is removed before the table is written and the new one is
+    written last, so a table that was only partly written is always written again.
+
+    Args:
+        df: the dataframe
+        fname_stem (str): the name of the table without the extension
+        table_format (str): one of csv, npy, feather or parquet
+        key: the key of the inputs, e.g. from get_reaches_key
+
+    Returns:
+        True if the table was written, False if it was already current
+
+    Author: FJC
+    """
+    manifest_fname = fname_stem+'_manifest.json'
+    manifest = _read_manifest(manifest_fname)
+    if table_exists(fname_stem, table_format) and manifest is not None:
+        if manifest.get('key') == key and manifest.get('n_rows') == len(df) and manifest.get('table_format') == table_format:
+            return False
+
+    if os.path.isfile(manifest_fname):
+        os.remove(manifest_fname)
+    write_table(df, fname_stem, table_format)
+    write_json({'key': key, 'n_rows': len(df), 'table_format': table_format}, manifest_fname)
+    return True
+
+def _load_reach(job):
+    """
+    Load the terraces for one reach and get their distance along the merged
+    baseline. The job is a tuple of the reach name, the name of its terrace table,
+    the merged baseline, the cache directory, the table format, the directory
+    of the baseline index, whether to downcast the table and whether to resume
+    from a checkpoint.
+    """
+    reach, fname_stem, lp_df, cache_dir, table_format, index_dir, typed, resume = job
+    start_wall = time.time()
+    start_cpu = time.process_time()
+    checkpoint_stem = os.path.join(cache_dir, reach)
+    key = get_checkpoint_key(fname_stem, table_format, lp_df, typed)
+
+    terraces = None
+    if resume:
+        terraces = read_checkpoint(checkpoint_stem, key, table_format, typed)
+    if terraces is not None:
+        print("Resuming "+reach+" from its checkpoint")
+        cache_status = 'checkpoint'
+        read_time = time.time() - start_wall
+        checkpoint_time = 0.
+    else:
+        terraces = load_table(fname_stem, table_format, typed=typed)
+        read_time = time.time() - start_wall
+        terraces, cache_status = cached_distance_along_baseline(terraces, lp_df, cache_dir, reach, index_dir)
+        # checkpoint the projected table, unless there is already a checkpoint for these inputs (if
+        # resuming, the checkpoint wasn't valid so it is always written again)
+        start_checkpoint = time.time()
+        manifest = _read_checkpoint_manifest(checkpoint_stem, key, table_format)
+        if resume or cache_status == 'miss' or manifest is None or manifest['n_rows'] != len(terraces):
+            write_checkpoint(terraces, checkpoint_stem, key, table_format)
+        checkpoint_time = time.time() - start_checkpoint
+
+    timing = {'reach': reach, 'n_rows': len(terraces), 'cache': cache_status,
+              'read_time': read_time, 'project_time': time.time() - start_wall - read_time - checkpoint_time,
+              'checkpoint_time': checkpoint_time, 'wall_time': time.time() - start_wall,
+              'cpu_time': time.process_time() - start_cpu, 'worker': os.getpid()}
+    return terraces, timing
+
+@instrumentation.timed('load_reaches', rows_from='reaches')
+def load_reaches(DataDirectory, reaches, lp_df, cache_dir, table_format='csv', n_workers=1, log_fname=None, index_dir=None, typed=False, resume=False):
+    """
+    This function loads the terraces for each reach and gets their distance along the
+    merged baseline, either one reach after the other or in a pool of worker processes.
+    The reaches are then joined together with a single concatenation.
+
+    Args:
+        DataDirectory (str): the directory with a sub-directory for each reach
+        reaches: list of the reach names (the sub-directories)
+        lp_df: the merged baseline
+        cache_dir (str): the directory for the cached distances along the baseline
+        table_format (str): one of csv, npy, feather or parquet
+        n_workers (int): the number of worker processes. Default = 1 (no pool)
+        log_fname (str): if given, write the time taken for each reach to this csv
+        index_dir (str): the directory of the saved index of the merged baseline, which is
+        memory-mapped by each reach instead of rebuilding it
+        typed (bool): if true, store the columns in smaller types (see downcast_table) and
+        the reach as a categorical
+        resume (bool): if true, reaches with a valid checkpoint in the cache directory are
+        read from it rather than being loaded and projected again
+
+    Returns:
+        dataframe with the terraces for all the reaches, and a dataframe with the
+        cache status and time taken for each reach
+
+    Author: FJC
+    """
+    jobs = [(reach, get_reach_fname(DataDirectory, reach), lp_df, cache_dir, table_format, index_dir, typed, resume) for reach in reaches]
+    results = [None]*len(jobs)
+
+    def _report(i, n_done):
+        timing = results[i][1]
+        print("Loaded reach %d of %d: %s (%d rows, cache %s, %.1f s)" %(n_done, len(jobs), timing['reach'], timing['n_rows'], timing['cache'], timing['wall_time']))
+
+    if n_workers > 1 and len(jobs) > 1:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = {pool.submit(_load_reach, job): i for i, job in enumerate(jobs)}
+            for n_done, future in enumerate(as_completed(futures)):
+                results[futures[future]] = future.result()
+                _report(futures[future], n_done+1)
+    else:
+        for i, job in enumerate(jobs):
+            results[i] = _load_reach(job)
+            _report(i, i+1)
+
+    timing_df = pd.DataFrame([timing for terraces, timing in results],
+                             columns=['reach', 'n_rows', 'cache', 'read_time', 'project_time', 'checkpoint_time', 'wall_time', 'cpu_time', 'worker'])
+    if log_fname:
+        timing_df.to_csv(log_fname, index=False)
+
+    if results:
+        master_df = pd.concat([terraces for terraces, timing in results], ignore_index=True)
+        # add the reach of each row after joining them, so the categories are the same for all the reaches
+        reach_codes = np.repeat(np.arange(len(reaches)), [len(terraces) for terraces, timing in results])
+        if typed:
+            master_df['reach'] = pd.Categorical.from_codes(reach_codes, categories=reaches)
+        else:
+            master_df['reach'] = np.asarray(reaches, dtype=object)[reach_codes]
+    else:
+        master_df = pd.DataFrame()
+    return master_df, timing_df
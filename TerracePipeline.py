@@ -0,0 +1,385 @@
+#------------------------------------------------------------------------------#
+# terrace-long-profiler
+# A small pipeline for running the analysis of a single reach as a set of
+# stages. Each stage declares the files it reads and writes and the stages it
+# depends on, and only the stages whose outputs are out of date are run.
+# Authors: F. Clubb
+#------------------------------------------------------------------------------#
+
+# import modules
+import json
+import os
+import threading
+import time
+import traceback
+
+import TerraceIO
+from LSDPlottingTools import instrumentation
+
+# pyplot isn't thread safe, so stages that make figures hold this lock
+PYPLOT_LOCK = threading.Lock()
+
+class Stage(object):
+    """
+    A stage of the pipeline.
+
+    Args:
+        name (str): the name of the stage
+        function: the function that runs the stage. It is called with the context dict,
+        which has the results of the stages before it, and returns a dict of results to add
+        to the context (or None)
+        inputs: list of the files that the stage reads
+        outputs: list of the files that the stage writes. A stage without any outputs only
+        makes results for the stages after it, so it is only run if they are.
+        depends: list of the names of the stages that this stage needs the results of
+        params: dict of the parameters that change the outputs of the stage
+        uses_pyplot (bool): if true, the stage holds PYPLOT_LOCK while it runs
+
+    Author: FJC
+    """
+    def __init__(self, name, function, inputs=None, outputs=None, depends=None, params=None, uses_pyplot=False):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs) if inputs else []
+        self.outputs = list(outputs) if outputs else []
+        self.depends = list(depends) if depends else []
+        self.params = dict(params) if params else {}
+        self.uses_pyplot = uses_pyplot
+
+    def run(self, context):
+        if self.uses_pyplot:
+            with PYPLOT_LOCK:
+                return self.function(context)
+        return self.function(context)
+
+#---------------------------------------------------------------------------------------------#
+# WORKING OUT WHAT TO RUN
+#---------------------------------------------------------------------------------------------#
+
+def sort_stages(stages):
+    """
+    Sort the stages so that every stage comes after the stages it depends on.
+
+    Args:
+        stages: list of Stage objects
+
+    Returns:
+        list of the stages in order
+
+    Author: FJC
+    """
+    stage_dict = {stage.name: stage for stage in stages}
+    sorted_stages = []
+    visited = {}
+
+    def _visit(name, path):
+        if visited.get(name) == 'done':
+            return
+        if name in path:
+            raise ValueError("The pipeline stages have a circular dependency: "+" -> ".join(path+[name]))
+        if name not in stage_dict:
+            raise ValueError("Stage "+path[-1]+" depends on "+name+", which isn't a stage")
+        for dep in stage_dict[name].depends:
+            _visit(dep, path+[name])
+        visited[name] = 'done'
+        sorted_stages.append(stage_dict[name])
+
+    for stage in stages:
+        _visit(stage.name, [])
+    return sorted_stages
+
+def _get_stale_reason(stage, previous, stale_stages):
+    """
+    Get the reason that a stage needs to be run, or None if its outputs are current
+    """
+    if not stage.outputs:
+        return None
+    for fname in stage.outputs:
+        if not os.path.exists(fname):
+            return "missing output "+os.path.basename(fname)
+    if stage.name not in previous or previous[stage.name].get('params') != stage.params:
+        return "parameters changed"
+    oldest_output = min(os.path.getmtime(fname) for fname in stage.outputs)
+    for fname in stage.inputs:
+        if os.path.exists(fname) and os.path.getmtime(fname) > oldest_output:
+            return "input "+os.path.basename(fname)+" is newer than the outputs"
+    for dep in stage.depends:
+        if dep in stale_stages:
+            return "stage "+dep+" is out of date"
+    return None
+
+def plan_pipeline(stages, targets, previous=None, force=False):
+    """
+    Work out which stages to run to make the targets. A stage is run if its
+    outputs are missing or older than its inputs, if its parameters have changed
+    since the last run, if a stage it depends on is run because it is out of date,
+    or if a stage that is run needs its results.
+
+    Args:
+        stages: list of Stage objects
+        targets: list of the names of the stages that you want
+        previous: the stages from the manifest of the last run
+        force (bool): if true, run all the stages needed for the targets
+
+    Returns:
+        the stages needed for the targets in order, and dicts of the stages to
+        run and the stages that are current, with the reason for each
+
+    Author: FJC
+    """
+    if previous is None:
+        previous = {}
+    stage_dict = {stage.name: stage for stage in stages}
+
+    # find all the stages that the targets need
+    needed = set()
+    to_check = list(targets)
+    while to_check:
+        name = to_check.pop()
+        if name not in needed:
+            needed.add(name)
+            to_check.extend(stage_dict[name].depends)
+    ordered = [stage for stage in sort_stages(stages) if stage.name in needed]
+
+    # find the stages that are out of date, from the first to the last
+    stale = {}
+    for stage in ordered:
+        reason = "forced" if force and stage.outputs else _get_stale_reason(stage, previous, stale)
+        if reason:
+            stale[stage.name] = reason
+
+    # the stages that are out of date need the results of all the stages before them
+    to_run = dict(stale)
+    for stage in reversed(ordered):
+        if stage.name in to_run:
+            for dep in stage.depends:
+                if dep not in to_run:
+                    to_run[dep] = "results needed by "+stage.name
+    current = {stage.name: ("outputs are current" if stage.outputs else "results not needed") for stage in ordered if stage.name not in to_run}
+
+    return ordered, to_run, current
+
+#---------------------------------------------------------------------------------------------#
+# RUNNING
+#---------------------------------------------------------------------------------------------#
+
+def read_manifest(manifest_fname):
+    """
+    Read the stages from the manifest of the last run, if there is one
+
+    Author: FJC
+    """
+    if not os.path.isfile(manifest_fname):
+        return {}
+    with open(manifest_fname, 'r') as f:
+        return json.load(f).get('stages', {})
+
+def run_pipeline(stages, targets, manifest_fname, n_threads=1, force=False):
+    """
+    This function runs the stages needed to make the targets. Only the stages that
+    are out of date are run (see plan_pipeline), and stages that don't depend on
+    each other are run at the same time in a pool of threads. A manifest of the run
+    is written to manifest_fname, with the status of each stage, why it was or wasn't
+    run, its inputs, outputs and parameters, and how long it took.
+
+    Args:
+        stages: list of Stage objects
+        targets: list of the names of the stages that you want
+        manifest_fname (str): the name of the json manifest
+        n_threads (int): the number of stages to run at once. Default = 1
+        force (bool): if true, run all the stages needed for the targets
+
+    Returns:
+        the context dict with the results of the stages that were run
+
+    Author: FJC
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    previous = read_manifest(manifest_fname)
+    ordered, to_run, current = plan_pipeline(stages, targets, previous, force)
+
+    context = {'stale_stages': set(name for name, reason in to_run.items() if not reason.startswith("results needed"))}
+    records = {}
+    for stage in ordered:
+        records[stage.name] = {'inputs': stage.inputs, 'outputs': stage.outputs, 'depends': stage.depends,
+                               'params': stage.params, 'status': 'current', 'reason': current.get(stage.name, to_run.get(stage.name)),
+                               'start_time': None, 'wall_time': 0.}
+
+    def _run_stage(stage):
+        print("Running stage "+stage.name+": "+to_run[stage.name])
+        start_time = time.time()
+        with instrumentation.stage(stage.name):
+            results = stage.run(context)
+        return results, start_time, time.time() - start_time
+
+    waiting = [stage for stage in ordered if stage.name in to_run]
+    done = set(stage.name for stage in ordered if stage.name not in to_run)
+    failed = set()
+    first_error = None
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, n_threads)) as pool:
+        while waiting or running:
+            # start every stage whose dependencies have finished
+            for stage in list(waiting):
+                if any(dep in failed for dep in stage.depends):
+                    waiting.remove(stage)
+                    failed.add(stage.name)
+                    records[stage.name].update({'status': 'skipped', 'reason': "a stage it depends on failed", 'params': None})
+                elif all(dep in done for dep in stage.depends):
+                    waiting.remove(stage)
+                    running[pool.submit(_run_stage, stage)] = stage
+            if not running:
+                continue
+
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    results, start_time, wall_time = future.result()
+                except Exception as e:
+                    print("Stage "+stage.name+" failed: "+repr(e))
+                    failed.add(stage.name)
+                    # clear the parameters so the stage is run again next time
+                    records[stage.name].update({'status': 'failed', 'error': traceback.format_exc(), 'params': None})
+                    if first_error is None:
+                        first_error = e
+                    continue
+                if results:
+                    context.update(results)
+                done.add(stage.name)
+                records[stage.name].update({'status': 'ran', 'start_time': start_time, 'wall_time': wall_time})
+
+    # keep the stages from the last run that weren't part of this one
+    manifest_stages = dict(previous)
+    manifest_stages.update(records)
+    TerraceIO.write_json({'targets': list(targets), 'n_threads': n_threads, 'force': force,
+                          'finished': time.strftime('%Y-%m-%d %H:%M:%S'), 'stages': manifest_stages}, manifest_fname)
+
+    if first_error is not None:
+        raise first_error
+    return context
+
+#---------------------------------------------------------------------------------------------#
+# STAGES FOR A SINGLE REACH
+#---------------------------------------------------------------------------------------------#
+
+def get_reach_stages(DataDirectory, fname_prefix, args, report_fname):
+    """
+    Get the stages for the analysis of a single reach: load the tables, project the
+    terraces onto the baseline, summarise each terrace, get the dips, make the heat
+    map and make the plots.
+
+    Args:
+        DataDirectory (str): the data directory
+        fname_prefix (str): name of the DEM
+        args: the arguments from make_terrace_plots
+        report_fname (str): the _report.csv, for the cache status
+
+    Returns:
+        list of Stage objects
+
+    Author: FJC
+    """
+    import TerracePlotter
+    import TerraceProfileFitter
+
+    stem = DataDirectory+fname_prefix
+    fmt = args.table_format
+    table_inputs = [stem+'_baseline_channel_info.csv', stem+'_terrace_info.csv']
+    dist_file = stem+'_terrace_info_dist'
+    dist_table = TerraceIO.get_table_file(dist_file, fmt)
+    means_file = stem+'_terrace_means.csv'
+    # the heat map uses the terraces that have been filtered by the digitised polygons
+    # (from filter_points_by_shapefile.py) and projected onto the baseline
+    filtered_file = stem+'_terrace_info_filtered_dist'
+
+    def load(context):
+        # read in the baseline channel and the terrace tables
+        lp = TerraceIO.load_table(stem+'_baseline_channel_info', fmt, typed=args.typed_tables)
+        lp = lp[lp['Elevation'] != -9999]
+        terraces = TerraceIO.load_table(stem+'_terrace_info', fmt, typed=args.typed_tables)
+        return {'lp': lp, 'terraces': terraces}
+
+    def project(context):
+        # find the nearest point along the baseline for each terrace ID. This is cached, so it is only
+        # recalculated if the terraces or the baseline have changed.
+        cache_dir = stem+'_cache'+os.path.sep
+        terraces, cache_status = TerraceIO.cached_distance_along_baseline(context['terraces'], context['lp'], cache_dir, fname_prefix)
+        TerraceIO.append_to_report(report_fname, 'cache_'+fname_prefix, cache_status)
+        if cache_status == 'miss' or 'project' in context['stale_stages'] or not TerraceIO.table_exists(dist_file, fmt):
+            TerraceIO.write_table(terraces, dist_file, fmt)
+        return {'terraces': terraces}
+
+    def summarize(context):
+        # get the mean elevation, distance, relief and area of each terrace
+        summary_df = TerracePlotter.get_terrace_summary(context['terraces'], res=5)
+        print(summary_df)
+        summary_df.to_csv(means_file, index=False)
+        return {'summary': summary_df}
+
+    def means_plot(context):
+        # plot the mean elevation of each terrace against the long profile
+        terraces = context['terraces']
+        TerracePlotter.plot_terrace_means(DataDirectory, fname_prefix, context['summary'], context['lp'],
+                                          relief_range=(terraces.ChannelRelief.min(), terraces.ChannelRelief.max()), FigFormat=args.FigFormat)
+
+    def paleo_profiles(context):
+        TerraceProfileFitter.paleo_profiler(DataDirectory, fname_prefix, context['summary'], context['lp'], max_rmse=args.fit_rmse,
+                                            FigFormat=args.FigFormat, n_workers=args.n_workers)
+
+    def binned_profiles(context):
+        TerracePlotter.long_profiler(DataDirectory, fname_prefix, context['terraces'], context['lp'], FigFormat=args.FigFormat,
+                                     n_workers=args.n_workers, bin_width=args.bin_width)
+
+    def surfaces_3d(context):
+        TerracePlotter.PlotTerraceSurfaces(DataDirectory, fname_prefix, context['terraces'], n_workers=args.n_workers, fit_method=args.plane_fit)
+
+    def dips(context):
+        # get the dip and dip direction of each terrace surface
+        terrace_dips = TerracePlotter.get_terrace_dip_and_dipdir(context['terraces'], fit_method=args.plane_fit, n_workers=args.n_workers)
+        terrace_dips.to_csv(stem+'_Dip_DipDirection.csv')
+
+    def heat_map(context):
+        TerracePlotter.MakeTerraceHeatMap(DataDirectory, fname_prefix, prec=100, bw_method=0.03, FigFormat=args.FigFormat, ages="",
+                                          kde_method=args.kde_method, check_error=args.kde_error, lp=context['lp'], table_format=fmt)
+
+    return [Stage('load', load, inputs=table_inputs, params={'table_format': fmt, 'typed': args.typed_tables}),
+            Stage('project', project, inputs=table_inputs, outputs=[dist_table], depends=['load'],
+                  params={'table_format': fmt, 'projection': TerraceIO.PROJECTION_PARAMS}),
+            Stage('summarize', summarize, inputs=[dist_table], outputs=[means_file], depends=['project'], params={'res': 5}),
+            Stage('means_plot', means_plot, inputs=[means_file], outputs=[stem+'_terrace_plot.'+args.FigFormat],
+                  depends=['load', 'project', 'summarize'], params={'FigFormat': args.FigFormat}, uses_pyplot=True),
+            Stage('paleo_profiles', paleo_profiles, inputs=[means_file],
+                  outputs=[stem+'_paleo_profiles.csv', stem+'_paleo_profile_residuals.csv', stem+'_paleo_profiles.'+args.FigFormat],
+                  depends=['load', 'summarize'], params={'fit_rmse': args.fit_rmse, 'FigFormat': args.FigFormat}, uses_pyplot=True),
+            Stage('binned_profiles', binned_profiles, inputs=[dist_table],
+                  outputs=[stem+'_terrace_binned_profiles.csv', stem+'_terrace_plot_timings.csv'],
+                  depends=['load', 'project'], params={'bin_width': args.bin_width, 'FigFormat': args.FigFormat}, uses_pyplot=True),
+            Stage('surfaces_3d', surfaces_3d, inputs=[dist_table], outputs=[stem+'_3d_plot_timings.csv'], depends=['project'],
+                  params={'plane_fit': args.plane_fit}, uses_pyplot=True),
+            Stage('dips', dips, inputs=[dist_table], outputs=[stem+'_Dip_DipDirection.csv'], depends=['project'], params={'plane_fit': args.plane_fit}),
+            Stage('heat_map', heat_map, inputs=[filtered_file+'.csv'], outputs=[stem+'_terrace_plot_heat_map.'+args.FigFormat], depends=['load'],
+                  params={'kde_method': args.kde_method, 'kde_error': args.kde_error, 'FigFormat': args.FigFormat}, uses_pyplot=True)]
+
+def get_reach_targets(args):
+    """
+    Get the stages to run for a single reach from the arguments of make_terrace_plots.
+    The terraces are always projected onto the baseline.
+
+    Author: FJC
+    """
+    targets = ['project']
+    if args.long_profiler:
+        targets += ['summarize', 'means_plot']
+    if args.fit_profiles:
+        targets.append('paleo_profiles')
+    if args.binned_profiles:
+        targets.append('binned_profiles')
+    if args.plot_3d:
+        targets.append('surfaces_3d')
+    if args.dips:
+        targets.append('dips')
+    if args.heat_map:
+        targets.append('heat_map')
+    return targets
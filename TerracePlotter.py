@@ -6,23 +6,21 @@
 #          F. Clubb
 #------------------------------------------------------------------------------#
 
-# import modules
+# import modules. mplot3d, shapely, fiona and scipy are slow to import, so they
+# are imported in the functions that need them.
 import pandas as pd
 import numpy as np
 from matplotlib import pyplot as plt
 import matplotlib.cm as cm
 from matplotlib import rcParams
 from matplotlib import colors as colors
-from mpl_toolkits import mplot3d
-from shapely.geometry import shape, Polygon, Point, LineString, mapping
-import fiona
 import os
 import sys
-from scipy.signal import savgol_filter
-from scipy import linalg
-from scipy import stats
 import math
 import re
+import itertools
+import time
+from LSDPlottingTools import instrumentation
 
 def cmap_discretize(N, cmap):
     """Return a discrete colormap from the continuous colormap cmap.
@@ -99,13 +97,14 @@ def CreateFigure(FigSizeFormat="default", AspectRatio=16./9.):
 # Functions to analyse the terrace info
 #---------------------------------------------------------------------------------------------#
 
-def write_dip_and_dipdir_to_csv(DataDirectory,fname_prefix):
+def write_dip_and_dipdir_to_csv(DataDirectory,fname_prefix,fit_method='lstsq'):
     """
     Wrapper for dip and dipdir function
 
     Args:
         DataDirectory (str): the data directory
         fname_prefix (str): name of the DEM
+        fit_method (str): how to fit the planes, 'lstsq', 'huber' or 'ransac' (see fit_terrace_planes)
 
     Author: FJC
     """
@@ -113,13 +112,14 @@ def write_dip_and_dipdir_to_csv(DataDirectory,fname_prefix):
     terraces = pd.read_csv(DataDirectory+fname_prefix+'_terrace_info_filtered.csv')
 
     # get the terrace dip and dip dirs
-    terrace_dips = get_terrace_dip_and_dipdir(terraces)
+    terrace_dips = get_terrace_dip_and_dipdir(terraces, fit_method=fit_method)
 
     # write to csv
     terrace_dips.to_csv(DataDirectory+fname_prefix+'_Dip_DipDirection.csv')
 
 
-def get_terrace_dip_and_dipdir(terrace_df):
+@instrumentation.timed('dip_and_dipdir', rows_from='terrace_df')
+def get_terrace_dip_and_dipdir(terrace_df, fit_method='lstsq', n_workers=1):
     """
     This function takes the initial terrace dataframe and calculates the dip and
     strike of the terrace surfaces. Fits a polynomial surface to the distribution
@@ -127,131 +127,928 @@ def get_terrace_dip_and_dipdir(terrace_df):
 
     Args:
         terrace_df: pandas dataframe with the terrace info
+        fit_method (str): how to fit the planes, 'lstsq', 'huber' or 'ransac' (see fit_terrace_planes)
+        n_workers (int): the number of processes for the robust fits
 
     Returns:
-        dataframe with terrace dip and dip directions
+        dataframe with terrace dip and dip directions, and the number of pixels and
+        fraction of inliers of each terrace for the robust fits
 
     Author: AW and FJC
     """
-    #from mpl_toolkits.mplot3d import Axes3D
-
-    # get the unique terrace IDs
-    terraceIDs = terrace_df.TerraceID.unique()
-    print(terraceIDs)
-
-    dips = []
-    dip_dirs = []
-    strikes = []
-    XbarTerraces = []
-    YbarTerraces = []
-
-    # get the info for each terrace ID
-    for terraceID in terraceIDs:
-        _terrace_subset = (terrace_df.TerraceID.values == terraceID)
-        _x = terrace_df['DistAlongBaseline'].values[_terrace_subset]
-        _y = terrace_df['DistToBaseline'].values[_terrace_subset]
-        _z = terrace_df['Elevation'].values[_terrace_subset]
-        _X = terrace_df['X'].values[_terrace_subset]
-        _Y = terrace_df['Y'].values[_terrace_subset]
-
-        # fit a plane to these points
-        # form: Z = C[0]*X + C[1]*Y + C[2]
-        _XY = np.vstack((_X, _Y, np.ones(len(_Y)))).transpose()
-        C,_,_,_ = linalg.lstsq(_XY, _z)
-
-        # going to get the dip and dip direction using the unit normal vector
-        # to the plane.
-        a = -C[0]
-        b = -C[1]
-        c = 1
-        n_vec = np.array([a,b,c])
-        print(n_vec)
-        # n vector projected onto the xy plane (multiply n_vec by (1,1,0))
-        n_xy = np.array([a,b,0])
-
-        #print n_vec
-
-        # now get the dip = angle between n_vec and n_xy. angle between 2 vectors:
-        # cos theta = (alpha . beta) / (|alpha| |beta|)
-        # This gives the dip in radians
-        dip = np.arccos((np.dot(n_vec,n_xy))/(np.linalg.norm(n_vec)*np.linalg.norm(n_xy)))
-        # convert to degrees
-        dip = 90 - math.degrees(dip)
-
-        # get the dip direction = angle between n_proj and the due north vector y = (0,1,0)
-        y_vec = np.array([0,1,0])
-        theta = np.arccos((np.dot(n_xy,y_vec))/(np.linalg.norm(n_xy)*np.linalg.norm(y_vec)))
-        theta = math.degrees(theta)
-        print("Theta", theta)
-
-        # work out strike depending on orientation
-        if a > 0 and b > 0: # x is positive so dip dir is just theta
-            strike = 270 + theta
-        elif a < 0:
-            strike = 270 - theta
-        elif a > 0 and b < 0: # x is negative so dip dir is 180+theta?
-            strike = theta - 90
-
-        # now get the dip dir using the right hand rule
-        dip_dir = strike+90
-        if dip_dir > 359:
-            dip_dir = dip_dir - 360
-
-        dips.append(dip)
-        dip_dirs.append(dip_dir)
-        strikes.append(strike)
-
-        # get the mean x and y for plotting
-        XbarTerraces.append(np.mean(_X))
-        YbarTerraces.append(np.mean(_Y))
-
-    outarray = np.vstack((XbarTerraces, YbarTerraces, dips, dip_dirs, strikes)).transpose()
-    _column_names = ('X', 'Y', 'dip', 'dip_azimuth', 'strike')
-    _index = np.arange(len(dips))+1
-    output_pd = pd.DataFrame(data = outarray, index=_index, columns=_column_names)
+    # fit a plane to every terrace at once
+    planes = fit_terrace_planes(terrace_df, by='TerraceID', method=fit_method, n_workers=n_workers)
+    dips, dip_dirs, strikes = get_dip_and_strike(planes['C'])
+
+    output_pd = pd.DataFrame({'TerraceID': planes['keys']['TerraceID'].values,
+                              'X': planes['X_mean'], 'Y': planes['Y_mean'],
+                              'dip': dips, 'dip_azimuth': dip_dirs, 'strike': strikes})
+    if fit_method != 'lstsq':
+        output_pd['n_pixels'] = planes['n_pixels']
+        output_pd['inlier_fraction'] = planes['inlier_fraction']
+        report_plane_fits(planes, fit_method)
+    output_pd.index = np.arange(len(dips))+1
     return output_pd
 
-def get_terrace_areas(terrace_df, res=5):
+def _get_group_codes(terrace_df, by):
     """
-    This function takes the initial terrace dataframe and calculates the
-    area of each terrace.
+    Number the groups of pixels in the order they first appear in the dataframe
+
+    Returns:
+        the list of columns to group by, and the group code of each pixel
+    """
+    if isinstance(by, str):
+        by = [by]
+
+    if len(by) == 1:
+        codes, _ = pd.factorize(terrace_df[by[0]], sort=False)
+    else:
+        # observed=True so that unused combinations of categorical columns aren't counted
+        codes = terrace_df.groupby(by, sort=False, observed=True).ngroup().values
+    return by, np.asarray(codes, dtype=np.intp)
+
+def group_terraces(terrace_df, by='new_ID', sort_col=None):
+    """
+    This function groups the terrace pixels by terrace ID with a single sort,
+    rather than masking the whole dataframe once for every terrace. Groups are
+    numbered in the order that they first appear in the dataframe.
+
+    Args:
+        terrace_df: pandas dataframe with the terrace info
+        by: the column, or list of columns, to group by. Default = new_ID
+        sort_col: if given, the pixels within each group are also sorted by this column
+
+    Returns:
+        dict with the group keys (dataframe), the group code of each pixel, the
+        order that sorts the pixels by group, and the start and count of each
+        group within that order
+
+    Author: FJC
+    """
+    by, codes = _get_group_codes(terrace_df, by)
+
+    counts = np.bincount(codes)
+    starts = np.cumsum(counts) - counts
+    if sort_col is None:
+        order = np.argsort(codes, kind='stable')
+    else:
+        order = np.lexsort((terrace_df[sort_col].values, codes))
+
+    # the first pixel of each group gives the key of that group
+    keys = terrace_df[by].iloc[order[starts]].reset_index(drop=True)
+
+    return {'keys': keys, 'codes': codes, 'order': order, 'starts': starts, 'counts': counts}
+
+@instrumentation.timed('terrace_summary', rows_from='terrace_df')
+def get_terrace_summary(terrace_df, res=5, by='new_ID', groups=None):
+    """
+    This function gets the summary statistics of each terrace in one pass:
+    mean and standard deviation of the elevation, the distance along the baseline
+    in the middle of the terrace (km), mean relief above the channel, number of
+    pixels and area.
 
     Args:
         terrace_df: pandas dataframe with the terrace info
         res: DEM resolution (default =5m)
+        by: the column, or list of columns, to group by. Default = new_ID
+        groups: the output of group_terraces sorted by DistAlongBaseline_new, if
+        you have already grouped the terraces
 
     Returns:
-        dict where key is the terrace ID and value is the terrace area in m^2
+        dataframe with one row for each terrace
+
+    Author: FJC
+    """
+    if groups is None:
+        groups = group_terraces(terrace_df, by=by, sort_col='DistAlongBaseline_new')
+    codes = groups['codes']
+    counts = groups['counts']
+
+    elevation = terrace_df['Elevation'].values.astype(np.float64)
+    mean_elevation = np.bincount(codes, weights=elevation)/counts
+    std_elevation = np.sqrt(np.bincount(codes, weights=(elevation - mean_elevation[codes])**2)/counts)
+    mean_relief = np.bincount(codes, weights=terrace_df['ChannelRelief'].values.astype(np.float64))/counts
+
+    # get the distance in the middle of the terrace
+    middle = groups['order'][groups['starts'] + counts//2]
+    distance = terrace_df['DistAlongBaseline_new'].values[middle]/1000
+
+    summary_df = groups['keys'].copy()
+    summary_df['mean_elevation'] = mean_elevation
+    summary_df['std_elevation'] = std_elevation
+    summary_df['flow_dist'] = distance
+    summary_df['mean_relief'] = mean_relief
+    summary_df['min_elevation'] = np.minimum.reduceat(elevation[groups['order']], groups['starts'])
+    summary_df['max_elevation'] = np.maximum.reduceat(elevation[groups['order']], groups['starts'])
+    summary_df['n_pixels'] = counts
+    summary_df['area'] = counts * res * res
+
+    return summary_df
+
+@instrumentation.timed('stream_terrace_means')
+def stream_terrace_means(terrace_fname, lp, out_fname=None, chunksize=1000000, res=5, sketch_bin_width=10., spill_fname=None):
+    """
+    This function gets the same summary statistics of each terrace as
+    get_terrace_summary, but reads the terrace csv in chunks so that the whole
+    table never has to be in memory. Each chunk is projected onto the baseline and
+    the count, mean and sum of squared deviations (combined between chunks), min,
+    max and relief of each terrace are accumulated.
+
+    The distance in the middle of each terrace is a median, so it can't be
+    accumulated directly. Instead the distance of each pixel is written to a
+    temporary file along with a sketch of the number of pixels of each terrace in
+    bins along the baseline. The sketch gives the bin that holds the middle pixel
+    of each terrace, and only the pixels in those bins are read back to find it.
+
+    Args:
+        terrace_fname (str): the name of the terrace csv
+        lp: the dataframe with the baseline points
+        out_fname (str): if given, write the summary to this csv
+        chunksize (int): the number of rows to read at once
+        res: DEM resolution (default =5m)
+        sketch_bin_width: the width of the sketch bins along the baseline (m)
+        spill_fname (str): name of the temporary file for the pixel distances. Default
+        is next to the output file, or the terrace csv
+
+    Returns:
+        dataframe with one row for each terrace
+
+    Author: FJC
+    """
+    index = build_baseline_index(lp['X'].values, lp['Y'].values)
+    if spill_fname is None:
+        spill_fname = (out_fname if out_fname else terrace_fname)+'.dist.tmp'
+    spill_dtype = np.dtype([('code', np.int64), ('dist', np.float64)])
+
+    ids = None
+    n = np.zeros(0)
+    mean = np.zeros(0)
+    M2 = np.zeros(0)
+    z_min = np.zeros(0)
+    z_max = np.zeros(0)
+    relief = np.zeros(0)
+    sketch = pd.Series(dtype=np.float64)
+
+    usecols = ['X', 'Y', 'Elevation', 'new_ID', 'ChannelRelief']
+    with open(spill_fname, 'wb') as spill:
+        for chunk in pd.read_csv(terrace_fname, usecols=usecols, chunksize=chunksize):
+            # get the code of each terrace ID, adding any new IDs to the end
+            if ids is None:
+                ids = pd.Index(pd.unique(chunk['new_ID'].values[:1]))
+            codes = ids.get_indexer(chunk['new_ID'].values)
+            new_ids = pd.unique(chunk['new_ID'].values[codes < 0])
+            if new_ids.size or n.size < ids.size:
+                ids = ids.append(pd.Index(new_ids))
+                codes = ids.get_indexer(chunk['new_ID'].values)
+                n_new = ids.size - n.size
+                n = np.concatenate((n, np.zeros(n_new)))
+                mean = np.concatenate((mean, np.zeros(n_new)))
+                M2 = np.concatenate((M2, np.zeros(n_new)))
+                z_min = np.concatenate((z_min, np.full(n_new, np.inf)))
+                z_max = np.concatenate((z_max, np.full(n_new, -np.inf)))
+                relief = np.concatenate((relief, np.zeros(n_new)))
+
+            # project this chunk onto the baseline
+            dist, _, _ = project_points_to_baseline(chunk['X'].values, chunk['Y'].values, index)
+            z = chunk['Elevation'].values.astype(np.float64)
+
+            # combine the mean and sum of squared deviations of this chunk with the totals
+            n_chunk = np.bincount(codes, minlength=ids.size).astype(np.float64)
+            has_pixels = n_chunk > 0
+            mean_chunk = np.bincount(codes, weights=z, minlength=ids.size)/np.where(has_pixels, n_chunk, 1)
+            M2_chunk = np.bincount(codes, weights=(z - mean_chunk[codes])**2, minlength=ids.size)
+            n_total = n + n_chunk
+            delta = mean_chunk - mean
+            ratio = np.divide(n_chunk, n_total, out=np.zeros_like(n_total), where=n_total > 0)
+            mean = mean + delta*ratio
+            M2 = M2 + M2_chunk + delta**2 * n * ratio
+            n = n_total
+            z_grouped = pd.Series(z).groupby(codes)
+            chunk_min = z_grouped.min()
+            chunk_max = z_grouped.max()
+            z_min[chunk_min.index] = np.minimum(z_min[chunk_min.index], chunk_min.values)
+            z_max[chunk_max.index] = np.maximum(z_max[chunk_max.index], chunk_max.values)
+            relief += np.bincount(codes, weights=chunk['ChannelRelief'].values.astype(np.float64), minlength=ids.size)
+
+            # add to the sketch and spill the distances
+            keys = (codes.astype(np.int64) << 32) + np.floor(dist/sketch_bin_width).astype(np.int64)
+            unique_keys, key_counts = np.unique(keys, return_counts=True)
+            sketch = sketch.add(pd.Series(key_counts, index=unique_keys), fill_value=0)
+            spilled = np.empty(len(chunk), dtype=spill_dtype)
+            spilled['code'] = codes
+            spilled['dist'] = dist
+            spilled.tofile(spill)
+
+    # find the sketch bin holding the middle pixel of each terrace
+    sketch = sketch.sort_index()
+    sketch_codes = sketch.index.values >> 32
+    sketch_bins = sketch.index.values & 0xFFFFFFFF
+    sketch_counts = sketch.values.astype(np.int64)
+    middle_rank = n.astype(np.int64)//2
+    cum_counts = np.cumsum(sketch_counts)
+    count_before_code = (cum_counts - sketch_counts)[np.searchsorted(sketch_codes, np.arange(ids.size))]
+    count_before_bin = cum_counts - sketch_counts - count_before_code[sketch_codes]
+    in_bin = (count_before_bin <= middle_rank[sketch_codes]) & (middle_rank[sketch_codes] < count_before_bin + sketch_counts)
+    target_bin = np.empty(ids.size, dtype=np.int64)
+    target_bin[sketch_codes[in_bin]] = sketch_bins[in_bin]
+    rank_in_bin = np.empty(ids.size, dtype=np.int64)
+    rank_in_bin[sketch_codes[in_bin]] = middle_rank[sketch_codes[in_bin]] - count_before_bin[in_bin]
+
+    # read back the pixels in those bins, and get the middle one of each terrace
+    spilled = np.memmap(spill_fname, dtype=spill_dtype, mode='r')
+    candidate_codes = []
+    candidate_dists = []
+    for start in range(0, spilled.size, chunksize):
+        block = np.array(spilled[start:start+chunksize])
+        keep = np.floor(block['dist']/sketch_bin_width).astype(np.int64) == target_bin[block['code']]
+        candidate_codes.append(block['code'][keep])
+        candidate_dists.append(block['dist'][keep])
+    del spilled
+    os.remove(spill_fname)
+    candidate_codes = np.concatenate(candidate_codes)
+    candidate_dists = np.concatenate(candidate_dists)
+    order = np.lexsort((candidate_dists, candidate_codes))
+    candidate_starts = np.searchsorted(candidate_codes[order], np.arange(ids.size))
+    distance = candidate_dists[order[candidate_starts + rank_in_bin]]/1000
+
+    summary_df = pd.DataFrame({'new_ID': ids.values})
+    summary_df['mean_elevation'] = mean
+    summary_df['std_elevation'] = np.sqrt(M2/n)
+    summary_df['flow_dist'] = distance
+    summary_df['mean_relief'] = relief/n
+    summary_df['min_elevation'] = z_min
+    summary_df['max_elevation'] = z_max
+    summary_df['n_pixels'] = n.astype(np.int64)
+    summary_df['area'] = summary_df['n_pixels'] * res * res
+
+    if out_fname:
+        summary_df.to_csv(out_fname, index=False)
+
+    return summary_df
+
+@instrumentation.timed('fit_terrace_planes', rows_from='terrace_df')
+def fit_terrace_planes(terrace_df, by='new_ID', groups=None, method='lstsq', threshold=None, n_workers=1, seed=0):
+    """
+    This function fits a plane to the pixels of every terrace at once, of the
+    form Z = C[0]*X + C[1]*Y + C[2]. The least squares normal equations for all
+    the terraces are built with bincount over the pixel coordinates, which are
+    centred on the mean of each terrace so that the fit isn't affected by the
+    size of the UTM coordinates, and then all the 3x3 systems are solved together.
+
+    Misclassified riser or hillslope pixels can pull a least squares plane a long
+    way, so there are two robust methods, which are also fitted to all the
+    terraces at once:
+        huber = iteratively reweighted least squares with Huber weights, using the
+        median absolute residual of each terrace as its scale. This is quicker, but
+        is still pulled a little by lots of outliers on one side of the surface.
+        ransac = planes through random triples of pixels of each terrace, scored
+        together by their number of inliers, and the best one refitted to its inliers
+        until they stop changing. This copes with more outliers.
+
+    Args:
+        terrace_df: pandas dataframe with the terrace info
+        by: the column, or list of columns, to group by. Default = new_ID
+        groups: the output of group_terraces, if you have already grouped the terraces
+        method (str): 'lstsq', 'huber' or 'ransac'. Default = lstsq
+        threshold: the largest residual (m) of an inlier for the robust methods.
+        Default = 3 times the robust scale of the residuals of each terrace
+        n_workers (int): the number of processes for the robust methods. The terraces
+        are split between them. Default = 1
+        seed: the seed for the random triples of the ransac method
+
+    Returns:
+        dict with the group keys, the plane coefficients C (n_terraces x 3), and
+        the mean X, Y and elevation and number of pixels of each terrace. The robust
+        methods also give the inlier fraction and the robust scale of the residuals
+        of each terrace.
+
+    Author: FJC
+    """
+    if method not in ['lstsq', 'huber', 'ransac']:
+        raise ValueError("The plane fitting method must be 'lstsq', 'huber' or 'ransac', not "+str(method))
+    if groups is None:
+        groups = group_terraces(terrace_df, by=by)
+    codes = groups['codes']
+    counts = groups['counts']
+
+    X = terrace_df['X'].values.astype(np.float64)
+    Y = terrace_df['Y'].values.astype(np.float64)
+    Z = terrace_df['Elevation'].values.astype(np.float64)
+
+    # centre the coordinates on each terrace
+    X_mean = np.bincount(codes, weights=X)/counts
+    Y_mean = np.bincount(codes, weights=Y)/counts
+    Z_mean = np.bincount(codes, weights=Z)/counts
+    dX = X - X_mean[codes]
+    dY = Y - Y_mean[codes]
+    dZ = Z - Z_mean[codes]
+
+    planes = {'keys': groups['keys'], 'X_mean': X_mean, 'Y_mean': Y_mean, 'Z_mean': Z_mean, 'n_pixels': counts}
+    if method == 'lstsq':
+        C = _solve_planes(dX, dY, dZ, codes, counts.size)
+    else:
+        C, planes['scale'], planes['inlier_fraction'] = _fit_planes_robust_parallel(dX, dY, dZ, groups, method, threshold, n_workers, seed)
+
+    # move the intercept back to the original coordinates
+    C[:,2] += Z_mean - C[:,0]*X_mean - C[:,1]*Y_mean
+    planes['C'] = C
+    return planes
+
+def _solve_planes(dX, dY, dZ, codes, n_groups, weights=None):
+    """
+    Solve the (weighted) least squares normal equations A C = b for the plane of
+    every group at once, in the centred coordinates
+    """
+    if weights is None:
+        weights = np.ones(len(dX))
+
+    def _sum(values):
+        return np.bincount(codes, weights=values, minlength=n_groups)
+
+    wX = weights*dX
+    wY = weights*dY
+    Sx = _sum(wX)
+    Sy = _sum(wY)
+    Sxy = _sum(wX*dY)
+    A = np.empty((n_groups, 3, 3))
+    A[:,0,0] = _sum(wX*dX)
+    A[:,0,1] = A[:,1,0] = Sxy
+    A[:,0,2] = A[:,2,0] = Sx
+    A[:,1,1] = _sum(wY*dY)
+    A[:,1,2] = A[:,2,1] = Sy
+    A[:,2,2] = _sum(weights)
+    b = np.stack((_sum(wX*dZ), _sum(wY*dZ), _sum(weights*dZ)), axis=1)
+
+    # the pseudo-inverse gives the least squares solution for all the terraces,
+    # including ones where the pixels are all in a line
+    return np.einsum('nij,nj->ni', np.linalg.pinv(A), b)
+
+def _get_group_median(values, codes, n_groups):
+    """
+    Get the median of the values in each group, for values >= 0. The values are
+    scaled to [0, 1) and added to the group codes, so one sort of a float array
+    puts them in order within each group (this is much faster than a lexsort).
+    """
+    counts = np.bincount(codes, minlength=n_groups)
+    median = np.zeros(n_groups)
+    if len(values) == 0:
+        return median
+    top = 2*values.max() + 1e-12
+    sorted_values = (np.sort(codes + values/top) - np.repeat(np.arange(n_groups), counts))*top
+    starts = np.cumsum(counts) - counts
+    lower = starts + np.maximum(counts - 1, 0)//2
+    upper = starts + counts//2
+    has_pixels = counts > 0
+    median[has_pixels] = 0.5*(sorted_values[lower[has_pixels]] + sorted_values[upper[has_pixels]])
+    return median
+
+# the robust scale of the residuals is 1.4826 x the median absolute residual, which is the
+# standard deviation for normally distributed residuals. It can't be less than MIN_SCALE (m),
+# so that perfectly flat terraces don't give zero thresholds.
+MAD_SCALE = 1.4826
+MIN_SCALE = 1e-3
+# the Huber tuning constant, and the default inlier threshold in robust scales
+HUBER_K = 1.345
+INLIER_SCALES = 3.
+# the number of random planes tried for each terrace by ransac, and the most pixels of each
+# terrace that they are scored on (the best plane is then refitted to all the pixels)
+RANSAC_HYPOTHESES = 64
+RANSAC_SCORE_PIXELS = 1000
+
+def _fit_planes_robust(dX, dY, dZ, codes, n_groups, method='huber', threshold=None, samples=None, n_iter=20, tol=1e-3):
+    """
+    Fit robust planes to every group at once in the centred coordinates, with
+    either IRLS with Huber weights or ransac. samples are the uniform random
+    numbers (n_groups x n_hypotheses x 3) that pick the triples for ransac. The
+    IRLS stops when the planes move by less than tol (m).
+
+    Returns:
+        the plane coefficients, the robust scale of the residuals and the inlier fraction of each group
+    """
+    def _residuals(C):
+        return dZ - (C[codes,0]*dX + C[codes,1]*dY + C[codes,2])
+
+    def _scale(residuals):
+        return np.maximum(MAD_SCALE*_get_group_median(np.abs(residuals), codes, n_groups), MIN_SCALE)
+
+    # start from the least squares planes
+    C = _solve_planes(dX, dY, dZ, codes, n_groups)
+    residuals = _residuals(C)
+    scale = _scale(residuals)
+
+    if method == 'huber':
+        # each plane stops changing once it has converged, so the result for a terrace doesn't
+        # depend on the other terraces that it is fitted with
+        converged = np.zeros(n_groups, dtype=bool)
+        for i in range(n_iter):
+            # full weight for small residuals, and weights falling off as 1/residual for large ones
+            abs_residuals = np.abs(residuals)
+            cutoff = HUBER_K*scale[codes]
+            weights = np.where(abs_residuals <= cutoff, 1., cutoff/np.maximum(abs_residuals, 1e-12))
+            new_C = _solve_planes(dX, dY, dZ, codes, n_groups, weights)
+            new_C[converged] = C[converged]
+            converged |= np.abs(new_C - C).max(axis=1) < tol
+            C = new_C
+            residuals = _residuals(C)
+            scale = _scale(residuals)
+            if converged.all():
+                break
+
+    elif method == 'ransac':
+        counts = np.bincount(codes, minlength=n_groups)
+        order = np.argsort(codes, kind='stable')
+        starts = np.cumsum(counts) - counts
+        this_threshold = threshold*np.ones(n_groups) if threshold is not None else INLIER_SCALES*scale
+
+        # the planes through random triples of pixels from each group
+        n_hypotheses = samples.shape[1]
+        picks = order[starts[:,None,None] + (samples*counts[:,None,None]).astype(np.intp)]
+        p0 = np.stack((dX[picks[:,:,0]], dY[picks[:,:,0]], dZ[picks[:,:,0]]), axis=-1)
+        u = np.stack((dX[picks[:,:,1]], dY[picks[:,:,1]], dZ[picks[:,:,1]]), axis=-1) - p0
+        v = np.stack((dX[picks[:,:,2]], dY[picks[:,:,2]], dZ[picks[:,:,2]]), axis=-1) - p0
+        normal = np.cross(u, v)
+        # triples in a line (or steeper than 45 degrees, which can't be terraces) aren't used
+        valid = np.abs(normal[:,:,2]) > np.hypot(normal[:,:,0], normal[:,:,1])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            hypotheses = np.stack((-normal[:,:,0]/normal[:,:,2], -normal[:,:,1]/normal[:,:,2]), axis=-1)
+        hypotheses = np.where(valid[:,:,None], hypotheses, 0.)
+        intercepts = p0[:,:,2] - hypotheses[:,:,0]*p0[:,:,0] - hypotheses[:,:,1]*p0[:,:,1]
+
+        # score all the hypotheses on up to RANSAC_SCORE_PIXELS pixels spread through each group, in
+        # chunks of pixels so that only the residuals of one chunk are in memory at once
+        n_scored = np.minimum(counts, RANSAC_SCORE_PIXELS)
+        score_codes = np.repeat(np.arange(n_groups), n_scored)
+        rank = np.arange(n_scored.sum()) - np.repeat(np.cumsum(n_scored) - n_scored, n_scored)
+        scored = order[starts[score_codes] + rank*counts[score_codes]//n_scored[score_codes]]
+        scores = np.zeros(n_groups*n_hypotheses)
+        chunk_size = max(1, 2**22//n_hypotheses)
+        hypothesis_index = np.arange(n_hypotheses)
+        for start in range(0, len(scored), chunk_size):
+            pixels = scored[start:start+chunk_size]
+            c = score_codes[start:start+chunk_size]
+            chunk_residuals = np.abs(dZ[pixels,None] - (hypotheses[c,:,0]*dX[pixels,None] + hypotheses[c,:,1]*dY[pixels,None] + intercepts[c]))
+            inliers = chunk_residuals <= this_threshold[c,None]
+            scores += np.bincount((c[:,None]*n_hypotheses + hypothesis_index).ravel(), weights=inliers.ravel(), minlength=scores.size)
+        scores = np.where(valid.ravel(), scores, -1).reshape(n_groups, n_hypotheses)
+        best = np.argmax(scores, axis=1)
+        has_plane = scores[np.arange(n_groups), best] >= 3
+        best_C = np.column_stack((hypotheses[np.arange(n_groups), best], intercepts[np.arange(n_groups), best]))
+        C = np.where(has_plane[:,None], best_C, C)
+
+        # refit each plane to its inliers until the inliers stop changing. The least squares scale
+        # is inflated by the outliers, so the threshold is set again from the residuals of each new
+        # plane, most of which are inliers.
+        inliers = None
+        converged = np.zeros(n_groups, dtype=bool)
+        for i in range(n_iter):
+            residuals = _residuals(C)
+            if threshold is None:
+                this_threshold = INLIER_SCALES*_scale(residuals)
+            new_inliers = np.abs(residuals) <= this_threshold[codes]
+            if inliers is not None:
+                converged |= np.bincount(codes, weights=new_inliers != inliers, minlength=n_groups) == 0
+                if converged.all():
+                    break
+            inliers = new_inliers
+            n_inliers = np.bincount(codes, weights=inliers, minlength=n_groups)
+            new_C = _solve_planes(dX, dY, dZ, codes, n_groups, inliers.astype(np.float64))
+            # keep the plane if it has converged or there aren't enough inliers to refit it
+            C = np.where(((n_inliers >= 3) & ~converged)[:,None], new_C, C)
+        residuals = _residuals(C)
+        scale = _scale(residuals)
+
+    else:
+        raise ValueError("Unknown robust plane fitting method: "+str(method))
+
+    if threshold is None:
+        threshold = INLIER_SCALES*scale
+    inlier_fraction = np.bincount(codes, weights=np.abs(residuals) <= (threshold*np.ones(n_groups))[codes], minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        inlier_fraction = inlier_fraction/np.bincount(codes, minlength=n_groups)
+    return C, scale, inlier_fraction
+
+def _fit_planes_robust_job(job):
+    """
+    Fit the robust planes for one chunk of terraces in a worker process
+    """
+    dX, dY, dZ, codes, n_groups, method, threshold, samples = job
+    return _fit_planes_robust(dX, dY, dZ, codes, n_groups, method, threshold, samples)
+
+def _fit_planes_robust_parallel(dX, dY, dZ, groups, method, threshold=None, n_workers=1, seed=0):
+    """
+    Fit the robust planes, splitting the terraces between n_workers processes
+    with about the same number of pixels in each. Each worker fits all of its
+    terraces at once. The random triples for ransac are drawn here, so the result
+    doesn't depend on the number of workers.
+    """
+    n_groups = groups['counts'].size
+    samples = None
+    if method == 'ransac':
+        samples = np.random.RandomState(seed).uniform(size=(n_groups, RANSAC_HYPOTHESES, 3))
+    if n_workers <= 1 or n_groups < 2:
+        return _fit_planes_robust(dX, dY, dZ, groups['codes'], n_groups, method, threshold, samples)
+
+    # split the terraces into chunks of whole terraces with about the same number of pixels
+    cum_pixels = np.cumsum(groups['counts'])
+    edges = np.searchsorted(cum_pixels, np.linspace(0, cum_pixels[-1], n_workers+1)[1:-1], side='right')
+    edges = np.unique(np.concatenate(([0], edges, [n_groups])))
+    jobs = []
+    for first, last in zip(edges[:-1], edges[1:]):
+        pixels = groups['order'][groups['starts'][first]:groups['starts'][last-1]+groups['counts'][last-1]]
+        jobs.append((dX[pixels], dY[pixels], dZ[pixels], groups['codes'][pixels] - first, last - first, method, threshold,
+                     samples[first:last] if samples is not None else None))
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=min(n_workers, len(jobs))) as pool:
+        results = list(pool.map(_fit_planes_robust_job, jobs))
+    return tuple(np.concatenate([result[i] for result in results]) for i in range(3))
+
+def report_plane_fits(planes, method, min_inlier_fraction=0.8):
+    """
+    Print the inlier fractions of robust plane fits, with the terraces that have
+    the fewest inliers, which are the ones that are most likely to have
+    misclassified pixels.
+
+    Args:
+        planes: the output of fit_terrace_planes with a robust method
+        method (str): the method of the fit
+        min_inlier_fraction: list the terraces with less than this fraction of inliers
+
+    Author: FJC
+    """
+    fractions = planes['inlier_fraction']
+    if len(fractions) == 0:
+        return
+    low = np.flatnonzero(fractions < min_inlier_fraction)
+    print("Robust plane fits (%s): median inlier fraction %.2f, %d of %d terraces with less than %d%% inliers"
+          %(method, np.nanmedian(fractions), len(low), len(fractions), 100*min_inlier_fraction))
+    keys = planes['keys']
+    for i in low[np.argsort(fractions[low])][:10]:
+        print("    %s: %.2f of %d pixels" %(', '.join(str(v) for v in keys.iloc[i].values), fractions[i], planes['n_pixels'][i]))
+
+def get_dip_and_strike(C):
+    """
+    This function gets the dip, dip direction and strike of planes of the form
+    Z = C[0]*X + C[1]*Y + C[2] using the normal vector to each plane.
+
+    Args:
+        C: array of plane coefficients (n_planes x 3)
+
+    Returns:
+        arrays of dip, dip direction and strike in degrees
+
+    Author: AW and FJC
+    """
+    C = np.atleast_2d(C)
+    # the normal vector to the plane is (a, b, 1), and (a, b, 0) projected onto the xy plane
+    a = -C[:,0]
+    b = -C[:,1]
+    n_xy = np.hypot(a, b)
+    n_vec = np.sqrt(a*a + b*b + 1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # now get the dip = angle between n_vec and n_xy
+        dip = 90 - np.degrees(np.arccos(n_xy/n_vec))
+        # get the dip direction = angle between n_xy and the due north vector y = (0,1,0)
+        theta = np.degrees(np.arccos(b/n_xy))
+
+    # work out strike depending on orientation
+    strike = np.select([a < 0, b > 0], [270 - theta, 270 + theta], theta - 90)
+
+    # now get the dip dir using the right hand rule
+    dip_dir = strike + 90
+    dip_dir = np.where(dip_dir > 359, dip_dir - 360, dip_dir)
+
+    return dip, dip_dir, strike
+
+@instrumentation.timed('bin_profiles', rows_from='terrace_df')
+def get_binned_profiles(terrace_df, bin_width=100., percentiles=(25, 75), by='new_ID'):
+    """
+    This function gets the median and percentiles of the elevation of each terrace
+    in fixed width bins along the baseline, for all the terraces at once. The
+    pixels are sorted once by terrace, bin and elevation, and the medians and
+    percentiles are then read off each run of pixels in the same terrace and bin.
+
+    Args:
+        terrace_df: pandas dataframe with the terrace info
+        bin_width: the width of the bins along the baseline (m). Default = 100 m
+        percentiles: the percentiles of elevation to get in each bin. Default = 25th and 75th
+        by: the column, or list of columns, to group by. Default = new_ID
+
+    Returns:
+        dataframe with one row for each bin of each terrace, with the bin number,
+        the distance along the baseline of the bin centre (m), the number of pixels,
+        the median elevation and the percentiles (columns p25_elevation etc.)
 
     Author: FJC
     """
-    # get unique IDs
-    terraceIDs = terrace_df.new_ID.unique()
+    by, codes = _get_group_codes(terrace_df, by)
+    bins = np.floor(terrace_df['DistAlongBaseline_new'].values/bin_width).astype(np.int64)
+    elevation = terrace_df['Elevation'].values.astype(np.float64)
+
+    order = np.lexsort((elevation, bins, codes))
+    sorted_codes = codes[order]
+    sorted_bins = bins[order]
+    sorted_elevation = elevation[order]
+
+    # find the start of each run of pixels in the same terrace and bin
+    new_run = np.ones(order.size, dtype=bool)
+    new_run[1:] = (sorted_codes[1:] != sorted_codes[:-1]) | (sorted_bins[1:] != sorted_bins[:-1])
+    starts = np.flatnonzero(new_run)
+    counts = np.diff(np.append(starts, order.size))
+
+    def _percentile(q):
+        # linear interpolation between the sorted elevations, the same as np.percentile
+        position = (counts - 1)*q/100.
+        lower = np.floor(position).astype(np.int64)
+        upper = np.ceil(position).astype(np.int64)
+        fraction = position - lower
+        return sorted_elevation[starts+lower]*(1-fraction) + sorted_elevation[starts+upper]*fraction
+
+    profile_df = terrace_df[by].iloc[order[starts]].reset_index(drop=True)
+    profile_df['bin'] = sorted_bins[starts]
+    profile_df['bin_centre'] = (sorted_bins[starts] + 0.5)*bin_width
+    profile_df['n_pixels'] = counts
+    profile_df['median_elevation'] = _percentile(50)
+    for q in percentiles:
+        profile_df['p%g_elevation' %q] = _percentile(q)
+
+    # put the terraces back in the order they first appear
+    profile_df['_code'] = sorted_codes[starts]
+    profile_df = profile_df.sort_values(['_code', 'bin'], kind='mergesort').drop(columns='_code').reset_index(drop=True)
+
+    return profile_df
 
-    area_dict = {}
+def get_terrace_areas(terrace_df, res=5):
+    """
+    This function takes the initial terrace dataframe and calculates the
+    area of each terrace.
 
-    for terraceID in terraceIDs:
-        # get the n rows with this ID
-        masked_df = terrace_df[terrace_df['new_ID'] == terraceID]
-        n_pixels = len(masked_df.index)
+    Args:
+        terrace_df: pandas dataframe with the terrace info
+        res: DEM resolution (default =5m)
 
-        # get the data resolution of the DEM
-        #Cell_area = IO.GetPixelArea(fname_prefix)
-        terrace_area = n_pixels * res * res
+    Returns:
+        dict where key is the terrace ID and value is the terrace area in m^2
 
-        area_dict[terraceID] = terrace_area
+    Author: FJC
+    """
+    n_pixels = terrace_df['new_ID'].value_counts(sort=False)
 
-    return area_dict
+    return dict(zip(n_pixels.index, n_pixels.values * res * res))
 
 def dist_along_line(X, Y, line):
     """
     find the distance of the point X,Y along the line shapefile
     FJC
     """
+    from shapely.geometry import Point
+
     dist = line.project(Point(X,Y))
     return dist
 
-def get_distance_along_baseline_points(terraces, lp):
+#---------------------------------------------------------------------------------------------#
+# BASELINE PROJECTION
+# Vectorised projection of terrace pixels onto the baseline
+#---------------------------------------------------------------------------------------------#
+
+@instrumentation.timed('build_baseline_index', rows_from='baseline_x')
+def build_baseline_index(baseline_x, baseline_y):
+    """
+    This function builds the index used to project points onto the baseline.
+    The baseline vertices are read once and stored as arrays along with the
+    cumulative distance of each vertex along the line, the length of each
+    segment and a KD-tree of the vertices which is used to find the segments
+    that are near to each point.
+
+    Args:
+        baseline_x: array of X coordinates of the baseline vertices
+        baseline_y: array of Y coordinates of the baseline vertices
+
+    Returns:
+        dict with the baseline index arrays
+
+    Author: FJC
+    """
+    from scipy.spatial import cKDTree
+
+    x = np.asarray(baseline_x, dtype=np.float64)
+    y = np.asarray(baseline_y, dtype=np.float64)
+    if x.size < 2:
+        raise ValueError("The baseline must have at least two vertices")
+
+    seg_length = np.hypot(np.diff(x), np.diff(y))
+    cum_dist = np.concatenate(([0.], np.cumsum(seg_length)))
+
+    # segments that are much longer than usual (e.g. gaps between reaches) are
+    # always tested, so that the search radius around each point stays small
+    long_segs = seg_length > 4*np.median(seg_length)
+    if long_segs.all():
+        long_segs[:] = False
+    max_seg_length = seg_length[~long_segs].max()
+
+    return {'x': x, 'y': y, 'cum_dist': cum_dist, 'seg_length': seg_length,
+            'long_segments': np.flatnonzero(long_segs),
+            'max_seg_length': max_seg_length, 'tree': cKDTree(np.column_stack((x, y)))}
+
+# the arrays of the baseline index that are saved to disk
+BASELINE_INDEX_ARRAYS = ['x', 'y', 'cum_dist', 'seg_length', 'long_segments']
+
+def save_baseline_index(index, index_dir):
+    """
+    Save the baseline index to a directory, with one .npy file for each array,
+    so that it can be memory-mapped and reused by later runs. The KD-tree isn't
+    saved as it is quick to rebuild from the vertices.
+
+    Args:
+        index: the baseline index from build_baseline_index
+        index_dir (str): the directory to save the index to
+
+    Author: FJC
+    """
+    import json
+
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    for name in BASELINE_INDEX_ARRAYS:
+        np.save(os.path.join(index_dir, name+'.npy'), np.ascontiguousarray(index[name]))
+    # the info file is written last, so the index is only read once it is complete
+    with open(os.path.join(index_dir, 'index_info.json'), 'w') as f:
+        json.dump({'n_vertices': int(index['x'].size), 'max_seg_length': float(index['max_seg_length'])}, f)
+
+def load_baseline_index(index_dir):
+    """
+    Load a baseline index saved with save_baseline_index. The arrays are
+    memory-mapped rather than read into memory.
+
+    Args:
+        index_dir (str): the directory with the index
+
+    Returns:
+        dict with the baseline index arrays
+
+    Author: FJC
+    """
+    import json
+    from scipy.spatial import cKDTree
+
+    with open(os.path.join(index_dir, 'index_info.json'), 'r') as f:
+        info = json.load(f)
+    index = {name: np.load(os.path.join(index_dir, name+'.npy'), mmap_mode='r') for name in BASELINE_INDEX_ARRAYS}
+    index['max_seg_length'] = info['max_seg_length']
+    index['tree'] = cKDTree(np.column_stack((index['x'], index['y'])))
+    return index
+
+def get_baseline_index(baseline_x, baseline_y, index_dir=None):
+    """
+    Get the baseline index, reusing the one saved in index_dir if it was made
+    from the same vertices. Otherwise the index is built, and saved to index_dir
+    if it is given.
+
+    Args:
+        baseline_x: array of X coordinates of the baseline vertices
+        baseline_y: array of Y coordinates of the baseline vertices
+        index_dir (str): the directory of the saved index. Default = don't save it
+
+    Returns:
+        dict with the baseline index arrays
+
+    Author: FJC
+    """
+    if index_dir is None:
+        return build_baseline_index(baseline_x, baseline_y)
+
+    if os.path.isfile(os.path.join(index_dir, 'index_info.json')):
+        index = load_baseline_index(index_dir)
+        if np.array_equal(index['x'], np.asarray(baseline_x, dtype=np.float64)) and np.array_equal(index['y'], np.asarray(baseline_y, dtype=np.float64)):
+            return index
+        os.remove(os.path.join(index_dir, 'index_info.json'))
+
+    index = build_baseline_index(baseline_x, baseline_y)
+    save_baseline_index(index, index_dir)
+    return index
+
+def _candidate_segments(px, py, index):
+    """
+    Find the baseline segments which might contain the nearest point on the
+    baseline to each of the points. The nearest point lies at most
+    (distance to nearest vertex) away, and any point on a segment is within half a
+    segment length of one of its vertices, so only segments with a vertex within
+    that radius need to be tested.
+
+    Returns:
+        arrays of point index and segment index for each candidate pair
+
+    Author: FJC
+    """
+    tree = index['tree']
+    n_segs = index['seg_length'].size
+    xy = np.column_stack((px, py))
+
+    nearest_dist, _ = tree.query(xy)
+    radius = nearest_dist + 0.5*index['max_seg_length'] + 1e-9
+    vertex_lists = tree.query_ball_point(xy, radius, return_sorted=False)
+    n_vertices = np.fromiter(map(len, vertex_lists), dtype=np.intp, count=len(vertex_lists))
+    vertices = np.fromiter(itertools.chain.from_iterable(vertex_lists), dtype=np.intp, count=n_vertices.sum())
+    pts = np.repeat(np.arange(len(px)), n_vertices)
+
+    # each vertex is the end of the segment before it and the start of the segment after it
+    pt_idx = np.repeat(pts, 2)
+    seg_idx = np.column_stack((vertices-1, vertices)).ravel()
+    valid = (seg_idx >= 0) & (seg_idx < n_segs)
+    pt_idx = pt_idx[valid]
+    seg_idx = seg_idx[valid]
+
+    # always test the long segments
+    long_segs = index['long_segments']
+    if long_segs.size:
+        pt_idx = np.concatenate((pt_idx, np.repeat(np.arange(len(px)), long_segs.size)))
+        seg_idx = np.concatenate((seg_idx, np.tile(long_segs, len(px))))
+        order = np.argsort(pt_idx, kind='stable')
+        pt_idx = pt_idx[order]
+        seg_idx = seg_idx[order]
+
+    return pt_idx, seg_idx
+
+def _project_onto_segments(px, py, seg_idx, index):
+    """
+    Project points onto baseline segments
+
+    Returns:
+        the fraction of the way along each segment of the nearest point, the squared
+        distance to it, and the cross product of the segment and the point (for the side)
+    """
+    bx = index['x']
+    by = index['y']
+    ax = bx[seg_idx]
+    ay = by[seg_idx]
+    dx = bx[seg_idx+1] - ax
+    dy = by[seg_idx+1] - ay
+    wx = px - ax
+    wy = py - ay
+    length_sq = dx*dx + dy*dy
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = np.where(length_sq > 0, (wx*dx + wy*dy)/length_sq, 0.)
+    frac = np.clip(frac, 0., 1.)
+    dist_sq = (wx - frac*dx)**2 + (wy - frac*dy)**2
+    return frac, dist_sq, dx*wy - dy*wx
+
+@instrumentation.timed('project_points', rows_from='X')
+def project_points_to_baseline(X, Y, index, chunk_size=200000):
+    """
+    Project points onto the baseline. For each point this finds the nearest point
+    on the baseline, and returns the distance of that point along the baseline,
+    the perpendicular distance from the point to the baseline, and which side of
+    the baseline the point is on. The chainage is the same as shapely's
+    LineString.project: where two segments are equally close the first one is used.
+
+    Points are processed in chunks to keep the memory use bounded.
+
+    Args:
+        X: array of X coordinates of the points
+        Y: array of Y coordinates of the points
+        index: the baseline index from build_baseline_index
+        chunk_size (int): the number of points to project at once
+
+    Returns:
+        arrays of distance along the baseline, distance to the baseline, and side
+        of the baseline (1 = left, -1 = right, 0 = on the baseline, looking along
+        the direction of increasing distance)
+
+    Author: FJC
+    """
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    n_points = X.size
+    n_segs = index['seg_length'].size
+
+    chainage = np.empty(n_points)
+    offset = np.empty(n_points)
+    side = np.zeros(n_points, dtype=np.int8)
+
+    for start in range(0, n_points, chunk_size):
+        end = min(start+chunk_size, n_points)
+        px = X[start:end]
+        py = Y[start:end]
+
+        # project onto each of the candidate segments. The candidates are sorted by point.
+        pt_idx, seg_idx = _candidate_segments(px, py, index)
+        _, dist_sq, _ = _project_onto_segments(px[pt_idx], py[pt_idx], seg_idx, index)
+
+        # keep the nearest segment for each point, taking the first segment if tied
+        starts = np.searchsorted(pt_idx, np.arange(end-start))
+        min_dist_sq = np.minimum.reduceat(dist_sq, starts)
+        best_seg = np.minimum.reduceat(np.where(dist_sq <= min_dist_sq[pt_idx], seg_idx, n_segs), starts)
+
+        frac, dist_sq, cross = _project_onto_segments(px, py, best_seg, index)
+        chainage[start:end] = index['cum_dist'][best_seg] + frac*index['seg_length'][best_seg]
+        offset[start:end] = np.sqrt(dist_sq)
+        side[start:end] = np.sign(cross)
+
+    return chainage, offset, side
+
+@instrumentation.timed('distance_along_baseline', rows_from='terraces')
+def get_distance_along_baseline_points(terraces, lp, index_dir=None):
     """
     This function gets the distance along the baseline for each of the terrace
     points. This gives continuous distances along the baseline, compared to the
@@ -261,18 +1058,19 @@ def get_distance_along_baseline_points(terraces, lp):
     Args:
         terraces: the dataframe with the terrace info
         lp: the csv file of the points along the baseline
+        index_dir (str): the directory of a saved baseline index to reuse (see get_baseline_index)
 
     Returns:
-        terrace dataframe with additional column - 'DistAlongBaseline_new'.
+        terrace dataframe with additional columns - 'DistAlongBaseline_new',
+        'DistToBaseline_new' and 'BaselineSide'.
 
     FJC
     """
-    baseline_x = lp['X']
-    baseline_y = lp['Y']
-    points_list = zip(baseline_x, baseline_y)
-
-    line = LineString(points_list)
-    terraces['DistAlongBaseline_new'] = terraces.apply(lambda x: dist_along_line(x['X'], x['Y'], line), axis=1)
+    index = get_baseline_index(lp['X'].values, lp['Y'].values, index_dir)
+    chainage, offset, side = project_points_to_baseline(terraces['X'].values, terraces['Y'].values, index)
+    terraces['DistAlongBaseline_new'] = chainage
+    terraces['DistToBaseline_new'] = offset
+    terraces['BaselineSide'] = side
 
     return terraces
 
@@ -288,76 +1086,169 @@ def get_distance_along_baseline(terraces, lp):
         lp: the name shapefile of the baseline (a line shapefile)
 
     Returns:
-        terrace dataframe with additional column - 'DistAlongBaseline_new'.
+        terrace dataframe with additional columns - 'DistAlongBaseline_new',
+        'DistToBaseline_new' and 'BaselineSide'.
 
     FJC
     """
+    import fiona
+    from shapely.geometry import shape, LineString
+
     # get the shapefile as a shapely line
      # read in the baseline shapefile
     c = fiona.collection(lp, 'r')
-    rec = c.next()
+    rec = next(iter(c))
     line = LineString(shape(rec['geometry']))
-    terraces['DistAlongBaseline_new'] = terraces.apply(lambda x: dist_along_line(x['X'], x['Y'], line), axis=1)
+    baseline_x, baseline_y = line.xy
+    index = build_baseline_index(baseline_x, baseline_y)
+    chainage, offset, side = project_points_to_baseline(terraces['X'].values, terraces['Y'].values, index)
+    terraces['DistAlongBaseline_new'] = chainage
+    terraces['DistToBaseline_new'] = offset
+    terraces['BaselineSide'] = side
 
     return terraces
 #---------------------------------------------------------------------------------------------#
+# RENDERING
+# Functions to render the per-terrace figures in parallel
+#---------------------------------------------------------------------------------------------#
+
+def _init_render_worker():
+    """
+    Make sure the rendering workers use the non-interactive backend
+    """
+    plt.switch_backend('Agg')
+
+def _render_job(job):
+    """
+    Render a single figure and time it. The job is a tuple of the plotting
+    function, the figure filename and a dict of keyword arguments, which
+    should only contain the small arrays that the figure needs.
+    """
+    plot_function, fname, kwargs = job
+    start_wall = time.time()
+    start_cpu = time.process_time()
+    n_points = plot_function(fname, **kwargs)
+    return {'fname': fname, 'n_points': n_points,
+            'wall_time': time.time() - start_wall,
+            'cpu_time': time.process_time() - start_cpu,
+            'worker': os.getpid()}
+
+@instrumentation.timed('render_figures', rows_from='jobs')
+def render_figures(jobs, n_workers=1, log_fname=None):
+    """
+    This function renders a list of figures, either one after the other or
+    in a pool of worker processes using the Agg backend. The figures are
+    saved under the filenames given in the jobs, so the output doesn't depend
+    on the number of workers.
+
+    Args:
+        jobs: list of (plotting function, filename, dict of keyword arguments)
+        n_workers (int): the number of worker processes. Default = 1 (no pool)
+        log_fname (str): if given, write the time taken for each figure to this csv
+
+    Returns:
+        dataframe with the time taken for each figure
+
+    Author: FJC
+    """
+    if n_workers > 1 and len(jobs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_render_worker) as pool:
+            timings = list(pool.map(_render_job, jobs, chunksize=max(1, len(jobs)//(4*n_workers))))
+    else:
+        timings = []
+        for i, job in enumerate(jobs):
+            sys.stdout.write("Figure %d of %d       \r" %(i+1, len(jobs)))
+            timings.append(_render_job(job))
+
+    timing_df = pd.DataFrame(timings, columns=['fname', 'n_points', 'wall_time', 'cpu_time', 'worker'])
+    print("Rendered %d figures (%.1f s of rendering time)" %(len(timing_df), timing_df['wall_time'].sum()))
+    if log_fname:
+        timing_df.to_csv(log_fname, index=False)
+
+    return timing_df
+
+#---------------------------------------------------------------------------------------------#
 # XZ PLOTS
 # Functions to make XZ plots of terraces
 #---------------------------------------------------------------------------------------------#
 
-def long_profiler(DataDirectory, fname_prefix, terraces, lp, FigFormat='png'):
+def plot_terrace_long_profile(fname, distance, elevation, bin_centres, bin_medians, FigFormat='png'):
     """
-    This function creates plots of the terraces with distance
-    downstream along the main channel.
-    It also attempts to fit a spline through each profile but this is not working
-    very well yet.
+    Plot the long profile of a single terrace with the median elevation along it.
 
     Args:
-        terraces: the dataframe with the terrace info
-        lp: the dataframe with the baseline profile info
+        fname (str): the filename of the figure
+        distance: the distance along the baseline of each pixel (km), sorted
+        elevation: the elevation of each pixel
+        bin_centres: the distance along the baseline of the centre of each bin (km)
+        bin_medians: the median elevation in each bin
         FigFormat: the format of the figure, default = png
 
     Returns:
-        terrace long profile plot
+        the number of pixels plotted
 
     Author: FJC
     """
-
     fig = plt.figure()
     ax = plt.subplot(111)
-    # now plot
-    #ax = terraces.plot.scatter(x='DistAlongBaseline_new', y='Elevation', c='new_ID', colormap='viridis', s=0.2)
+    ax.scatter(distance, elevation, s = 0.2)
 
-    terrace_ids = terraces.new_ID.unique()
-    for id in terrace_ids:
-        sys.stdout.write("This id is %d       \r" %(id))
-        this_df = terraces[terraces.new_ID == id]
-        this_df['DistAlongBaseline_new'] = this_df['DistAlongBaseline_new']/1000
-        sorted_df = this_df.sort_values(by='DistAlongBaseline_new')
-        _xTerraces = sorted_df['DistAlongBaseline_new'].values
-        _zTerraces = sorted_df['Elevation'].values
-        plt.scatter(_xTerraces, _zTerraces, s = 0.2)
-
-        # bin the points into 100 m bins and find the median elevation within that bin.
-        #bin_width = 0.05
-        #n_bins = int((_xTerraces.max() - _xTerraces.min())/bin_width)
-        n_bins = 50
-        print("Number of bins:", n_bins)
-        bin_medians, bin_edges, binnumber = stats.binned_statistic(_xTerraces, _zTerraces, statistic='median', bins=n_bins)
-        bin_width = (bin_edges[1] - bin_edges[0])
-        bin_centres = bin_edges[1:] - bin_width/2
-        plt.plot(bin_centres, bin_medians, c='red')
-
-        #print("Fitting spline...")
-        #fit a spline through the terrace points
-        #print(_xTerraces)
-        #yhat = savgol_filter(_zTerraces, 101, 2)   # window size 51, polynomial order 3
-        #plt.plot(_xTerraces, yhat, color='red')
-
-        plt.xlabel('Distance downstream (km)')
-        plt.ylabel('Elevation (m)')
-        plt.savefig(DataDirectory+fname_prefix+'_terrace_plot_'+str(id)+'.'+FigFormat,format=FigFormat,dpi=300)
-        plt.clf()
+    # plot the median elevation within each bin.
+    ax.plot(bin_centres, bin_medians, c='red')
+
+    ax.set_xlabel('Distance downstream (km)')
+    ax.set_ylabel('Elevation (m)')
+    fig.savefig(fname,format=FigFormat,dpi=300)
+    plt.close(fig)
+
+    return len(distance)
+
+@instrumentation.timed('long_profiler', rows_from='terraces')
+def long_profiler(DataDirectory, fname_prefix, terraces, lp, FigFormat='png', n_workers=1, bin_width=100.):
+    """
+    This function creates a plot of each terrace with distance
+    downstream along the main channel. The pixels are binned along the
+    baseline and the median elevation in each bin is plotted as a line over
+    the pixels. The binned medians and percentiles are also written to the
+    _terrace_binned_profiles.csv.
+
+    Args:
+        DataDirectory (str): the data directory
+        fname_prefix (str): the prefix of the DEM
+        terraces: the dataframe with the terrace info
+        lp: the dataframe with the baseline profile info
+        FigFormat: the format of the figure, default = png
+        n_workers (int): the number of processes used to render the figures, default = 1
+        bin_width: the width of the bins along the baseline (m), default = 100 m
+
+    Returns:
+        terrace long profile plots
+
+    Author: FJC
+    """
+    # get the pixels for each terrace, sorted by distance along the baseline
+    groups = group_terraces(terraces, sort_col='DistAlongBaseline_new')
+    distance = terraces['DistAlongBaseline_new'].values/1000
+    elevation = terraces['Elevation'].values
+
+    # bin the points into 100 m bins and find the median elevation within each bin.
+    profile_df = get_binned_profiles(terraces, bin_width=bin_width)
+    profile_df.to_csv(DataDirectory+fname_prefix+'_terrace_binned_profiles.csv', index=False)
+    _, profile_codes = _get_group_codes(profile_df, 'new_ID')
+    profile_starts = np.searchsorted(profile_codes, np.arange(len(groups['counts'])+1))
+
+    jobs = []
+    for i, id in enumerate(groups['keys']['new_ID']):
+        this_terrace = groups['order'][groups['starts'][i]:groups['starts'][i]+groups['counts'][i]]
+        these_bins = profile_df.iloc[profile_starts[i]:profile_starts[i+1]]
+        fname = DataDirectory+fname_prefix+'_terrace_plot_'+str(id)+'.'+FigFormat
+        jobs.append((plot_terrace_long_profile, fname, {'distance': distance[this_terrace], 'elevation': elevation[this_terrace],
+                                                        'bin_centres': these_bins['bin_centre'].values/1000,
+                                                        'bin_medians': these_bins['median_elevation'].values,
+                                                        'FigFormat': FigFormat}))
+
+    render_figures(jobs, n_workers=n_workers, log_fname=DataDirectory+fname_prefix+'_terrace_plot_timings.csv')
 
 def long_profiler_all_terraces(DataDirectory, fname_prefix, terraces, lp, FigFormat='png'):
     """
@@ -372,62 +1263,217 @@ def long_profiler_all_terraces(DataDirectory, fname_prefix, terraces, lp, FigFor
     Returns:
         terrace long profile plot
 
+    Author: FJC
+    """
+    # get the mean elevation, distance, relief and area of each terrace
+    master_df = get_terrace_summary(terraces, res=5)
+
+    # save the mean dataframe to csv
+    print(master_df)
+    master_df.to_csv(DataDirectory+fname_prefix+'_terrace_means.csv', index=False)
+
+    plot_terrace_means(DataDirectory, fname_prefix, master_df, lp, relief_range=(terraces.ChannelRelief.min(), terraces.ChannelRelief.max()), FigFormat=FigFormat)
+
+@instrumentation.timed('plot_terrace_means', rows_from='master_df')
+def plot_terrace_means(DataDirectory, fname_prefix, master_df, lp, relief_range=None, FigFormat='png', out_file=None, dpi=300):
+    """
+    Plot the mean elevation of each terrace against the long profile of the
+    main channel, from the terrace summary.
+
+    Args:
+        master_df: the dataframe with the summary of each terrace (from get_terrace_summary)
+        lp: the dataframe with the baseline profile info
+        relief_range: the (min, max) relief above the channel for the colour scale.
+        Default = the range of the mean relief of the terraces
+        FigFormat: the format of the figure, default = png
+        out_file: a file name or file object to save the figure to. Default = <fname_prefix>_terrace_plot.<FigFormat>
+        dpi (int): the resolution of the figure, default = 300
+
+    Returns:
+        terrace long profile plot
+
     Author: FJC
     """
 
     fig = plt.figure()
     ax = plt.subplot(111)
 
-    # plot the main stem channel in black
+    # plot the main stem channel in black. If the baseline doesn't have the distance along it yet,
+    # it's the distance between the baseline points.
+    if 'DistAlongBaseline_new' not in lp.columns:
+        lp = lp.assign(DistAlongBaseline_new=build_baseline_index(lp['X'].values, lp['Y'].values)['cum_dist'])
     plt.plot(lp['DistAlongBaseline_new']/1000,lp['Elevation'], c='k', lw=2)
 
-    # now plot each terrace individually
-    terrace_ids = terraces.new_ID.unique()
     # normalize colours by relief above channel
-    norm = colors.Normalize(vmin=terraces.ChannelRelief.min(),vmax=terraces.ChannelRelief.max())
-    # get area of terraces: size of marker is scaled by area
-    areas = get_terrace_areas(terraces, res=5)
-    print(areas)
-
-    data = []
-    for i, id in enumerate(terrace_ids):
-        sys.stdout.write("This id is %d       \r" %(id))
-        this_df = terraces[terraces.new_ID == id]
-        this_df['DistAlongBaseline_new'] = this_df['DistAlongBaseline_new']/1000
-        sorted_df = this_df.sort_values(by='DistAlongBaseline_new')
-        _xTerraces = sorted_df['DistAlongBaseline_new'].values
-        _zTerraces = sorted_df['Elevation'].values
-        ChannelRelief = sorted_df['ChannelRelief'].values
-
-        mean_elevation = np.mean(_zTerraces)
-        std_elevation = np.std(_zTerraces)
-        # get the distance in the middle of the terrace
-        distance = np.take(_xTerraces, _xTerraces.size // 2)
-        mean_relief = np.mean(ChannelRelief)
-
-        #print(mean_relief)
-        plt.scatter(distance, mean_elevation, c=mean_relief, s=areas[id]/100000, edgecolors='k', cmap=cm.Reds, norm=norm, zorder=1, alpha=0.5)
-        plt.errorbar(distance, mean_elevation, yerr=std_elevation, zorder=0.1, c='0.5', lw=1, capsize=2, alpha=0.5)
-
-        # append the mean data
-        data.append([id, mean_elevation, std_elevation, distance, mean_relief, areas[id]])
+    if relief_range is None:
+        relief_range = (master_df['mean_relief'].min(), master_df['mean_relief'].max())
+    norm = colors.Normalize(vmin=relief_range[0],vmax=relief_range[1])
 
-
-    # save the mean dataframe to csv
-    print(data)
-    master_df = pd.DataFrame(data, columns=['new_ID', 'mean_elevation', 'std_elevation', 'flow_dist', 'mean_relief', 'area'])
-    print(master_df)
-    master_df.to_csv(DataDirectory+fname_prefix+'_terrace_means.csv', index=False)
+    # now plot each terrace: size of marker is scaled by area
+    plt.scatter(master_df['flow_dist'], master_df['mean_elevation'], c=master_df['mean_relief'], s=master_df['area']/100000, edgecolors='k', cmap=cm.Reds, norm=norm, zorder=1, alpha=0.5)
+    plt.errorbar(master_df['flow_dist'], master_df['mean_elevation'], yerr=master_df['std_elevation'], fmt='none', zorder=0.1, c='0.5', lw=1, capsize=2, alpha=0.5)
 
     # set axis params and save
     ax.set_xlabel('Distance downstream (km)')
     ax.set_ylabel('Elevation (m)')
     plt.colorbar(cmap=cm.Reds,norm=norm, label="Elevation above modern channel (m)")
     plt.tight_layout()
-    plt.savefig(DataDirectory+fname_prefix+'_terrace_plot.'+FigFormat,format=FigFormat,dpi=300)
-    plt.clf()
+    if out_file is None:
+        out_file = DataDirectory+fname_prefix+'_terrace_plot.'+FigFormat
+    with instrumentation.stage('savefig'):
+        plt.savefig(out_file,format=FigFormat,dpi=dpi)
+    plt.close(fig)
+
+@instrumentation.timed('binned_kde')
+def get_binned_kde(KDE, x_grid, y_grid, max_nodes=4000):
+    """
+    Evaluate a Gaussian KDE on a regular grid by binning the data onto the grid and
+    convolving the binned counts with the kernel using an FFT, rather than evaluating
+    the kernel for every data point at every grid position. The data are linearly
+    binned onto a grid which is refined until the nodes are at most a quarter of a bandwidth
+    apart (up to max_nodes in each direction), and the density is then sampled at
+    the nodes of the requested grid.
+
+    Args:
+        KDE: a scipy.stats.gaussian_kde object, which gives the data and the kernel covariance
+        x_grid: the evenly spaced x positions of the grid
+        y_grid: the evenly spaced y positions of the grid
+        max_nodes (int): the maximum number of nodes in each direction of the refined grid
+
+    Returns:
+        array of density with shape (len(y_grid), len(x_grid))
+
+    Author: FJC
+    """
+    from scipy.signal import fftconvolve
+
+    x, y = KDE.dataset
+    weights = KDE.weights
+
+    # refine the grid so that the nodes are no more than a quarter of a bandwidth apart
+    sigma = np.sqrt(np.diag(KDE.covariance))
+    n_fine = []
+    for grid, this_sigma in zip((x_grid, y_grid), sigma):
+        spacing = (grid[-1] - grid[0])/(len(grid)-1)
+        refine = int(np.clip(np.ceil(4*spacing/this_sigma), 1, max(1, (max_nodes-1)//(len(grid)-1))))
+        n_fine.append(refine)
+    x_fine = np.linspace(x_grid[0], x_grid[-1], (len(x_grid)-1)*n_fine[0]+1)
+    y_fine = np.linspace(y_grid[0], y_grid[-1], (len(y_grid)-1)*n_fine[1]+1)
+    dx = x_fine[1] - x_fine[0]
+    dy = y_fine[1] - y_fine[0]
+    nx = x_fine.size
+    ny = y_fine.size
+
+    # linear binning: share the weight of each point between the four surrounding nodes
+    fx = (x - x_fine[0])/dx
+    fy = (y - y_fine[0])/dy
+    ix = np.floor(fx).astype(np.intp)
+    iy = np.floor(fy).astype(np.intp)
+    wx = fx - ix
+    wy = fy - iy
+    binned = np.zeros(nx*ny)
+    for ox, oy, w in ((0, 0, (1-wx)*(1-wy)), (1, 0, wx*(1-wy)), (0, 1, (1-wx)*wy), (1, 1, wx*wy)):
+        jx = ix + ox
+        jy = iy + oy
+        inside = (jx >= 0) & (jx < nx) & (jy >= 0) & (jy < ny)
+        binned += np.bincount(jy[inside]*nx + jx[inside], weights=(w*weights)[inside], minlength=nx*ny)
+    binned = binned.reshape(ny, nx)
+
+    # the kernel sampled at the grid offsets, out to 4 bandwidths
+    kx = min(int(np.ceil(4*sigma[0]/dx)), nx-1)
+    ky = min(int(np.ceil(4*sigma[1]/dy)), ny-1)
+    off_x, off_y = np.meshgrid(np.arange(-kx, kx+1)*dx, np.arange(-ky, ky+1)*dy)
+    offsets = np.vstack((off_x.ravel(), off_y.ravel()))
+    q = np.sum(offsets * np.dot(KDE.inv_cov, offsets), axis=0)
+    kernel = (np.exp(-0.5*q)/np.sqrt(np.linalg.det(2*np.pi*KDE.covariance))).reshape(off_x.shape)
+
+    density = fftconvolve(binned, kernel, mode='same')
+    return np.clip(density[::n_fine[1], ::n_fine[0]], 0, None)
+
+def get_kde_error(KDE, x_grid, y_grid, density, n_check=500):
+    """
+    Compare a gridded KDE against the exact KDE at a random sample of the grid nodes
+    (and the node with the highest density).
+
+    Args:
+        KDE: the scipy.stats.gaussian_kde object
+        x_grid: the x positions of the grid
+        y_grid: the y positions of the grid
+        density: the gridded density with shape (len(y_grid), len(x_grid))
+        n_check (int): the number of grid nodes to check
+
+    Returns:
+        dict with the maximum and RMS absolute error, both divided by the maximum
+        density, and the number of nodes checked
+
+    Author: FJC
+    """
+    rng = np.random.RandomState(0)
+    n_check = min(n_check, density.size)
+    nodes = np.union1d(rng.choice(density.size, n_check, replace=False), [np.argmax(density)])
+    iy, ix = np.unravel_index(nodes, density.shape)
+    exact = KDE(np.vstack((x_grid[ix], y_grid[iy])))
+    error = np.abs(density[iy, ix] - exact)/exact.max()
+
+    return {'max_error': error.max(), 'rms_error': np.sqrt(np.mean(error**2)), 'n_checked': nodes.size}
+
+@instrumentation.timed('terrace_kde', rows_from='flow_dist')
+def get_terrace_kde(flow_dist, elevation, prec=100, bw_method=0.03, kde_method='exact', check_error=False):
+    """
+    Get the Gaussian KDE of the terrace pixels on a grid of distance along the
+    baseline and elevation, from 0 to the largest distance and elevation.
+
+    Args:
+        flow_dist: array of the distance along the baseline of each pixel (km)
+        elevation: array of the elevation of each pixel (m)
+        prec(int): the number of grid nodes in each direction
+        bw_method: the method for determining the bandwidth of the KDE, see MakeTerraceHeatMap
+        kde_method (str): "exact" or "binned", see MakeTerraceHeatMap
+        check_error (bool): if true and kde_method is "binned", get the error of the binned KDE
+
+    Returns:
+        dict with the x_grid and y_grid, the density Z (with the highest elevation in the
+        first row, for imshow), the extent and the kde_error, or None if there aren't any pixels
+
+    Author: FJC
+    """
+    import scipy.stats as st
+
+    flow_dist = np.asarray(flow_dist, dtype=np.float64)
+    elevation = np.asarray(elevation, dtype=np.float64)
+    if flow_dist.size == 0:
+        return None
+
+	## Getting the extent of our dataset
+    xmin = 0
+    xmax = flow_dist.max()
+    ymin = 0
+    ymax = elevation.max()
+
+    ## formatting the data in a meshgrid
+    x_grid = np.linspace(0,xmax,num = prec)
+    y_grid = np.linspace(0,ymax, num = prec)
+    values = np.vstack([flow_dist, elevation])
+    kde_error = None
+
+    # get the kernel density estimation
+    KDE = st.gaussian_kde(values, bw_method = bw_method)
+    if kde_method == 'binned':
+        density = get_binned_kde(KDE, x_grid, y_grid)
+        if check_error:
+            kde_error = get_kde_error(KDE, x_grid, y_grid, density)
+            print("Binned KDE error: max = %.3g, RMS = %.3g of the maximum density (%d nodes checked)" %(kde_error['max_error'], kde_error['rms_error'], kde_error['n_checked']))
+        Z = density[::-1]
+    else:
+        X,Y = np.meshgrid(x_grid,y_grid)
+        positions = np.vstack([X.ravel(), Y.ravel()[::-1]]) # inverted Y to get the axis in the bottom left
+        with instrumentation.stage('exact_kde', rows=values.shape[1]):
+            Z = np.reshape(KDE(positions).T,X.shape)
+
+    return {'x_grid': x_grid, 'y_grid': y_grid, 'Z': Z, 'extent': [xmin, xmax, ymin, ymax], 'kde_error': kde_error}
 
-def MakeTerraceHeatMap(DataDirectory,fname_prefix, prec=100, bw_method=0.03, FigFormat='png', ages=""):
+@instrumentation.timed('terrace_heat_map')
+def MakeTerraceHeatMap(DataDirectory,fname_prefix, prec=100, bw_method=0.03, FigFormat='png', ages="", kde_method='exact', check_error=False, terrace_df=None, lp=None, table_format='csv', out_file=None, dpi=300):
     """
     Function to make a heat map of the terrace pixels using Gaussian KDE.
     see https://docs.scipy.org/doc/scipy-0.14.0/reference/generated/scipy.stats.gaussian_kde.html
@@ -441,50 +1487,62 @@ def MakeTerraceHeatMap(DataDirectory,fname_prefix, prec=100, bw_method=0.03, Fig
         Can either be "scott", "silverman" (where the bandwidth will be determined automatically), or a scalar. Default = 0.03
         FigFormat(str): figure format, default = png
         ages (str): Can pass in the name of a csv file with terrace ages which will be plotted on the profile. Must be in the same directory
+        kde_method (str): "exact" evaluates the KDE at every grid position, "binned" bins the pixels onto the grid
+        and convolves them with the kernel, which is much faster for large numbers of pixels. Default = exact
+        check_error (bool): if true and kde_method is "binned", compare the binned KDE to the exact KDE at a
+        sample of the grid positions and print the error
+        terrace_df: the dataframe with the terrace info, if you have already read it in. If not I'll read
+        the _terrace_info_filtered_dist table
+        lp: the dataframe with the baseline info, if you have already read it in. If not I'll read
+        the _baseline_channel_info table
+        table_format (str): the format of the tables that I read, default = csv
+        out_file: a file name or file object to save the figure to. Default = <fname_prefix>_terrace_plot_heat_map.<FigFormat>
+        dpi (int): the resolution of the figure, default = 300
+
+    Returns:
+        dict with the error of the binned KDE if check_error is true
 
     FJC 26/03/18
     """
-    import scipy.stats as st
-
     # make a figure
     fig = CreateFigure()
     ax = plt.subplot(111)
 
-    # read in the terrace DataFrame
-    terrace_df = pd.read_csv(DataDirectory+fname_prefix+'_terrace_info_filtered_dist.csv')
-    terrace_df = terrace_df[terrace_df['BaselineNode'] != -9999]
+    import TerraceIO
+
+    # read in the terrace DataFrame, only reading the columns that we need
+    if terrace_df is None:
+        terrace_df = TerraceIO.load_table(DataDirectory+fname_prefix+'_terrace_info_filtered_dist', table_format, columns=['DistAlongBaseline_new', 'Elevation', 'BaselineNode'])
 
     # read in the baseline channel csv
-    lp = pd.read_csv(DataDirectory+fname_prefix+'_baseline_channel_info.csv')
+    if lp is None:
+        lp = TerraceIO.load_table(DataDirectory+fname_prefix+'_baseline_channel_info', table_format, columns=['DistFromOutlet', 'Elevation'])
     lp = lp[lp['Elevation'] != -9999]
 
     # get the distance from outlet along the baseline for each terrace pixels
     #terrace_df = terrace_df.merge(lp, left_on = "BaselineNode", right_on = "node")
     #print(terrace_df.columns)
-    flow_dist = terrace_df['DistAlongBaseline_new']/1000
+    # use the arrays of the pixels that are on the baseline, so the whole dataframe isn't copied
+    flow_dist = terrace_df['DistAlongBaseline_new'].values.astype(np.float64)/1000
+    elevation = terrace_df['Elevation'].values.astype(np.float64)
+    if 'BaselineNode' in terrace_df.columns:
+        on_baseline = terrace_df['BaselineNode'].values != -9999
+        flow_dist = flow_dist[on_baseline]
+        elevation = elevation[on_baseline]
     #print(terrace_df)
 
-	## Getting the extent of our dataset
-    xmin = 0
-    xmax = flow_dist.max()
-    ymin = 0
-    ymax = terrace_df["Elevation"].max()
-
-    ## formatting the data in a meshgrid
-    X,Y = np.meshgrid(np.linspace(0,xmax,num = prec),np.linspace(0,ymax, num = prec))
-    positions = np.vstack([X.ravel(), Y.ravel()[::-1]]) # inverted Y to get the axis in the bottom left
-    values = np.vstack([flow_dist, terrace_df['Elevation']])
-    if len(values) == 0:
+    kde = get_terrace_kde(flow_dist, elevation, prec, bw_method, kde_method, check_error)
+    kde_error = None
+    if kde is None:
         print("You don't have any terraces, I'm going to quit now.")
     else:
-        # get the kernel density estimation
-        KDE = st.gaussian_kde(values, bw_method = bw_method)
-        Z = np.reshape(KDE(positions).T,X.shape)
+        kde_error = kde['kde_error']
+        xmin, xmax, ymin, ymax = kde['extent']
 
         # plot the density on the profile
         cmap = cm.gist_heat_r
         cmap.set_bad(alpha=0)
-        cb = ax.imshow(Z, interpolation = "None",  extent=[xmin, xmax, ymin, ymax], cmap=cmap, aspect = "auto")
+        cb = ax.imshow(kde['Z'], interpolation = "None",  extent=[xmin, xmax, ymin, ymax], cmap=cmap, aspect = "auto")
 
         # plot the main stem channel
         ax.plot(lp['DistFromOutlet']/1000,lp['Elevation'],'k',lw=1)
@@ -510,8 +1568,13 @@ def MakeTerraceHeatMap(DataDirectory,fname_prefix, prec=100, bw_method=0.03, Fig
 
         # save the figure
         plt.tight_layout()
-        plt.savefig(T_directory+fname_prefix+'_terrace_plot_heat_map.png',format=FigFormat,dpi=300)
-        plt.clf
+        if out_file is None:
+            out_file = DataDirectory+fname_prefix+'_terrace_plot_heat_map.'+FigFormat
+        with instrumentation.stage('savefig'):
+            plt.savefig(out_file,format=FigFormat,dpi=dpi)
+    plt.close(fig)
+
+    return kde_error
 
 #--------------------------------------------------------------------------------------------------#
 # 3D plots
@@ -519,47 +1582,74 @@ def MakeTerraceHeatMap(DataDirectory,fname_prefix, prec=100, bw_method=0.03, Fig
 def plane(x,y,C):
     return C[0]*x + C[1]*y + C[2]
 
-def PlotTerraceSurfaces(DataDirectory, fname_prefix, terraces):
+def plot_terrace_surface(fname, X, Y, Z, C):
     """
-    Make 3d plot of each terrace surface
+    Make a 3d plot of a single terrace surface with the plane fitted to it.
+
+    Args:
+        fname (str): the filename of the figure
+        X: the X coordinates of the pixels
+        Y: the Y coordinates of the pixels
+        Z: the elevation of the pixels
+        C: the coefficients of the plane, Z = C[0]*X + C[1]*Y + C[2]
+
+    Returns:
+        the number of pixels plotted
+
+    Author: FJC
     """
-    # make a figure
+    # this registers the 3d projection
+    from mpl_toolkits import mplot3d
+
     fig = plt.figure()
+    plane_x = np.linspace(X.min()-100, X.max()+100, 1000)
+    plane_y = np.linspace(Y.min()-100, Y.max()+100, 1000)
+    plane_X, plane_Y = np.meshgrid(plane_x, plane_y)
+    plane_Z = plane(plane_X,plane_Y,C)
+
+    # plot the plane
+    ax = fig.add_subplot(111, projection='3d')
+    ax.plot_wireframe(plane_X, plane_Y, plane_Z, color='black', lw=0.7, alpha=0.5, zorder=0)
+
+    # plot the terrace points
+    ax.scatter(X, Y, Z, c=Z, s=0.2, edgecolors=None, zorder=2)
 
-    # create a groupby object from the terrace dataframe
-    terrace_ids = terraces.new_ID.unique()
+    ax.set_xlabel('X (m)')
+    ax.set_ylabel('Y (m)')
+    ax.set_zlabel('Elevation (m)')
+    fig.savefig(fname,format='png',dpi=300)
+    plt.close(fig)
 
-    for id in terrace_ids:
-        sys.stdout.write("This id is %d       \r" %(id))
+    return len(Z)
+
+@instrumentation.timed('terrace_surfaces', rows_from='terraces')
+def PlotTerraceSurfaces(DataDirectory, fname_prefix, terraces, n_workers=1, fit_method='lstsq'):
+    """
+    Make 3d plot of each terrace surface
+
+    Args:
+        terraces: the dataframe with the terrace info
+        n_workers (int): the number of processes used to render the figures and fit the robust planes, default = 1
+        fit_method (str): how to fit the planes, 'lstsq', 'huber' or 'ransac' (see fit_terrace_planes)
+    """
+    # group the pixels by terrace ID and fit a plane to each terrace
+    # form: Z = C[0]*X + C[1]*Y + C[2]
+    groups = group_terraces(terraces)
+    planes = fit_terrace_planes(terraces, groups=groups, method=fit_method, n_workers=n_workers)
+    if fit_method != 'lstsq':
+        report_plane_fits(planes, fit_method)
+
+    jobs = []
+    for i, id in enumerate(groups['keys']['new_ID']):
         # get the x and z data for this terrace id
-        this_df = terraces[terraces.new_ID == id]
-        #_x = terrace_df['DistAlongBaseline'].values[_terrace_subset]
-        #_y = terrace_df['DistToBaseline'].values[_terrace_subset]
-        _z = this_df['Elevation'].values
-        _X = this_df['X'].values
-        _Y = this_df['Y'].values
-
-        # fit a plane to these points
-        # form: Z = C[0]*X + C[1]*Y + C[2]
-        _XY = np.vstack((_X, _Y, np.ones(len(_Y)))).transpose()
-        C,_,_,_ = linalg.lstsq(_XY, _z)
-        plane_x = np.linspace(_X.min()-100, _X.max()+100, 1000)
-        plane_y = np.linspace(_Y.min()-100, _Y.max()+100, 1000)
-        plane_X, plane_Y = np.meshgrid(plane_x, plane_y)
-        plane_Z = plane(plane_X,plane_Y,C)
-
-        # plot the plane
-        ax = plt.axes(projection='3d')
-        ax.plot_wireframe(plane_X, plane_Y, plane_Z, color='black', lw=0.7, alpha=0.5, zorder=0)
-
-        # plot the terrace points
-        ax.scatter(_X, _Y, _z, c=_z, s=0.2, edgecolors=None, zorder=2)
-
-        ax.set_xlabel('X (m)')
-        ax.set_ylabel('Y (m)')
-        ax.set_zlabel('Elevation (m)')
-        plt.savefig(DataDirectory+fname_prefix+'_3d_plot_'+str(id)+'.png',format='png',dpi=300)
-        plt.clf()
+        this_terrace = groups['order'][groups['starts'][i]:groups['starts'][i]+groups['counts'][i]]
+        fname = DataDirectory+fname_prefix+'_3d_plot_'+str(id)+'.png'
+        jobs.append((plot_terrace_surface, fname, {'X': terraces['X'].values[this_terrace],
+                                                   'Y': terraces['Y'].values[this_terrace],
+                                                   'Z': terraces['Elevation'].values[this_terrace],
+                                                   'C': planes['C'][i]}))
+
+    render_figures(jobs, n_workers=n_workers, log_fname=DataDirectory+fname_prefix+'_3d_plot_timings.csv')
 
 #-------------------------------------------------------------------------------------------#
 # Functions for merging to plot the whole UMV together
@@ -569,31 +1659,49 @@ def natural_sort_key(s):
     return [int(text) if text.isdigit() else text.lower()
             for text in re.split(_nsre, s)]
 
-def merge_baselines(lp, out_fname):
+@instrumentation.timed('merge_baselines', rows_from='lp')
+def merge_baselines(lp, out_fname, index_dir=None):
     """
-    Function to read in the baseline csv files and merge them for the whole UMV
+    Function to read in the baseline csv files and merge them for the whole UMV.
+    The reaches are put in natural order, the points are sorted by distance along
+    the baseline within each reach, and the distance along the merged baseline is
+    the distance along each reach plus the lengths of all the reaches before it.
+    The index of the merged baseline is also saved, so that it can be reused when
+    the terraces are projected onto it.
+
+    Args:
+        lp (str): the csv of the baseline points, with the reach in the layer column
+        out_fname (str): the name of the merged baseline csv
+        index_dir (str): the directory to save the baseline index to.
+        Default = the name of the csv with _index instead of .csv
+
+    Returns:
+        dataframe with the merged baseline
+
+    Author: FJC
     """
     lp_df = pd.read_csv(lp)
 
-    # get the reaches and sort numerically
+    # get the reaches and sort numerically, then sort by distance along the baseline within each reach
     reaches = sorted(lp_df.layer.unique(), key=natural_sort_key)
+    reach_order = pd.Series(np.arange(len(reaches)), index=reaches)
+    lp_df['_reach_order'] = reach_order.loc[lp_df['layer'].values].values
+    lp_df = lp_df.sort_values(by=['_reach_order', 'DistAlongB'], kind='mergesort')
 
-    master_df = pd.DataFrame()
-    # now loop through each one to create the new
-    end_dist = 0
-    for r in reaches:
-        this_df = lp_df[lp_df['layer'] == r]
-        #sort this DF by old distance along the baseline
-        this_df.sort_values(by='DistAlongB')
-        this_df['DistAlongBaseline_new'] = this_df['DistAlongB'] + end_dist
-        print(this_df)
-        end_dist = this_df['DistAlongBaseline_new'].max()
-        master_df = master_df.append(this_df)
+    # each reach starts at the end of the one before
+    reach_lengths = lp_df.groupby('_reach_order')['DistAlongB'].max()
+    offsets = reach_lengths.cumsum() - reach_lengths
+    lp_df['DistAlongBaseline_new'] = lp_df['DistAlongB'] + offsets.loc[lp_df['_reach_order'].values].values
+    lp_df = lp_df.drop(columns='_reach_order').reset_index(drop=True)
 
-    master_df.to_csv(out_fname, index=False)
+    lp_df.to_csv(out_fname, index=False)
+    if index_dir is None:
+        index_dir = os.path.splitext(out_fname)[0]+'_index'
+    save_baseline_index(build_baseline_index(lp_df['X'].values, lp_df['Y'].values), index_dir)
 
-    return master_df
+    return lp_df
 
+@instrumentation.timed('long_profiler_all_reaches', rows_from='terraces')
 def long_profiler_all_reaches(DataDirectory, fname_prefix, terraces, lp, FigFormat='png'):
     """
     Plot each terrace surface against the long profile of the entire UMV
@@ -618,43 +1726,16 @@ def long_profiler_all_reaches(DataDirectory, fname_prefix, terraces, lp, FigForm
     # plot the main stem channel in black
     plt.plot(lp['DistAlongBaseline_new']/1000,lp['Elevation'], c='k', lw=2)
 
-    # now plot each terrace individually
-    reaches = terraces.reach.unique()
     # normalize colours by relief above channel
     norm = colors.Normalize(vmin=terraces.ChannelRelief.min(),vmax=terraces.ChannelRelief.max())
-    # get area of terraces: size of marker is scaled by area
-    areas = get_terrace_areas(terraces, res=5)
-    print(areas)
-
-    data = []
-    for r in reaches:
-        this_reach = terraces[terraces.reach == r]
-        terrace_ids = this_reach.new_ID.unique()
-        for i, id in enumerate(terrace_ids):
-            sys.stdout.write("This id is %d       \r" %(id))
-            this_df = this_reach[this_reach.new_ID == id]
-            this_df['DistAlongBaseline_new'] = this_df['DistAlongBaseline_new']/1000
-            sorted_df = this_df.sort_values(by='DistAlongBaseline_new')
-            _xTerraces = sorted_df['DistAlongBaseline_new'].values
-            _zTerraces = sorted_df['Elevation'].values
-            ChannelRelief = sorted_df['ChannelRelief'].values
-
-            mean_elevation = np.mean(_zTerraces)
-            std_elevation = np.std(_zTerraces)
-            # get the distance in the middle of the terrace
-            distance = np.take(_xTerraces, _xTerraces.size // 2)
-            mean_relief = np.mean(ChannelRelief)
-
-            plt.scatter(distance, mean_elevation, c=mean_relief, s=10, edgecolors='k', cmap=cm.Reds, norm=norm, zorder=2, marker='x')
-            plt.errorbar(distance, mean_elevation, yerr=std_elevation, zorder=0.1, c='0.5', lw=1, capsize=2, alpha=0.5)
-
-            # append the mean data
-            data.append([id, mean_elevation, std_elevation, distance, mean_relief, areas[id]])
+    # get the mean elevation, distance, relief and area of each terrace in each reach
+    master_df = get_terrace_summary(terraces, res=5, by=['reach', 'new_ID'])
 
+    # now plot each terrace
+    plt.scatter(master_df['flow_dist'], master_df['mean_elevation'], c=master_df['mean_relief'], s=10, edgecolors='k', cmap=cm.Reds, norm=norm, zorder=2, marker='x')
+    plt.errorbar(master_df['flow_dist'], master_df['mean_elevation'], yerr=master_df['std_elevation'], fmt='none', zorder=0.1, c='0.5', lw=1, capsize=2, alpha=0.5)
 
     # save the mean dataframe to csv
-    print(data)
-    master_df = pd.DataFrame(data, columns=['new_ID', 'mean_elevation', 'std_elevation', 'flow_dist', 'mean_relief', 'area'])
     print(master_df)
     master_df.to_csv(DataDirectory+fname_prefix+'_terrace_means.csv', index=False)
     ax.set_ylim(50,300)
@@ -664,5 +1745,6 @@ def long_profiler_all_reaches(DataDirectory, fname_prefix, terraces, lp, FigForm
     ax.set_ylabel('Elevation (m)')
     plt.colorbar(cmap=cm.Reds,norm=norm, label="Elevation above modern channel (m)")
     plt.tight_layout()
-    plt.savefig(DataDirectory+fname_prefix+'_terrace_plot.'+FigFormat,format=FigFormat,dpi=300)
-    plt.clf()
+    with instrumentation.stage('savefig'):
+        plt.savefig(DataDirectory+fname_prefix+'_terrace_plot.'+FigFormat,format=FigFormat,dpi=300)
+    plt.close(fig)
@@ -0,0 +1,374 @@
+#------------------------------------------------------------------------------#
+# terrace-long-profiler
+# Functions to fit ancient long profiles to groups of terraces, using the
+# summary of each terrace (mean elevation and distance along the baseline)
+# Authors: F. Clubb
+#------------------------------------------------------------------------------#
+
+# import modules
+import pandas as pd
+import numpy as np
+from matplotlib import pyplot as plt
+import matplotlib.cm as cm
+import time
+
+import TerracePlotter
+from LSDPlottingTools import instrumentation
+
+# The profiles are exponential curves:
+#     z = a + b*exp(-k*(x-x0))
+# where x is the distance downstream (km) and x0 is the distance of the most
+# upstream terrace. With b >= 0 and k > 0 the profile always gets lower
+# downstream and is concave up, like a graded river. For a fixed k the profile
+# is linear in a and b, so these are found by weighted least squares in closed
+# form, and k is found by searching a grid. The sums that the least squares
+# needs are calculated for every grouping and every k at once.
+
+#---------------------------------------------------------------------------------------------#
+# FITTING
+#---------------------------------------------------------------------------------------------#
+
+def get_k_grid(x, n_k=60):
+    """
+    Get the grid of decay constants to search. These are spaced logarithmically
+    so that the profiles range from almost straight to almost all of the drop
+    happening in the first 1/30th of the valley.
+
+    Args:
+        x: the distance downstream of the terraces (km)
+        n_k (int): the number of decay constants
+
+    Returns:
+        array of decay constants (1/km)
+
+    Author: FJC
+    """
+    length = max(np.ptp(x), 1e-6)
+    return np.logspace(-2, 1.5, n_k)/length
+
+def _get_weights(summary_df, weights):
+    """
+    Get the weight of each terrace in the fit: 'n_pixels' (bigger terraces count
+    more), 'std' (1/variance of the terrace elevation) or None (all the same)
+    """
+    if weights is None:
+        return np.ones(len(summary_df))
+    elif weights == 'n_pixels':
+        return summary_df['n_pixels'].values.astype(np.float64)
+    elif weights == 'std':
+        std = summary_df['std_elevation'].values.astype(np.float64)
+        return 1./np.maximum(std, np.median(std[std > 0]) if np.any(std > 0) else 1.)**2
+    raise ValueError("Unknown weights "+str(weights)+", choose from 'n_pixels', 'std' or None")
+
+def _solve_exponential(Sw, Sz, Szz, SE, SEE, SEz, k_grid, EE_scale):
+    """
+    Solve the weighted least squares for every grouping and every k, then pick the
+    best k for each grouping. The sums have shape (n_groupings, n_k), except Sw,
+    Sz and Szz which have shape (n_groupings, 1). If the spread of exp(-k*x) within
+    a grouping is too small compared with EE_scale (the size of the sums it was
+    calculated from) to be resolved, the flat profile is used for that k.
+
+    Returns:
+        a, b, k and the weighted sum of the squared residuals for each grouping
+    """
+    # the sums about the weighted mean of each grouping
+    var_z = Szz - Sz*Sz/Sw
+    var_E = SEE - SE*SE/Sw
+    cov = SEz - SE*Sz/Sw
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        b = np.where(var_E > 1e-9*EE_scale, cov/var_E, 0.)
+    # the profile can't get higher downstream: if the best b is negative then the flat profile is the best fit
+    b = np.maximum(b, 0.)
+    sse = np.maximum(var_z - 2*b*cov + b*b*var_E, 0.)
+
+    best = np.argmin(sse, axis=1)
+    rows = np.arange(sse.shape[0])
+    b = b[rows, best]
+    a = (Sz[:, 0] - b*SE[rows, best])/Sw[:, 0]
+    return a, b, k_grid[best], sse[rows, best]
+
+def get_contiguous_windows(n_terraces, min_terraces=4, max_terraces=None):
+    """
+    Get every window of consecutive terraces, from min_terraces to max_terraces long.
+
+    Returns:
+        arrays of the first terrace and one past the last terrace of each window
+
+    Author: FJC
+    """
+    if max_terraces is None:
+        max_terraces = n_terraces
+    starts = []
+    stops = []
+    for length in range(min_terraces, min(max_terraces, n_terraces)+1):
+        these_starts = np.arange(n_terraces-length+1)
+        starts.append(these_starts)
+        stops.append(these_starts+length)
+    if not starts:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    return np.concatenate(starts), np.concatenate(stops)
+
+# the running sums over the terraces, set in each worker by _init_window_worker
+_window_sums = {}
+
+def _init_window_worker(sums):
+    """
+    Give a fitting worker the running sums, so they are only sent once
+    """
+    _window_sums.update(sums)
+
+def _fit_window_chunk(windows):
+    """
+    Fit the profiles for a chunk of windows. The sums over each window are the
+    differences of the running sums at either end of it.
+    """
+    starts, stops = windows
+    s = _window_sums
+    sums = [s[name][:, stops].T - s[name][:, starts].T for name in ['w', 'z', 'zz', 'E', 'EE', 'Ez']]
+    # the running sums lose precision for windows where exp(-k*x) is tiny, so the
+    # spread is compared with the total over all the terraces
+    return _solve_exponential(*sums, s['k_grid'], s['EE'][:, -1])
+
+def fit_contiguous_windows(x, z, w, order, min_terraces=4, max_terraces=None, k_grid=None, n_workers=1, chunk_size=5000):
+    """
+    Fit an exponential profile to every window of consecutive terraces, taking the
+    terraces in the order given (e.g. sorted by their height above the modern channel,
+    so that each window is a set of terraces at a similar level). The sums for each
+    window come from running sums over the terraces, so the fits don't depend on
+    the length of the windows. The windows are split into chunks which are fitted
+    in a pool of worker processes.
+
+    Args:
+        x: the distance downstream of each terrace (km)
+        z: the elevation of each terrace
+        w: the weight of each terrace
+        order: the order of the terraces for the windows
+        min_terraces (int): the fewest terraces in a window. Default = 4
+        max_terraces (int): the most terraces in a window. Default = all of them
+        k_grid: the decay constants to search. Default from get_k_grid
+        n_workers (int): the number of worker processes. Default = 1 (no pool)
+        chunk_size (int): the number of windows in each chunk
+
+    Returns:
+        arrays of the window starts and stops (positions in the order), and a, b, k
+        and the weighted root mean square error of each window. The profiles are
+        relative to x0 = x.min()
+
+    Author: FJC
+    """
+    if k_grid is None:
+        k_grid = get_k_grid(x)
+    z0 = np.average(z, weights=w)
+    x = x[order] - x.min()
+    z = z[order] - z0
+    w = w[order]
+    E = np.exp(-np.outer(k_grid, x))
+
+    def _running_sum(values):
+        values = np.atleast_2d(values)
+        return np.concatenate([np.zeros((values.shape[0], 1)), np.cumsum(values, axis=1)], axis=1)
+
+    sums = {'w': _running_sum(w), 'z': _running_sum(w*z), 'zz': _running_sum(w*z*z),
+            'E': _running_sum(w*E), 'EE': _running_sum(w*E*E), 'Ez': _running_sum(w*E*z),
+            'k_grid': k_grid}
+
+    starts, stops = get_contiguous_windows(len(x), min_terraces, max_terraces)
+    chunks = [(starts[i:i+chunk_size], stops[i:i+chunk_size]) for i in range(0, len(starts), chunk_size)]
+
+    if n_workers > 1 and len(chunks) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_window_worker, initargs=(sums,)) as pool:
+            results = list(pool.map(_fit_window_chunk, chunks))
+    else:
+        _init_window_worker(sums)
+        results = [_fit_window_chunk(chunk) for chunk in chunks]
+
+    if results:
+        a, b, k, sse = [np.concatenate(r) for r in zip(*results)]
+    else:
+        a, b, k, sse = [np.zeros(0) for i in range(4)]
+    Sw = sums['w'][0, stops] - sums['w'][0, starts]
+    return starts, stops, a + z0, b, k, np.sqrt(sse/Sw)
+
+@instrumentation.timed('fit_paleo_profiles', rows_from='summary_df')
+def fit_paleo_profiles(summary_df, sort_col='mean_relief', min_terraces=4, max_terraces=None, weights='n_pixels', n_k=60, n_workers=1):
+    """
+    This function fits ancient long profiles to groups of terraces. The candidate groups
+    are all the windows of consecutive terraces when they are sorted by sort_col
+    (by default their mean height above the modern channel).
+
+    Args:
+        summary_df: the summary of each terrace, from TerracePlotter.get_terrace_summary
+        sort_col (str): the column to sort the terraces by before taking the windows. Default = mean_relief
+        min_terraces (int): the fewest terraces in a group. Default = 4
+        max_terraces (int): the most terraces in a group. Default = all of them
+        weights: how to weight the terraces, 'n_pixels', 'std' or None. Default = n_pixels
+        n_k (int): the number of decay constants to search
+        n_workers (int): the number of worker processes. Default = 1
+
+    Returns:
+        dataframe with a row for each group: the first and one past the last position in
+        the sorted terraces, the number of terraces, the range of sort_col, the profile
+        parameters (z = a + b*exp(-k*(x-x0))) and the weighted rmse, sorted by rmse.
+        Also the order that the terraces were sorted into.
+
+    Author: FJC
+    """
+    x = summary_df['flow_dist'].values.astype(np.float64)
+    z = summary_df['mean_elevation'].values.astype(np.float64)
+    w = _get_weights(summary_df, weights)
+    order = np.argsort(summary_df[sort_col].values, kind='mergesort')
+
+    start_time = time.time()
+    starts, stops, a, b, k, rmse = fit_contiguous_windows(x, z, w, order, min_terraces, max_terraces,
+                                                          k_grid=get_k_grid(x, n_k), n_workers=n_workers)
+    print("Fitted %d groups of terraces in %.2f s" %(len(starts), time.time()-start_time))
+
+    sorted_values = summary_df[sort_col].values[order]
+    fits = pd.DataFrame({'start': starts, 'stop': stops, 'n_terraces': stops-starts,
+                         'min_'+sort_col: sorted_values[starts] if len(starts) else [],
+                         'max_'+sort_col: sorted_values[stops-1] if len(starts) else [],
+                         'a': a, 'b': b, 'k': k, 'x0': x.min(), 'rmse': rmse})
+    return fits.sort_values('rmse', kind='mergesort').reset_index(drop=True), order
+
+def get_profile_elevation(a, b, k, x0, x):
+    """
+    Get the elevation of the exponential profiles at distances x downstream.
+    a, b, k and x0 can be arrays of the parameters of several profiles, then the
+    result has a row for each profile.
+
+    Author: FJC
+    """
+    a, b, k, x0 = [np.atleast_1d(p)[:, np.newaxis] for p in (a, b, k, x0)]
+    return a + b*np.exp(-k*(np.asarray(x)[np.newaxis, :] - x0))
+
+def get_fit_residuals(summary_df, fits, order):
+    """
+    Get the residual of every terrace in each of the fitted groups, for all the
+    groups at once.
+
+    Args:
+        summary_df: the summary of each terrace
+        fits: the fitted groups, from fit_paleo_profiles
+        order: the order the terraces were sorted into for the windows
+
+    Returns:
+        dataframe with a row for each terrace in each group: the index of the fit
+        in fits, the terrace ID, distance, elevation and residual (observed - fitted)
+
+    Author: FJC
+    """
+    counts = fits['n_terraces'].values
+    fit_idx = np.repeat(np.arange(len(fits)), counts)
+    # the position of each terrace within its window
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    terrace_idx = order[fits['start'].values[fit_idx] + offsets]
+
+    x = summary_df['flow_dist'].values[terrace_idx]
+    z = summary_df['mean_elevation'].values[terrace_idx]
+    fitted = fits['a'].values[fit_idx] + fits['b'].values[fit_idx]*np.exp(-fits['k'].values[fit_idx]*(x - fits['x0'].values[fit_idx]))
+
+    residual_df = summary_df[['new_ID']].iloc[terrace_idx].reset_index(drop=True)
+    residual_df.insert(0, 'fit', fit_idx)
+    residual_df['flow_dist'] = x
+    residual_df['mean_elevation'] = z
+    residual_df['residual'] = z - fitted
+    return residual_df
+
+def select_profiles(fits, max_rmse, n_profiles=None):
+    """
+    Pick the groups to show as the paleo profiles: going from the biggest groups
+    to the smallest, take each group that fits to within max_rmse and doesn't share
+    any terraces with the groups already taken.
+
+    Args:
+        fits: the fitted groups, from fit_paleo_profiles
+        max_rmse: the largest rmse (m) for a group to be picked
+        n_profiles (int): the most profiles to pick. Default = no limit
+
+    Returns:
+        dataframe with the picked groups
+
+    Author: FJC
+    """
+    candidates = fits[fits['rmse'] <= max_rmse].sort_values(['n_terraces', 'rmse'], ascending=[False, True], kind='mergesort')
+    taken = []
+    for idx, start, stop in zip(candidates.index, candidates['start'].values, candidates['stop'].values):
+        if all(stop <= fits.at[t, 'start'] or start >= fits.at[t, 'stop'] for t in taken):
+            taken.append(idx)
+            if n_profiles is not None and len(taken) == n_profiles:
+                break
+    return fits.loc[taken]
+
+#---------------------------------------------------------------------------------------------#
+# PLOTTING
+#---------------------------------------------------------------------------------------------#
+
+def plot_paleo_profiles(DataDirectory, fname_prefix, summary_df, lp, profiles, order, FigFormat='png'):
+    """
+    Plot the fitted paleo profiles over the mean elevation of each terrace and
+    the long profile of the main channel. The terraces in each profile are
+    outlined in the colour of the profile.
+
+    Args:
+        summary_df: the summary of each terrace
+        lp: the dataframe with the baseline profile info, with DistAlongBaseline_new
+        profiles: the groups to plot, from select_profiles
+        order: the order the terraces were sorted into for the windows
+        FigFormat: the format of the figure, default = png
+
+    Author: FJC
+    """
+    fig = plt.figure()
+    ax = plt.subplot(111)
+
+    if 'DistAlongBaseline_new' not in lp.columns:
+        lp = lp.assign(DistAlongBaseline_new=TerracePlotter.build_baseline_index(lp['X'].values, lp['Y'].values)['cum_dist'])
+    plt.plot(lp['DistAlongBaseline_new']/1000, lp['Elevation'], c='k', lw=2)
+    plt.scatter(summary_df['flow_dist'], summary_df['mean_elevation'], c='0.7', s=10, zorder=1)
+
+    x = np.linspace(summary_df['flow_dist'].min(), summary_df['flow_dist'].max(), 200)
+    z = get_profile_elevation(profiles['a'].values, profiles['b'].values, profiles['k'].values, profiles['x0'].values, x)
+    profile_colours = cm.viridis(np.linspace(0, 0.9, max(len(profiles), 1)))
+    for i, (start, stop) in enumerate(zip(profiles['start'].values, profiles['stop'].values)):
+        these_terraces = summary_df.iloc[order[start:stop]]
+        plt.scatter(these_terraces['flow_dist'], these_terraces['mean_elevation'], facecolors='none', edgecolors=[profile_colours[i]], s=20, zorder=2)
+        plt.plot(x, z[i], c=profile_colours[i], lw=1, zorder=3)
+
+    ax.set_xlabel('Distance downstream (km)')
+    ax.set_ylabel('Elevation (m)')
+    plt.tight_layout()
+    plt.savefig(DataDirectory+fname_prefix+'_paleo_profiles.'+FigFormat, format=FigFormat, dpi=300)
+    plt.close(fig)
+
+def paleo_profiler(DataDirectory, fname_prefix, summary_df, lp, max_rmse=2., n_profiles=None, FigFormat='png', n_workers=1):
+    """
+    This function fits paleo long profiles to the terraces, picks the biggest groups of
+    terraces that fit well, and plots them. The picked profiles are written to
+    _paleo_profiles.csv and the residual of each terrace in them to
+    _paleo_profile_residuals.csv.
+
+    Args:
+        summary_df: the summary of each terrace, from TerracePlotter.get_terrace_summary
+        lp: the dataframe with the baseline profile info
+        max_rmse: the largest rmse (m) for a group of terraces to be picked. Default = 2 m
+        n_profiles (int): the most profiles to pick. Default = no limit
+        FigFormat: the format of the figure, default = png
+        n_workers (int): the number of worker processes for the fitting. Default = 1
+
+    Returns:
+        dataframe with the picked profiles
+
+    Author: FJC
+    """
+    fits, order = fit_paleo_profiles(summary_df, n_workers=n_workers)
+    profiles = select_profiles(fits, max_rmse, n_profiles)
+    print("Picked %d paleo profiles with rmse < %g m" %(len(profiles), max_rmse))
+
+    profiles.to_csv(DataDirectory+fname_prefix+'_paleo_profiles.csv', index=False)
+    residual_df = get_fit_residuals(summary_df, profiles.reset_index(drop=True), order)
+    residual_df.to_csv(DataDirectory+fname_prefix+'_paleo_profile_residuals.csv', index=False)
+    plot_paleo_profiles(DataDirectory, fname_prefix, summary_df, lp, profiles, order, FigFormat=FigFormat)
+
+    return profiles
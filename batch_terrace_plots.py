@@ -0,0 +1,186 @@
+# Driver to run make_terrace_plots for lots of DEMs in one go.
+# Running make_terrace_plots.py once for each DEM from a shell loop means that every DEM pays for starting python and
+# importing the plotting and GIS packages. This script runs all the jobs in one process (or a pool of worker processes
+# which each import the packages once), and writes a summary of the time taken and the outputs of each job.
+#
+# **job list** = a CSV file with one row for each job and the columns:
+#     base_directory = the directory with the terrace analysis (with the / at the end)
+#     fname_prefix = the prefix of the DEM
+#     options = (optional) any other arguments for make_terrace_plots, e.g. "-LP True -HM True -kde binned"
+#
+# python batch_terrace_plots.py -jobs jobs.csv -nw 4
+#-----------------------------------------------------------------------------------------#
+# FJC 15/01/21
+
+# import modules
+import matplotlib
+matplotlib.use('Agg')
+import pandas as pd
+import contextlib
+import shlex
+import time
+import sys
+import os
+import traceback
+
+import make_terrace_plots
+
+#=============================================================================
+# Running the jobs
+#=============================================================================
+def get_job_argv(job):
+    """
+    Get the arguments for make_terrace_plots for a job
+
+    Args:
+        job: dict with the base_directory, fname_prefix and options of the job
+
+    Returns:
+        list of arguments
+
+    Author: FJC
+    """
+    argv = ['-dir', str(job['base_directory']), '-fname', str(job['fname_prefix'])]
+    options = job.get('options')
+    if isinstance(options, str) and options.strip():
+        argv += shlex.split(options)
+    return argv
+
+def find_outputs(DataDirectory, fname_prefix, start_time):
+    """
+    Find the files for a DEM that were written after the job started, in the data
+    directory and in the UMV_combined directory for the compiled mode.
+
+    Returns:
+        list of the file names
+
+    Author: FJC
+    """
+    outputs = []
+    for this_dir in [DataDirectory, os.path.join(DataDirectory, 'UMV_combined')]:
+        if not os.path.isdir(this_dir):
+            continue
+        for fname in sorted(os.listdir(this_dir)):
+            full_fname = os.path.join(this_dir, fname)
+            if fname.startswith(fname_prefix) and os.path.getmtime(full_fname) >= start_time:
+                outputs.append(os.path.relpath(full_fname, DataDirectory))
+    return outputs
+
+def run_job(job):
+    """
+    Run one job with make_terrace_plots. Everything that the job prints goes to
+    <fname_prefix>_batch_log.txt in the data directory, so the logs of jobs
+    running at the same time don't get mixed up.
+
+    Args:
+        job: dict with the base_directory, fname_prefix and options of the job
+
+    Returns:
+        dict with the status, timings and outputs of the job
+
+    Author: FJC
+    """
+    DataDirectory = str(job['base_directory'])
+    fname_prefix = str(job['fname_prefix'])
+    log_fname = os.path.join(DataDirectory, fname_prefix+'_batch_log.txt')
+
+    start_time = time.time()
+    start_cpu = time.process_time()
+    status = 'ok'
+    error = ''
+    with open(log_fname, 'w') as log:
+        with contextlib.redirect_stdout(log):
+            try:
+                make_terrace_plots.main(get_job_argv(job))
+            except SystemExit as e:
+                # make_terrace_plots returns when it has finished, so it only exits (with or
+                # without a code) if the arguments are wrong
+                status = 'failed'
+                error = 'exit code '+str(e.code)
+            except Exception as e:
+                status = 'failed'
+                error = repr(e)
+                log.write(traceback.format_exc())
+
+    # the file times are only to the nearest second on some systems
+    return {'base_directory': DataDirectory, 'fname_prefix': fname_prefix, 'options': job.get('options', ''),
+            'status': status, 'error': error, 'wall_time': time.time() - start_time,
+            'cpu_time': time.process_time() - start_cpu, 'worker': os.getpid(),
+            'outputs': ';'.join(find_outputs(DataDirectory, fname_prefix, int(start_time))), 'log': log_fname}
+
+def run_batch(jobs, n_workers=1, summary_fname=None):
+    """
+    This function runs a list of jobs, either one after the other in this process or
+    in a pool of worker processes. Each worker imports the packages once and then
+    runs as many jobs as it is given.
+
+    Args:
+        jobs: list of dicts with the base_directory, fname_prefix and options of each job
+        n_workers (int): the number of worker processes. Default = 1 (no pool)
+        summary_fname (str): if given, write the summary of the jobs to this csv
+
+    Returns:
+        dataframe with the status, timings and outputs of each job
+
+    Author: FJC
+    """
+    results = [None]*len(jobs)
+    if n_workers > 1 and len(jobs) > 1:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = {pool.submit(run_job, job): i for i, job in enumerate(jobs)}
+            for n_done, future in enumerate(as_completed(futures)):
+                i = futures[future]
+                results[i] = future.result()
+                print("Job %d of %d: %s %s (%.1f s)" %(n_done+1, len(jobs), results[i]['fname_prefix'], results[i]['status'], results[i]['wall_time']))
+    else:
+        for i, job in enumerate(jobs):
+            results[i] = run_job(job)
+            print("Job %d of %d: %s %s (%.1f s)" %(i+1, len(jobs), results[i]['fname_prefix'], results[i]['status'], results[i]['wall_time']))
+
+    summary_df = pd.DataFrame(results, columns=['base_directory', 'fname_prefix', 'options', 'status', 'error',
+                                                'wall_time', 'cpu_time', 'worker', 'outputs', 'log'])
+    if summary_fname:
+        summary_df.to_csv(summary_fname, index=False)
+    print("Finished %d jobs, %d failed" %(len(summary_df), (summary_df['status'] != 'ok').sum()))
+
+    return summary_df
+
+def read_jobs(job_fname):
+    """
+    Read the job list csv
+
+    Returns:
+        list of dicts with the base_directory, fname_prefix and options of each job
+
+    Author: FJC
+    """
+    job_df = pd.read_csv(job_fname, dtype=str, keep_default_na=False)
+    for col in ['base_directory', 'fname_prefix']:
+        if col not in job_df.columns:
+            raise ValueError("The job list "+job_fname+" needs a "+col+" column")
+    if 'options' not in job_df.columns:
+        job_df['options'] = ''
+    return job_df.to_dict('records')
+
+#=============================================================================
+# This is the main function that runs the whole thing
+#=============================================================================
+def main(argv):
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-jobs", "--job_list", type=str, help="The CSV with the jobs, with the columns base_directory, fname_prefix and (optionally) options")
+    parser.add_argument("-nw", "--n_workers", type=int, default=1, help="The number of worker processes to run the jobs. Default = 1 (run them one after the other)")
+    parser.add_argument("-out", "--summary_fname", type=str, default='batch_summary.csv', help="The CSV to write the summary of the jobs to. Default = batch_summary.csv")
+    args = parser.parse_args(argv)
+
+    if not args.job_list:
+        print("WARNING! You haven't supplied a job list. Please specify this with the flag '-jobs'")
+        sys.exit()
+
+    run_batch(read_jobs(args.job_list), n_workers=args.n_workers, summary_fname=args.summary_fname)
+
+#=============================================================================
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,8 @@
+#------------------------------------------------------------------------------#
+# terrace-long-profiler
+# Benchmarks for the terrace analysis. synthetic makes deterministic synthetic
+# valleys, terraces, polygons and rasters of any size, and run_benchmarks times
+# the main stages of the analysis on them and compares the results with the
+# stored baselines. See run_benchmarks.py for how to run them.
+# Authors: F. Clubb
+#------------------------------------------------------------------------------#
@@ -0,0 +1,112 @@
+#------------------------------------------------------------------------------#
+# terrace-long-profiler
+# Benchmark for the time it takes to import the modules and to show the help of
+# make_terrace_plots. Each import is timed in a fresh python process. As the
+# times depend on the machine, the benchmark also checks that the slow packages
+# (scipy, fiona, shapely, GDAL...) aren't imported until they are needed, which
+# is what keeps the start up fast. Exits with 1 if any check fails.
+# Run from the repository directory:
+#     python benchmarks/bench_import_time.py
+# Authors: F. Clubb
+#------------------------------------------------------------------------------#
+
+# import modules
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the code to run, the packages that it shouldn't import, and the most time it should take (s).
+# mplot3d isn't checked as newer versions of matplotlib import it with pyplot.
+CHECKS = [
+    {'name': 'make_terrace_plots -h',
+     'code': "import make_terrace_plots\ntry:\n    make_terrace_plots.main(['-h'])\nexcept SystemExit:\n    pass",
+     'not_imported': ['pandas', 'matplotlib', 'scipy', 'fiona', 'shapely'], 'max_time': 0.5},
+    {'name': 'import LSDPlottingTools', 'code': "import LSDPlottingTools",
+     'not_imported': ['osgeo', 'pyproj', 'shapely', 'matplotlib', 'scipy'], 'max_time': 0.2},
+    {'name': 'import LSDMapFigure', 'code': "import LSDMapFigure",
+     'not_imported': ['osgeo', 'pyproj', 'shapely', 'matplotlib'], 'max_time': 0.2},
+    {'name': 'import TerracePlotter', 'code': "import TerracePlotter",
+     'not_imported': ['scipy.signal', 'scipy.stats', 'fiona', 'shapely'], 'max_time': 2.},
+    {'name': 'import TerraceIO', 'code': "import TerraceIO",
+     'not_imported': ['scipy.signal', 'scipy.stats', 'fiona', 'shapely'], 'max_time': 2.},
+    {'name': 'import TerracePipeline', 'code': "import TerracePipeline",
+     'not_imported': ['scipy.signal', 'scipy.stats', 'fiona', 'shapely'], 'max_time': 2.},
+]
+
+# this is run in the fresh process: it times the code and lists the modules it imported
+TIMER = """
+import sys, time, json, io
+sys.path.insert(0, {repo_dir!r})
+start_time = time.perf_counter()
+stdout = sys.stdout
+sys.stdout = io.StringIO()
+exec({code!r})
+sys.stdout = stdout
+print(json.dumps({{'time': time.perf_counter() - start_time, 'modules': sorted(sys.modules)}}))
+"""
+
+def time_import(code, n_repeats=3):
+    """
+    Time some code in fresh python processes, taking the fastest of n_repeats
+
+    Returns:
+        the time (s) and the list of modules that were imported
+
+    Author: FJC
+    """
+    best = None
+    for i in range(n_repeats):
+        output = subprocess.check_output([sys.executable, '-c', TIMER.format(repo_dir=repo_dir, code=code)], cwd=repo_dir)
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        if best is None or result['time'] < best['time']:
+            best = result
+    return best['time'], best['modules']
+
+def run_checks(n_repeats=3, time_scale=1.):
+    """
+    Run all the checks
+
+    Args:
+        n_repeats (int): the number of times to time each import
+        time_scale: multiply the time limits by this, for slow machines
+
+    Returns:
+        list of dicts with the results, and True if all the checks passed
+
+    Author: FJC
+    """
+    results = []
+    all_passed = True
+    for check in CHECKS:
+        try:
+            import_time, modules = time_import(check['code'], n_repeats)
+        except subprocess.CalledProcessError:
+            # e.g. a package that is needed at import time isn't installed
+            results.append({'name': check['name'], 'time': float('nan'), 'max_time': check['max_time']*time_scale,
+                            'slow_imports': ['(import failed)'], 'passed': False})
+            all_passed = False
+            continue
+        # a package counts as imported if it or any of its submodules are
+        imported = [name for name in check['not_imported'] if any(m == name or m.startswith(name+'.') for m in modules)]
+        passed = not imported and import_time <= check['max_time']*time_scale
+        all_passed = all_passed and passed
+        results.append({'name': check['name'], 'time': import_time, 'max_time': check['max_time']*time_scale,
+                        'slow_imports': imported, 'passed': passed})
+    return results, all_passed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--n_repeats", type=int, default=3, help="The number of times to time each import (the fastest is used). Default = 3")
+    parser.add_argument("-scale", "--time_scale", type=float, default=1., help="Multiply the time limits by this, for slow machines. Default = 1")
+    args = parser.parse_args()
+
+    results, all_passed = run_checks(args.n_repeats, args.time_scale)
+    for result in results:
+        print("%-26s %6.3f s (limit %5.2f s) %s%s" %(result['name'], result['time'], result['max_time'],
+                                                  'ok' if result['passed'] else 'FAILED',
+                                                  '' if not result['slow_imports'] else ', imported '+', '.join(result['slow_imports'])))
+    sys.exit(0 if all_passed else 1)
@@ -0,0 +1,93 @@
+#------------------------------------------------------------------------------#
+# terrace-long-profiler
+# Benchmark for fitting paleo long profiles to groups of terraces. Makes a
+# synthetic valley with a few levels of terraces along an exponential modern
+# channel, then times the fitting of every candidate group of terraces.
+# Run from the repository directory:
+#     python benchmarks/bench_profile_fitting.py -n 100 200 400 800
+# Authors: F. Clubb
+#------------------------------------------------------------------------------#
+
+# import modules
+import numpy as np
+import pandas as pd
+import argparse
+import time
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import TerraceProfileFitter
+
+def make_synthetic_valley(n_terraces, levels=(5., 15., 30.), valley_length=60., noise=0.5, seed=0):
+    """
+    Make the summary of the terraces in a synthetic valley. The modern channel is
+    z = 100 + 200*exp(-0.05*x), and the terraces are at a few heights above it.
+
+    Args:
+        n_terraces (int): the number of terraces
+        levels: the heights of the terrace levels above the modern channel (m)
+        valley_length: the length of the valley (km)
+        noise: the standard deviation of the terrace elevations about their level (m)
+        seed: the seed for the random numbers
+
+    Returns:
+        dataframe like TerracePlotter.get_terrace_summary, with the true level of each terrace
+
+    Author: FJC
+    """
+    rng = np.random.RandomState(seed)
+    level = rng.randint(len(levels), size=n_terraces)
+    x = rng.uniform(0, valley_length, n_terraces)
+    relief = np.asarray(levels)[level] + rng.normal(0, noise, n_terraces)
+    z = 100 + 200*np.exp(-0.05*x) + relief
+    return pd.DataFrame({'new_ID': np.arange(1, n_terraces+1), 'flow_dist': x, 'mean_elevation': z,
+                         'std_elevation': rng.uniform(0.2, 2, n_terraces), 'mean_relief': relief,
+                         'n_pixels': rng.randint(10, 5000, n_terraces), 'true_level': level})
+
+def run_benchmark(sizes, n_workers=1, max_terraces=None, noise=0.5, n_residual_fits=1000):
+    """
+    Time the fitting for each number of terraces and check that the levels are found
+
+    Returns:
+        dataframe with the timings
+
+    Author: FJC
+    """
+    results = []
+    for n in sizes:
+        summary_df = make_synthetic_valley(n, noise=noise)
+        start_time = time.time()
+        fits, order = TerraceProfileFitter.fit_paleo_profiles(summary_df, max_terraces=max_terraces, n_workers=n_workers)
+        fit_time = time.time() - start_time
+
+        # the residuals of every terrace in the best groups
+        start_time = time.time()
+        residuals = TerraceProfileFitter.get_fit_residuals(summary_df, fits.head(n_residual_fits), order)
+        residual_time = time.time() - start_time
+
+        # the picked profiles should each contain one level of terraces
+        profiles = TerraceProfileFitter.select_profiles(fits, max_rmse=3*noise, n_profiles=3)
+        purity = []
+        for start, stop in zip(profiles['start'].values, profiles['stop'].values):
+            levels = summary_df['true_level'].values[order[start:stop]]
+            purity.append(np.bincount(levels).max()/float(len(levels)))
+
+        results.append({'n_terraces': n, 'n_groups': len(fits), 'fit_time': fit_time,
+                        'groups_per_second': len(fits)/max(fit_time, 1e-9),
+                        'residual_time': residual_time, 'n_residuals': len(residuals),
+                        'n_profiles': len(profiles), 'min_purity': min(purity) if purity else np.nan})
+    return pd.DataFrame(results)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--n_terraces", type=int, nargs='+', default=[100, 200, 400, 800], help="The numbers of terraces in the synthetic valleys")
+    parser.add_argument("-nw", "--n_workers", type=int, default=1, help="The number of worker processes for the fitting. Default = 1")
+    parser.add_argument("-max", "--max_terraces", type=int, default=None, help="The most terraces in a group. Default = all of them")
+    parser.add_argument("-out", "--out_fname", type=str, default=None, help="If given, write the timings to this csv")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.n_terraces, args.n_workers, args.max_terraces)
+    print(results.to_string(index=False))
+    if args.out_fname:
+        results.to_csv(args.out_fname, index=False)
@@ -0,0 +1,321 @@
+#------------------------------------------------------------------------------#
+# terrace-long-profiler
+# Times the main stages of the terrace analysis on synthetic valleys of
+# different sizes, and compares the results and times with the baselines
+# stored in baselines.json. The results should always match (they are
+# deterministic), so a mismatch is a failure. The times depend on the machine,
+# so slower times are only reported.
+#
+# The stages are the distance along the baseline, the terrace summaries and
+# binned profiles (grouped statistics), the dip and dip direction, the heat map,
+# filtering the pixels by the terrace polygons (needs shapely, and rasterio for
+# the raster lookup), reading rasters (needs rasterio and/or GDAL) and the
+# memory of the terrace table with the default and the smaller types. Stages
+# whose packages aren't installed are skipped. 10^7 points and more need a lot of memory (about 1 GB for every
+# 10^7 points).
+#
+# Run from the repository directory:
+#     python benchmarks/run_benchmarks.py -n 1e4 1e5 1e6
+# and to store the results as the new baselines:
+#     python benchmarks/run_benchmarks.py -n 1e4 1e5 1e6 -save True
+# Authors: F. Clubb
+#------------------------------------------------------------------------------#
+
+# import modules
+import argparse
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import pandas as pd
+
+from benchmarks import synthetic
+from LSDPlottingTools import instrumentation
+import TerracePlotter
+import TerraceIO
+
+baseline_fname = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+def package_available(name):
+    """
+    Check if a package can be imported
+    """
+    try:
+        importlib.import_module(name)
+        return True
+    except ImportError:
+        return False
+
+#=============================================================================
+# The benchmarks. Each one takes the synthetic data and a directory for any
+# files, and returns a dict of numbers that summarise its results.
+#=============================================================================
+def get_projected_terraces(data):
+    """
+    Get the terraces with the distance along the baseline, for the benchmarks that need it.
+    This is called before the benchmark is timed, so the time doesn't include the projection.
+    """
+    if 'DistAlongBaseline_new' not in data['terraces'].columns:
+        data['terraces'] = TerracePlotter.get_distance_along_baseline_points(data['terraces'], data['baseline'])
+    return data['terraces']
+
+def bench_distance_along_baseline(data, work_dir):
+    terraces = TerracePlotter.get_distance_along_baseline_points(data['terraces'], data['baseline'])
+    data['terraces'] = terraces
+    return {'mean_dist': float(terraces['DistAlongBaseline_new'].mean()),
+            'mean_offset': float(terraces['DistToBaseline_new'].mean()),
+            'mean_side': float(terraces['BaselineSide'].mean())}
+
+def bench_terrace_summary(data, work_dir):
+    summary_df = TerracePlotter.get_terrace_summary(get_projected_terraces(data))
+    return {'n_terraces': len(summary_df), 'sum_mean_elevation': float(summary_df['mean_elevation'].sum()),
+            'sum_flow_dist': float(summary_df['flow_dist'].sum()), 'sum_area': float(summary_df['area'].sum())}
+
+def bench_binned_profiles(data, work_dir):
+    profile_df = TerracePlotter.get_binned_profiles(get_projected_terraces(data))
+    return {'n_bins': len(profile_df), 'sum_median_elevation': float(profile_df['median_elevation'].sum()),
+            'sum_p75_elevation': float(profile_df['p75_elevation'].sum())}
+
+def bench_dip_and_dipdir(data, work_dir):
+    dips = TerracePlotter.get_terrace_dip_and_dipdir(data['terraces'])
+    return {'n_terraces': len(dips), 'mean_dip': float(dips['dip'].mean()),
+            'mean_dip_azimuth': float(dips['dip_azimuth'].mean())}
+
+def get_outlier_terraces(data):
+    """
+    Get the terraces with some outliers for the robust plane fits. This is also called
+    before the benchmark is timed.
+    """
+    if 'outlier_terraces' not in data:
+        data['outlier_terraces'] = synthetic.add_outliers(data['terraces'])
+    return data['outlier_terraces']
+
+def bench_robust_planes(data, method):
+    dips = TerracePlotter.get_terrace_dip_and_dipdir(get_outlier_terraces(data), fit_method=method)
+    return {'n_terraces': len(dips), 'mean_dip': float(dips['dip'].mean()),
+            'mean_dip_azimuth': float(dips['dip_azimuth'].mean()),
+            'mean_inlier_fraction': float(dips['inlier_fraction'].mean())}
+
+def bench_huber_planes(data, work_dir):
+    return bench_robust_planes(data, 'huber')
+
+def bench_ransac_planes(data, work_dir):
+    return bench_robust_planes(data, 'ransac')
+
+def bench_heat_map(data, work_dir):
+    TerracePlotter.MakeTerraceHeatMap(work_dir, 'bench', kde_method='binned', terrace_df=get_projected_terraces(data), lp=data['baseline'])
+    return {'n_files': int(os.path.isfile(os.path.join(work_dir, 'bench_terrace_plot_heat_map.png')))}
+
+def bench_filter_points(data, work_dir):
+    # the point in polygon test from filter_points_by_shapefile.py
+    import filter_points_by_shapefile
+    polygons = synthetic.make_polygons(data['outlines'])
+    polygon_index = filter_points_by_shapefile.get_polygon_index(data['terraces']['X'].values, data['terraces']['Y'].values, polygons)
+    keep = polygon_index >= 0
+    return {'n_tested': len(polygon_index), 'n_kept': int(keep.sum()), 'sum_ids': int(polygon_index[keep].sum())}
+
+def bench_filter_points_raster(data, work_dir):
+    # the raster label lookup from filter_points_by_shapefile.py, on a grid with a cell
+    # centred on each pixel. The results should be the same as filter_points.
+    import filter_points_by_shapefile
+    from rasterio.transform import Affine
+    X = data['terraces']['X'].values
+    Y = data['terraces']['Y'].values
+    res = 5.
+    transform = Affine(res, 0., X.min() - res/2, 0., -res, Y.max() + res/2)
+    out_shape = (int(round((Y.max() - Y.min())/res)) + 1, int(round((X.max() - X.min())/res)) + 1)
+    polygons = synthetic.make_polygons(data['outlines'])
+    polygon_index = filter_points_by_shapefile.get_raster_polygon_index(X, Y, polygons, transform, out_shape)
+    keep = polygon_index >= 0
+    return {'n_tested': len(polygon_index), 'n_kept': int(keep.sum()), 'sum_ids': int(polygon_index[keep].sum())}
+
+def bench_read_raster(data, work_dir):
+    # write a raster with the same number of cells as there are points, and read it back. The
+    # time includes writing the raster, the read on its own is in the read_raster_rasterio stage.
+    array, x_min, y_max = synthetic.make_raster(data['n_points'])
+    results = {'n_cells': int(array.size)}
+    if package_available('rasterio'):
+        import rasterio
+        fname = os.path.join(work_dir, 'bench_relief.tif')
+        synthetic.write_geotiff(fname, array, x_min, y_max)
+        with instrumentation.stage('read_raster_rasterio', rows=array.size):
+            with rasterio.open(fname) as src:
+                relief = src.read(1, masked=True)
+        results['rasterio_sum'] = float(relief.sum())
+    if package_available('osgeo'):
+        from LSDPlottingTools import LSDMap_GDALIO
+        fname = os.path.join(work_dir, 'bench_relief.bil')
+        synthetic.write_envi_raster(fname, array, x_min, y_max)
+        relief = LSDMap_GDALIO.ReadRasterArrayBlocks(fname)
+        results['gdal_sum'] = float(np.nansum(relief))
+    return results
+
+def bench_typed_loading(data, work_dir):
+    # the memory of the terrace table with the default types and with TerraceIO.downcast_table.
+    # The time includes writing the csv.
+    fname_stem = os.path.join(work_dir, 'bench_terrace_info')
+    TerraceIO.write_table(data['terraces'][['X', 'Y', 'Elevation', 'new_ID', 'TerraceID', 'ChannelRelief', 'DistAlongBaseline',
+                                            'DistToBaseline', 'BaselineNode']], fname_stem)
+    default_mb = TerraceIO.get_table_memory(TerraceIO.load_table(fname_stem))
+    terraces = TerraceIO.load_table(fname_stem, typed=True)
+    return {'default_mb': default_mb, 'typed_mb': TerraceIO.get_table_memory(terraces),
+            'n_float32': int(sum(dtype == np.float32 for dtype in terraces.dtypes))}
+
+# the benchmarks that need the distance along the baseline
+PROJECTED_BENCHMARKS = ['terrace_summary', 'binned_profiles', 'heat_map']
+# the benchmarks that need the terraces with outliers
+OUTLIER_BENCHMARKS = ['huber_planes', 'ransac_planes']
+
+# the name of each benchmark, its function and the packages it needs
+BENCHMARKS = [
+    ('distance_along_baseline', bench_distance_along_baseline, ['scipy']),
+    ('terrace_summary', bench_terrace_summary, []),
+    ('binned_profiles', bench_binned_profiles, []),
+    ('dip_and_dipdir', bench_dip_and_dipdir, []),
+    ('huber_planes', bench_huber_planes, []),
+    ('ransac_planes', bench_ransac_planes, []),
+    ('heat_map', bench_heat_map, ['scipy']),
+    ('filter_points', bench_filter_points, ['shapely']),
+    ('filter_points_raster', bench_filter_points_raster, ['shapely', 'rasterio']),
+    ('read_raster', bench_read_raster, []),
+    ('typed_loading', bench_typed_loading, []),
+]
+
+#=============================================================================
+# Running and comparing
+#=============================================================================
+def compare_results(results, baseline_results, rtol=1e-6):
+    """
+    Check the results of a benchmark against the baseline
+
+    Returns:
+        'ok', 'new' if there is no baseline, or 'MISMATCH' with the names of the numbers that differ
+
+    Author: FJC
+    """
+    if baseline_results is None:
+        return 'new'
+    different = [key for key in set(results) | set(baseline_results)
+                 if key not in results or key not in baseline_results
+                 or not np.isclose(results[key], baseline_results[key], rtol=rtol, atol=0)]
+    if different:
+        return 'MISMATCH: '+', '.join(sorted(different))
+    return 'ok'
+
+def run_benchmarks(sizes, names=None, baselines=None, work_dir=None, slow_factor=2., seed=0):
+    """
+    This function runs the benchmarks for each number of points.
+
+    Args:
+        sizes: list of the numbers of terrace points
+        names: list of the benchmarks to run. Default = all of them
+        baselines: dict of the stored baselines to compare with
+        work_dir (str): the directory for the files that the benchmarks write. Default = a temporary directory
+        slow_factor: report a benchmark as slower if it takes this many times as long as the baseline
+        seed: the seed for the synthetic data
+
+    Returns:
+        dataframe with the time, memory and results of each benchmark, and
+        the results in the format of the baselines
+
+    Author: FJC
+    """
+    baselines = baselines or {}
+    temp_dir = None
+    if work_dir is None:
+        work_dir = temp_dir = tempfile.mkdtemp(prefix='terrace_bench_')
+    else:
+        os.makedirs(work_dir, exist_ok=True)
+    work_dir = os.path.join(work_dir, '')
+
+    rows = []
+    new_baselines = {}
+    try:
+        for n_points in sizes:
+            baseline = synthetic.make_baseline(seed=seed)
+            terraces, outlines = synthetic.make_terraces(baseline, n_points, seed=seed)
+            data = {'baseline': baseline, 'terraces': terraces, 'outlines': outlines, 'n_points': n_points}
+            print("%d points, %d terraces" %(n_points, len(outlines)))
+
+            for name, function, packages in BENCHMARKS:
+                if names and name not in names:
+                    continue
+                missing = [package for package in packages if not package_available(package)]
+                if missing:
+                    print("    %-24s skipped, needs %s" %(name, ', '.join(missing)))
+                    continue
+
+                if name in PROJECTED_BENCHMARKS:
+                    get_projected_terraces(data)
+                if name in OUTLIER_BENCHMARKS:
+                    get_outlier_terraces(data)
+                with instrumentation.stage(name, rows=n_points) as record:
+                    results = function(data, work_dir)
+                stored = baselines.get(name, {}).get(str(n_points))
+                status = compare_results(results, stored['results'] if stored else None)
+                time_ratio = record['wall_time']/stored['wall_time'] if stored else np.nan
+                if status == 'ok' and time_ratio > slow_factor:
+                    status = 'slower'
+                print("    %-24s %8.3f s  %+6.0f MB peak  %s" %(name, record['wall_time'], _or_nan(record['peak_rss_increase_mb']), status))
+
+                rows.append({'benchmark': name, 'n_points': n_points, 'wall_time': record['wall_time'],
+                             'cpu_time': record['cpu_time'], 'rss_change_mb': _or_nan(record['rss_change_mb']),
+                             'peak_rss_increase_mb': _or_nan(record['peak_rss_increase_mb']),
+                             'baseline_time': stored['wall_time'] if stored else np.nan,
+                             'time_ratio': time_ratio, 'status': status})
+                new_baselines.setdefault(name, {})[str(n_points)] = {'wall_time': record['wall_time'], 'results': results}
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return pd.DataFrame(rows), new_baselines
+
+def _or_nan(value):
+    return np.nan if value is None else value
+
+def read_baselines(fname):
+    """
+    Read the stored baselines, or an empty dict if there aren't any
+    """
+    if not os.path.isfile(fname):
+        return {}
+    with open(fname) as f:
+        return json.load(f)
+
+def write_baselines(fname, baselines, new_baselines):
+    """
+    Add the new results to the stored baselines and write them
+    """
+    for name, sizes in new_baselines.items():
+        baselines.setdefault(name, {}).update(sizes)
+    with open(fname, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--n_points", type=float, nargs='+', default=[1e4, 1e5, 1e6], help="The numbers of terrace points, e.g. 1e4 1e5 1e6. Default = 1e4 1e5 1e6")
+    parser.add_argument("-b", "--benchmarks", type=str, nargs='+', default=None, help="The benchmarks to run: "+', '.join(name for name, _, _ in BENCHMARKS)+". Default = all of them")
+    parser.add_argument("-baselines", "--baseline_fname", type=str, default=baseline_fname, help="The json file with the stored baselines. Default = benchmarks/baselines.json")
+    parser.add_argument("-save", "--save_baselines", type=bool, default=False, help="If this is true, I'll store the results as the new baselines")
+    parser.add_argument("-slow", "--slow_factor", type=float, default=2., help="Report a benchmark as slower if it takes this many times as long as the baseline. Default = 2")
+    parser.add_argument("-dir", "--work_dir", type=str, default=None, help="The directory for the files that the benchmarks write. Default = a temporary directory")
+    parser.add_argument("-out", "--out_fname", type=str, default=None, help="If given, write the timings to this csv")
+    args = parser.parse_args()
+
+    baselines = read_baselines(args.baseline_fname)
+    results, new_baselines = run_benchmarks([int(n) for n in args.n_points], args.benchmarks, baselines, args.work_dir,
+                                            args.slow_factor)
+    print(results.to_string(index=False))
+    if args.out_fname:
+        results.to_csv(args.out_fname, index=False)
+    if args.save_baselines:
+        write_baselines(args.baseline_fname, baselines, new_baselines)
+        print("Stored the baselines in "+args.baseline_fname)
+    sys.exit(1 if len(results) and results['status'].str.startswith('MISMATCH').any() else 0)
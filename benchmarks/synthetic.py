@@ -0,0 +1,229 @@
+#------------------------------------------------------------------------------#
+# terrace-long-profiler
+# Deterministic synthetic data for the benchmarks: a sinuous valley baseline,
+# clouds of terrace pixels along it with the same columns as the
+# _terrace_info.csv from LSDTopoTools, polygons around the terraces like the
+# digitised terrace shapefiles, and rasters of any size. The same arguments
+# always give the same data, so the results can be compared between runs.
+# Authors: F. Clubb
+#------------------------------------------------------------------------------#
+
+# import modules
+import numpy as np
+import pandas as pd
+
+def make_baseline(n_nodes=2000, valley_length=50000., amplitude=800., wavelength=8000., outlet_elevation=100., gradient=0.002, seed=0):
+    """
+    Make a sinuous valley baseline, running from the outlet at X = 0 up the valley.
+    The baseline is the sum of two sine waves, with a random phase for the second
+    one so that the meanders aren't all the same.
+
+    Args:
+        n_nodes (int): the number of nodes along the baseline
+        valley_length: the straight line length of the valley (m)
+        amplitude: the amplitude of the meanders (m)
+        wavelength: the wavelength of the meanders (m)
+        outlet_elevation: the elevation of the channel at the outlet (m)
+        gradient: the gradient of the channel
+        seed: the seed for the random numbers
+
+    Returns:
+        dataframe like the _baseline_channel_info.csv, with X, Y, Elevation and DistFromOutlet
+
+    Author: FJC
+    """
+    rng = np.random.RandomState(seed)
+    phase = rng.uniform(0, 2*np.pi)
+    x = np.linspace(0, valley_length, n_nodes)
+    y = amplitude*np.sin(2*np.pi*x/wavelength) + 0.25*amplitude*np.sin(6*np.pi*x/wavelength + phase)
+    dist = np.concatenate([[0.], np.cumsum(np.hypot(np.diff(x), np.diff(y)))])
+    return pd.DataFrame({'X': x, 'Y': y, 'Elevation': outlet_elevation + gradient*dist, 'DistFromOutlet': dist})
+
+def make_terraces(baseline, n_points, n_terraces=None, pixels_per_terrace=2000, levels=(5., 15., 30.), res=5., noise=0.5, seed=0):
+    """
+    Make the pixels of the terraces along a baseline. Each terrace is an ellipse
+    of pixels on a res grid, next to a random node of the baseline and lined up
+    with the valley. The terrace surface is a plane at one of the levels above the
+    channel, dipping down the valley with the channel, plus some noise.
+
+    Args:
+        baseline: the dataframe from make_baseline
+        n_points (int): the number of terrace pixels
+        n_terraces (int): the number of terraces. Default = n_points/pixels_per_terrace
+        pixels_per_terrace (int): the mean number of pixels in each terrace, if n_terraces isn't given
+        levels: the heights of the terrace levels above the channel (m)
+        res: the resolution of the DEM (m)
+        noise: the standard deviation of the pixel elevations about the terrace surface (m)
+        seed: the seed for the random numbers
+
+    Returns:
+        dataframe like the _terrace_info.csv, and a dataframe with the centre, size and
+        orientation of each terrace (for make_polygons)
+
+    Author: FJC
+    """
+    rng = np.random.RandomState(seed)
+    if n_terraces is None:
+        n_terraces = max(1, int(n_points // pixels_per_terrace))
+    bx = baseline['X'].values
+    by = baseline['Y'].values
+    bz = baseline['Elevation'].values
+    n_nodes = len(bx)
+
+    # the shape and position of each terrace. The direction of the valley is from the nodes either side.
+    node = rng.randint(1, n_nodes-1, size=n_terraces)
+    angle = np.arctan2(by[node+1] - by[node-1], bx[node+1] - bx[node-1])
+    half_length = rng.uniform(200, 1500, n_terraces)
+    half_width = rng.uniform(50, 300, n_terraces)
+    offset = rng.choice([-1., 1.], n_terraces)*(half_width + rng.uniform(50, 1000, n_terraces))
+    centre_x = bx[node] - offset*np.sin(angle)
+    centre_y = by[node] + offset*np.cos(angle)
+    relief = np.asarray(levels)[rng.randint(len(levels), size=n_terraces)] + rng.normal(0, 1, n_terraces)
+    gradient = (bz[node+1] - bz[node-1])/np.hypot(bx[node+1] - bx[node-1], by[node+1] - by[node-1])
+    cross_slope = rng.normal(0, 0.005, n_terraces)
+
+    # the pixels, spread evenly over each ellipse
+    ids = rng.randint(n_terraces, size=n_points)
+    r = np.sqrt(rng.uniform(0, 1, n_points))
+    theta = rng.uniform(0, 2*np.pi, n_points)
+    u = half_length[ids]*r*np.cos(theta)
+    v = half_width[ids]*r*np.sin(theta)
+    cos_a = np.cos(angle[ids])
+    sin_a = np.sin(angle[ids])
+    X = np.round((centre_x[ids] + u*cos_a - v*sin_a)/res)*res
+    Y = np.round((centre_y[ids] + u*sin_a + v*cos_a)/res)*res
+    channel = bz[node][ids] + gradient[ids]*u
+    Z = channel + relief[ids] + cross_slope[ids]*v + rng.normal(0, noise, n_points)
+
+    terraces = pd.DataFrame({'X': X, 'Y': Y, 'Elevation': Z, 'new_ID': ids+1, 'TerraceID': ids+1,
+                             'ChannelRelief': Z - channel, 'DistAlongBaseline': baseline['DistFromOutlet'].values[node][ids],
+                             'DistToBaseline': np.abs(offset)[ids], 'BaselineNode': node[ids]})
+    outlines = pd.DataFrame({'new_ID': np.arange(1, n_terraces+1), 'X': centre_x, 'Y': centre_y,
+                             'half_length': half_length, 'half_width': half_width, 'angle': angle, 'relief': relief})
+    return terraces, outlines
+
+def add_outliers(terraces, fraction=0.1, min_height=2., max_height=20., seed=0):
+    """
+    Raise a random fraction of the terrace pixels above the terrace surface, like
+    the pixels of the risers and hillslopes that get picked up with the terraces.
+    These are the pixels that the robust plane fits should ignore.
+
+    Args:
+        terraces: the dataframe from make_terraces
+        fraction: the fraction of the pixels to raise
+        min_height, max_height: the range of heights to raise them by (m)
+        seed: the seed for the random numbers
+
+    Returns:
+        a copy of the dataframe with the outliers
+
+    Author: FJC
+    """
+    rng = np.random.RandomState(seed)
+    outliers = rng.uniform(0, 1, len(terraces)) < fraction
+    terraces = terraces.copy()
+    Z = terraces['Elevation'].values.copy()
+    Z[outliers] += rng.uniform(min_height, max_height, outliers.sum())
+    terraces['Elevation'] = Z
+    return terraces
+
+def make_polygons(outlines, scale=0.9, n_vertices=64):
+    """
+    Make a polygon for each terrace, like the digitised terrace shapefiles. The
+    polygons are a bit smaller than the terraces (scale < 1), so that filtering the
+    pixels by the polygons removes the pixels around the edges.
+
+    Args:
+        outlines: the dataframe of terrace outlines from make_terraces
+        scale: the size of the polygons compared to the terraces
+        n_vertices (int): the number of vertices of each polygon
+
+    Returns:
+        list of shapely polygons, in the order of the outlines
+
+    Author: FJC
+    """
+    from shapely.geometry import Polygon
+
+    theta = np.linspace(0, 2*np.pi, n_vertices, endpoint=False)
+    polygons = []
+    for row in outlines.itertuples():
+        u = scale*row.half_length*np.cos(theta)
+        v = scale*row.half_width*np.sin(theta)
+        polygons.append(Polygon(np.column_stack([row.X + u*np.cos(row.angle) - v*np.sin(row.angle),
+                                                 row.Y + u*np.sin(row.angle) + v*np.cos(row.angle)])))
+    return polygons
+
+def make_raster(n_cells, res=5., nodata=-9999., seed=0):
+    """
+    Make a square raster of terrace relief with about n_cells cells: a smooth
+    surface made from a few sine waves plus some noise, with no data around the
+    edges like a raster that has been masked to the valley.
+
+    Args:
+        n_cells (int): the number of cells
+        res: the resolution (m)
+        nodata: the no data value
+        seed: the seed for the random numbers
+
+    Returns:
+        the float32 array, and the x and y of the top left corner
+
+    Author: FJC
+    """
+    rng = np.random.RandomState(seed)
+    n = max(2, int(round(np.sqrt(n_cells))))
+    yy, xx = np.mgrid[0:n, 0:n].astype(np.float32)/n
+    relief = 15 + 10*np.sin(2*np.pi*3*xx)*np.cos(2*np.pi*2*yy) + rng.normal(0, 0.5, (n, n)).astype(np.float32)
+    # no data outside an ellipse
+    relief[(xx - 0.5)**2/0.45**2 + (yy - 0.5)**2/0.3**2 > 1] = nodata
+    return relief.astype(np.float32), 0., n*res
+
+def write_envi_raster(fname, array, x_min, y_max, res=5., nodata=-9999.):
+    """
+    Write a float32 array to an ENVI .bil raster with a .hdr, which is the format
+    that LSDTopoTools writes. This only needs numpy.
+
+    Args:
+        fname (str): the name of the raster, ending in .bil
+        array: the array
+        x_min, y_max: the coordinates of the top left corner
+        res: the resolution (m)
+        nodata: the no data value
+
+    Author: FJC
+    """
+    array.astype('<f4').tofile(fname)
+    with open(fname[:-3]+'hdr', 'w') as f:
+        f.write('ENVI\n')
+        f.write('samples = %d\n' %array.shape[1])
+        f.write('lines = %d\n' %array.shape[0])
+        f.write('bands = 1\n')
+        f.write('header offset = 0\n')
+        f.write('file type = ENVI Standard\n')
+        f.write('data type = 4\n')
+        f.write('interleave = bsq\n')
+        f.write('byte order = 0\n')
+        f.write('map info = {UTM, 1, 1, %f, %f, %f, %f, 15, North, WGS-84}\n' %(x_min, y_max, res, res))
+        f.write('data ignore value = %g\n' %nodata)
+
+def write_geotiff(fname, array, x_min, y_max, res=5., nodata=-9999.):
+    """
+    Write a float32 array to a tiled, compressed GeoTIFF (needs rasterio)
+
+    Args:
+        fname (str): the name of the raster
+        array: the array
+        x_min, y_max: the coordinates of the top left corner
+        res: the resolution (m)
+        nodata: the no data value
+
+    Author: FJC
+    """
+    import rasterio
+    from rasterio.transform import Affine
+
+    with rasterio.open(fname, 'w', driver='GTiff', height=array.shape[0], width=array.shape[1], count=1,
+                       dtype='float32', nodata=nodata, transform=Affine(res, 0., x_min, 0., -res, y_max),
+                       tiled=True, blockxsize=256, blockysize=256, compress='deflate') as dst:
+        dst.write(array, 1)
@@ -1,76 +1,645 @@
-# script to filter the csv file to remove any points which are not within the shapefile boundary.
-# Also masks the terrace relief raster to the shapefile.
+# Script to filter the terrace pixels of each reach to remove any points which are not within the digitised terrace
+# polygons, and to give each point the ID of its polygon. Also masks the terrace relief raster to the polygons.
+#
+# The reaches are the sub-directories of the data directory that match a pattern. Each reach directory has the
+# files <reach>_terraces.shp (the polygons), <reach>_final_terrace_info.csv (the points) and
+# <reach>_final_terrace_relief_final.bil (the relief raster), and this writes <reach>_final_terrace_info_filtered.csv
+# and <reach>_terrace_relief_masked.tif. The points are read and written in chunks so the csv is never all in memory,
+# and the reaches can be run in a pool of worker processes.
+#
+# The points can be assigned to the polygons in two ways:
+#     geometry = test the points against the polygons. This is the default.
+#     raster = burn the polygons onto the grid of the relief raster and look up the cell of each point. This is
+#              faster, and the same grid is used to mask the relief raster, but it is only the same as geometry if
+#              the points are at the centres of the cells of the raster (-method raster).
+#
+# For long reaches, -windowed True burns the polygons onto the grid and masks the raster one block at a time and
+# writes the masked raster as a tiled, compressed GeoTIFF, so the memory is set by the block size and not by the
+# size of the reach.
+#
+# python filter_points_by_shapefile.py -dir /path/to/MississippiTerraces/ -reaches "UMV_DEM5m_*" -nw 4
+#-----------------------------------------------------------------------------------------#
+# FJC 22/01/21
 
+# import modules
 import numpy as np
 import pandas as pd
-from glob import glob
+import fnmatch
 import sys
-from shapely.geometry import shape, Point
-import fiona
 import os
-import rasterio
-import rasterio.mask
-
-#data_dir = '/home/fiona/MississippiTerraces/'
-data_dir = 'D:\\MississippiTerraces\\'
-
-subdirs = next(os.walk(data_dir))[1]
-
-for dir in subdirs:
-    print(dir)
-    if 'UMV_DEM5m_10' in dir:
-
-        # get the filename
-        s = dir.split('_')
-        print(s)
-        fname = 'UMV_DEM5m_'+s[2]
-        print(fname)
-
-        # get the shapefile as a polygon
-        c = fiona.open(data_dir+dir+'\\'+fname+'_terraces.shp')
-        shp_geom = []
-        new_ids = []
-        i = 0
-        for pol in c:
-            shp_geom.append(shape(pol['geometry']))
-            new_ids.append(i)
-            i+=1
-
-        # mask the relief raster to this geometry
-        with rasterio.open(data_dir+dir+'\\'+fname+'_final_terrace_relief_final.bil') as src:
-            out_image, out_transform = rasterio.mask.mask(src, shp_geom, crop=True)
-            out_meta = src.meta
-
-        # write to an output
-        out_meta.update({"driver": "GTiff",
-                     "height": out_image.shape[1],
-                     "width": out_image.shape[2],
-                     "transform": out_transform})
-
-        with rasterio.open(data_dir+dir+'\\'+fname+'_terrace_relief_masked.tif', "w", **out_meta) as dest:
-            dest.write(out_image)
-
-        #read in the points csv file
-        pts_csv = data_dir+dir+'\\'+fname+'_final_terrace_info.csv'
-        pts = []
-        df = pd.read_csv(pts_csv)
-
-        X = df.X.values
-        Y = df.Y.values
-        #nodes = df.node.values
-        keep_index = []
-        id_index = []
-        # find which points are within the shapefile
-        for i in range(len(X)):
-            sys.stdout.write("point %d of %d       \r" %(i, len(X)))
-            sys.stdout.flush()
-            point = Point(X[i], Y[i])
-            for j, this_shp in enumerate(shp_geom):
-                if (point.within(this_shp)):
-                    keep_index.append(i)
-                    id_index.append(new_ids[j])
-
-        output_df = df.loc[keep_index]
+import time
+
+#=============================================================================
+# Finding the polygon of each point
+#=============================================================================
+def get_polygon_query(polygons):
+    """
+    Get the function that finds the points in the polygons, for get_polygon_index.
+    Build this once if you are testing lots of chunks of points against the same
+    polygons.
+
+    Args:
+        polygons: list of shapely polygons
+
+    Returns:
+        function that takes arrays of x and y and returns the indices of the points
+        and of the polygons for each pair where the point is in the polygon
+
+    Author: FJC
+    """
+    import shapely
+    if hasattr(shapely, 'contains_xy'):
+        return _get_vectorized_query(polygons)
+    return _get_prepared_query(polygons)
+
+def get_polygon_index(X, Y, polygons, chunk_size=100000, query=None):
+    """
+    Find which polygon each point is in. The points are tested in chunks, with
+    one bulk query of an STRtree of the polygons for each chunk, rather than
+    testing every point against every polygon. Points on the boundary of a polygon
+    aren't in it, the same as Point.within.
+
+    If the polygons overlap, a point is given the lowest index of the polygons that
+    it is in, so the result doesn't depend on the order of the tests.
+
+    Args:
+        X: the x coordinates of the points
+        Y: the y coordinates of the points
+        polygons: list of shapely polygons
+        chunk_size (int): the number of points to test at once
+        query: the query from get_polygon_query, if it has already been built
+
+    Returns:
+        array with the index of the polygon that each point is in, or -1 for points
+        that aren't in any of the polygons
+
+    Author: FJC
+    """
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    polygon_index = np.full(len(X), -1, dtype=np.int64)
+    if len(X) == 0 or len(polygons) == 0:
+        return polygon_index
+
+    if query is None:
+        query = get_polygon_query(polygons)
+
+    for start in range(0, len(X), chunk_size):
+        point_idx, poly_idx = query(X[start:start+chunk_size], Y[start:start+chunk_size])
+        if len(point_idx) == 0:
+            continue
+        # keep the lowest polygon index for each point
+        order = np.lexsort((poly_idx, point_idx))
+        point_idx = point_idx[order]
+        poly_idx = poly_idx[order]
+        first = np.concatenate(([True], point_idx[1:] != point_idx[:-1]))
+        polygon_index[start + point_idx[first]] = poly_idx[first]
+    return polygon_index
+
+def rasterize_polygons(polygons, transform, out_shape):
+    """
+    Burn the polygons onto a raster grid. The label of each cell is the index of
+    its polygon + 1, and 0 outside the polygons. A cell is in a polygon if its
+    centre is. The polygons are burned in reverse order so that where they overlap
+    the cells get the lowest polygon index, the same as get_polygon_index.
+
+    Args:
+        polygons: list of shapely polygons
+        transform: the affine transform of the grid, e.g. src.transform
+        out_shape: the number of rows and columns of the grid
+
+    Returns:
+        the array of labels
+
+    Author: FJC
+    """
+    from rasterio.features import rasterize
+
+    dtype = 'uint16' if len(polygons) < np.iinfo(np.uint16).max else 'int32'
+    if len(polygons) == 0:
+        return np.zeros(out_shape, dtype=dtype)
+    return rasterize([(polygon, j+1) for j, polygon in reversed(list(enumerate(polygons)))],
+                     out_shape=out_shape, transform=transform, fill=0, dtype=dtype)
+
+def lookup_labels(X, Y, labels, transform):
+    """
+    Find the polygon of each point from the labels of rasterize_polygons, using
+    the row and column of the point from the inverse of the transform.
+
+    Returns:
+        array with the index of the polygon that each point is in, or -1 for points
+        that aren't in any of the polygons or are outside the grid
+
+    Author: FJC
+    """
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    polygon_index = np.full(len(X), -1, dtype=np.int64)
+
+    a, b, c, d, e, f = transform.a, transform.b, transform.c, transform.d, transform.e, transform.f
+    det = a*e - b*d
+    col = np.floor((e*(X - c) - b*(Y - f))/det).astype(np.int64)
+    row = np.floor((a*(Y - f) - d*(X - c))/det).astype(np.int64)
+    on_grid = (row >= 0) & (row < labels.shape[0]) & (col >= 0) & (col < labels.shape[1])
+    polygon_index[on_grid] = labels[row[on_grid], col[on_grid]].astype(np.int64) - 1
+    return polygon_index
+
+def get_raster_polygon_index(X, Y, polygons, transform, out_shape):
+    """
+    Find which polygon each point is in by burning the polygons onto a raster
+    grid (e.g. the DEM that the terrace pixels came from) and looking up the cell
+    of each point. This is much faster than testing the points against the
+    polygons, and gives the same result for points at the cell centres, except
+    for points exactly on the edge of a polygon.
+
+    Args:
+        X: the x coordinates of the points
+        Y: the y coordinates of the points
+        polygons: list of shapely polygons
+        transform: the affine transform of the grid, e.g. src.transform
+        out_shape: the number of rows and columns of the grid
+
+    Returns:
+        array with the index of the polygon that each point is in, or -1 for points
+        that aren't in any of the polygons or are outside the grid
+
+    Author: FJC
+    """
+    if len(X) == 0 or len(polygons) == 0:
+        return np.full(len(X), -1, dtype=np.int64)
+    return lookup_labels(X, Y, rasterize_polygons(polygons, transform, out_shape), transform)
+
+def _get_vectorized_query(polygons):
+    """
+    The point in polygon query for shapely 2: the tree finds the polygons whose
+    bounding boxes contain each point, and contains_xy tests all of these pairs at
+    once against the prepared polygons.
+    """
+    import shapely
+
+    polygons = np.asarray(polygons, dtype=object)
+    shapely.prepare(polygons)
+    tree = shapely.STRtree(polygons)
+
+    def _query(x, y):
+        point_idx, poly_idx = tree.query(shapely.points(x, y))
+        inside = shapely.contains_xy(polygons[poly_idx], x[point_idx], y[point_idx])
+        return point_idx[inside], poly_idx[inside]
+    return _query
+
+def _get_prepared_query(polygons):
+    """
+    The point in polygon query for shapely < 2, which doesn't have vectorized
+    predicates: the points in the bounding box of each polygon are found with
+    numpy, and only those are tested against the prepared polygon.
+    """
+    from shapely.geometry import Point
+    from shapely.prepared import prep
+
+    prepared = [prep(polygon) for polygon in polygons]
+    bounds = np.array([polygon.bounds for polygon in polygons])
+
+    def _query(x, y):
+        point_idx = []
+        poly_idx = []
+        for j, this_polygon in enumerate(prepared):
+            minx, miny, maxx, maxy = bounds[j]
+            in_box = np.flatnonzero((x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy))
+            inside = [i for i in in_box if this_polygon.contains(Point(x[i], y[i]))]
+            point_idx.extend(inside)
+            poly_idx.extend([j]*len(inside))
+        return np.asarray(point_idx, dtype=np.int64), np.asarray(poly_idx, dtype=np.int64)
+    return _query
+
+#=============================================================================
+# Filtering the reaches
+#=============================================================================
+def read_polygons(shp_fname):
+    """
+    Read the polygons from a shapefile, in the order of the features
+
+    Returns:
+        list of shapely polygons
+
+    Author: FJC
+    """
+    import fiona
+    from shapely.geometry import shape
+
+    with fiona.open(shp_fname) as c:
+        return [shape(pol['geometry']) for pol in c]
+
+def rasterize_polygons_blocks(polygons, transform, out_shape, labels_fname, block_size=256):
+    """
+    Burn the polygons onto a raster grid one block at a time, the same as
+    rasterize_polygons, but into a memory-mapped .npy file so that only one block is
+    in memory. Each block only burns the polygons whose bounding boxes overlap it.
+
+    Args:
+        polygons: list of shapely polygons
+        transform: the affine transform of the grid
+        out_shape: the number of rows and columns of the grid
+        labels_fname (str): the .npy file for the labels
+        block_size (int): the number of rows and columns in each block
+
+    Returns:
+        the memory-mapped array of labels, and the rows and columns of the grid
+        that are in any polygon (boolean arrays)
+
+    Author: FJC
+    """
+    from rasterio.features import rasterize
+    from rasterio.transform import Affine
+
+    dtype = 'uint16' if len(polygons) < np.iinfo(np.uint16).max else 'int32'
+    labels = np.lib.format.open_memmap(labels_fname, mode='w+', dtype=dtype, shape=tuple(out_shape))
+    row_in_polygons = np.zeros(out_shape[0], dtype=bool)
+    col_in_polygons = np.zeros(out_shape[1], dtype=bool)
+    # the rows and columns of the bounding box of each polygon
+    windows = np.array([_bounds_to_window(polygon.bounds, transform, out_shape) for polygon in polygons]).reshape(-1, 4)
+
+    t = transform
+    for row_off in range(0, out_shape[0], block_size):
+        for col_off in range(0, out_shape[1], block_size):
+            height = min(block_size, out_shape[0] - row_off)
+            width = min(block_size, out_shape[1] - col_off)
+            overlaps = np.flatnonzero((windows[:, 0] < row_off + height) & (windows[:, 1] > row_off) &
+                                      (windows[:, 2] < col_off + width) & (windows[:, 3] > col_off))
+            if len(overlaps) == 0:
+                continue
+            block_transform = Affine(t.a, t.b, t.c + t.a*col_off + t.b*row_off, t.d, t.e, t.f + t.d*col_off + t.e*row_off)
+            block = rasterize([(polygons[j], j+1) for j in overlaps[::-1]], out_shape=(height, width),
+                              transform=block_transform, fill=0, dtype=dtype)
+            labels[row_off:row_off+height, col_off:col_off+width] = block
+            row_in_polygons[row_off:row_off+height] |= block.any(axis=1)
+            col_in_polygons[col_off:col_off+width] |= block.any(axis=0)
+    labels.flush()
+    return labels, row_in_polygons, col_in_polygons
+
+def _bounds_to_window(bounds, transform, out_shape):
+    """
+    Get the first and last+1 rows and columns of the cells of a grid that overlap
+    some bounds, clipped to the grid
+    """
+    minx, miny, maxx, maxy = bounds
+    t = transform
+    det = t.a*t.e - t.b*t.d
+    x = np.array([minx, minx, maxx, maxx]) - t.c
+    y = np.array([miny, maxy, miny, maxy]) - t.f
+    cols = (t.e*x - t.b*y)/det
+    rows = (t.a*y - t.d*x)/det
+    return (int(np.clip(np.floor(rows.min()), 0, out_shape[0])), int(np.clip(np.ceil(rows.max()), 0, out_shape[0])),
+            int(np.clip(np.floor(cols.min()), 0, out_shape[1])), int(np.clip(np.ceil(cols.max()), 0, out_shape[1])))
+
+def get_reach_index(polygons, relief_fname=None, labels_fname=None, block_size=256):
+    """
+    Build the polygon index of a reach, which is shared by the point filter and
+    the raster mask. If there is a relief raster the polygons are burned onto its
+    grid once, and the labels are used for both.
+
+    Args:
+        polygons: list of shapely polygons
+        relief_fname (str): the relief raster, or None
+        labels_fname (str): if given, burn the polygons one block at a time into this
+        memory-mapped .npy file (see rasterize_polygons_blocks) rather than into memory
+        block_size (int): the size of the blocks for labels_fname
+
+    Returns:
+        dict with the polygons, and the labels, transform and metadata of the grid
+        and the window of the cells in the polygons if there is a relief raster
+
+    Author: FJC
+    """
+    index = {'polygons': polygons, 'query': None, 'labels': None}
+    if relief_fname is not None:
+        import rasterio
+        with rasterio.open(relief_fname) as src:
+            index['transform'] = src.transform
+            index['meta'] = src.meta.copy()
+        out_shape = (index['meta']['height'], index['meta']['width'])
+        if labels_fname:
+            index['labels'], rows, cols = rasterize_polygons_blocks(polygons, index['transform'], out_shape, labels_fname, block_size)
+        else:
+            index['labels'] = rasterize_polygons(polygons, index['transform'], out_shape)
+            rows = index['labels'].any(axis=1)
+            cols = index['labels'].any(axis=0)
+        # the window of the cells in the polygons, for cropping the raster
+        rows = np.flatnonzero(rows)
+        cols = np.flatnonzero(cols)
+        index['window'] = None
+        if len(rows):
+            from rasterio.windows import Window
+            index['window'] = Window(cols[0], rows[0], cols[-1] - cols[0] + 1, rows[-1] - rows[0] + 1)
+    return index
+
+def _get_window_meta(index, nodata):
+    """
+    Get the metadata of the masked raster, which is cropped to the window of the
+    cells in the polygons
+    """
+    from rasterio.transform import Affine
+
+    window = index['window']
+    t = index['transform']
+    out_meta = index['meta'].copy()
+    out_meta.update({"driver": "GTiff",
+                     "height": window.height,
+                     "width": window.width,
+                     "transform": Affine(t.a, t.b, t.c + t.a*window.col_off + t.b*window.row_off,
+                                         t.d, t.e, t.f + t.d*window.col_off + t.e*window.row_off),
+                     "nodata": nodata})
+    return out_meta
+
+def mask_relief_raster(relief_fname, out_fname, index):
+    """
+    Mask the relief raster to the polygons and crop it to the cells in the
+    polygons, using the labels of the reach index. Only the cropped window of the
+    raster is read.
+
+    Args:
+        relief_fname (str): the relief raster
+        out_fname (str): the masked GeoTIFF
+        index: the reach index from get_reach_index
+
+    Returns:
+        the number of cells in the polygons
+
+    Author: FJC
+    """
+    import rasterio
+
+    window = index['window']
+    if window is None:
+        print("WARNING: none of the relief raster is in the polygons, so I won't write "+out_fname)
+        return 0
+    in_polygons = index['labels'][window.row_off:window.row_off+window.height, window.col_off:window.col_off+window.width] > 0
+
+    with rasterio.open(relief_fname) as src:
+        out_image = src.read(window=window)
+        nodata = src.nodata if src.nodata is not None else -9999
+    out_image[:, ~in_polygons] = nodata
+
+    with rasterio.open(out_fname, "w", **_get_window_meta(index, nodata)) as dest:
+        dest.write(out_image)
+    return int(in_polygons.sum())
+
+def mask_relief_raster_windowed(relief_fname, out_fname, index, block_size=256):
+    """
+    Mask the relief raster to the polygons and crop it to the cells in the
+    polygons, the same as mask_relief_raster, but one block at a time: each block
+    of the output is read from the raster, masked with the labels of the reach
+    index and written to a tiled, compressed GeoTIFF. Only one block is in memory
+    at once, however long the reach is.
+
+    Args:
+        relief_fname (str): the relief raster
+        out_fname (str): the masked GeoTIFF
+        index: the reach index from get_reach_index
+        block_size (int): the size of the tiles of the output (a multiple of 16)
+
+    Returns:
+        the number of cells in the polygons
+
+    Author: FJC
+    """
+    import rasterio
+    from rasterio.windows import Window
+
+    window = index['window']
+    if window is None:
+        print("WARNING: none of the relief raster is in the polygons, so I won't write "+out_fname)
+        return 0
+
+    n_cells = 0
+    with rasterio.open(relief_fname) as src:
+        nodata = src.nodata if src.nodata is not None else -9999
+        out_meta = _get_window_meta(index, nodata)
+        out_meta.update({"tiled": True, "blockxsize": block_size, "blockysize": block_size, "compress": "deflate"})
+        with rasterio.open(out_fname, "w", **out_meta) as dest:
+            for _, out_window in dest.block_windows(1):
+                row_off = window.row_off + out_window.row_off
+                col_off = window.col_off + out_window.col_off
+                in_polygons = index['labels'][row_off:row_off+out_window.height, col_off:col_off+out_window.width] > 0
+                if in_polygons.any():
+                    block = src.read(window=Window(col_off, row_off, out_window.width, out_window.height))
+                    block[:, ~in_polygons] = nodata
+                    n_cells += int(in_polygons.sum())
+                else:
+                    block = np.full((src.count, out_window.height, out_window.width), nodata, dtype=out_meta['dtype'])
+                dest.write(block, window=out_window)
+    return n_cells
+
+def filter_points(points_fname, out_fname, index, lookup_method='geometry', chunksize=1000000):
+    """
+    Filter the points csv to the points in the polygons, and write them with the
+    index of their polygon in the new_ID column. The csv is read and written in
+    chunks.
+
+    Args:
+        points_fname (str): the csv of the points, with X and Y columns
+        out_fname (str): the filtered csv
+        index: the reach index from get_reach_index
+        lookup_method (str): 'geometry' to test the points against the polygons, or 'raster'
+        to look them up on the grid of the reach index. Default = geometry
+        chunksize (int): the number of rows to read at once
+
+    Returns:
+        the number of points read and the number kept
+
+    Author: FJC
+    """
+    if lookup_method == 'raster' and index['labels'] is None:
+        raise ValueError("The raster lookup needs the relief raster for the grid")
+    if lookup_method == 'geometry' and index['query'] is None and len(index['polygons']):
+        index['query'] = get_polygon_query(index['polygons'])
+
+    n_read = 0
+    n_kept = 0
+    header = True
+    for chunk in pd.read_csv(points_fname, chunksize=chunksize):
+        if lookup_method == 'raster':
+            polygon_index = lookup_labels(chunk['X'].values, chunk['Y'].values, index['labels'], index['transform'])
+        else:
+            polygon_index = get_polygon_index(chunk['X'].values, chunk['Y'].values, index['polygons'], query=index['query'])
+        keep = polygon_index >= 0
+        output_df = chunk[keep].copy()
         # write the new IDs to a new column
-        output_df['new_ID'] = id_index
-        output_df.to_csv(data_dir+dir+'\\'+fname+'_final_terrace_info_filtered.csv', index=False)
+        output_df['new_ID'] = polygon_index[keep]
+        output_df.to_csv(out_fname, index=False, mode='w' if header else 'a', header=header)
+        header = False
+        n_read += len(chunk)
+        n_kept += int(keep.sum())
+    if header:
+        # the csv didn't have any rows
+        pd.read_csv(points_fname, nrows=0).assign(new_ID=[]).to_csv(out_fname, index=False)
+    return n_read, n_kept
+
+def filter_reach(job):
+    """
+    Filter the points and mask the relief raster of one reach. The polygon index
+    is built once and used for both.
+
+    Args:
+        job: tuple of (DataDirectory, reach, lookup_method, mask_raster, chunksize, suffixes, windowed,
+        block_size), where suffixes is a dict with the points, polygons, relief, out_points and
+        out_relief file suffixes
+
+    Returns:
+        dict with the number of points and the time taken for each step
+
+    Author: FJC
+    """
+    DataDirectory, reach, lookup_method, mask_raster, chunksize, suffixes, windowed, block_size = job
+    start_time = time.time()
+    start_cpu = time.process_time()
+    stem = os.path.join(DataDirectory, reach, reach)
+
+    polygons = read_polygons(stem+suffixes['polygons'])
+    relief_fname = stem+suffixes['relief']
+    if not os.path.isfile(relief_fname):
+        relief_fname = None
+        if lookup_method == 'raster':
+            print("WARNING: there isn't a relief raster for "+reach+", so I'll test the points against the polygons")
+            lookup_method = 'geometry'
+    # in windowed mode the labels are burned into a temporary file rather than into memory
+    labels_fname = stem+'_polygon_labels.npy' if windowed else None
+    index = get_reach_index(polygons, relief_fname if (lookup_method == 'raster' or mask_raster) else None, labels_fname, block_size)
+    index_time = time.time() - start_time
+
+    try:
+        mask_start = time.time()
+        n_cells = np.nan
+        if mask_raster and relief_fname is not None:
+            if windowed:
+                n_cells = mask_relief_raster_windowed(relief_fname, stem+suffixes['out_relief'], index, block_size)
+            else:
+                n_cells = mask_relief_raster(relief_fname, stem+suffixes['out_relief'], index)
+        mask_time = time.time() - mask_start
+
+        filter_start = time.time()
+        n_read, n_kept = filter_points(stem+suffixes['points'], stem+suffixes['out_points'], index, lookup_method, chunksize)
+        filter_time = time.time() - filter_start
+    finally:
+        if labels_fname and index['labels'] is not None:
+            index['labels'] = None
+            os.remove(labels_fname)
+
+    return {'reach': reach, 'n_polygons': len(polygons), 'n_points': n_read, 'n_kept': n_kept, 'n_masked_cells': n_cells,
+            'lookup_method': lookup_method, 'index_time': index_time, 'mask_time': mask_time, 'filter_time': filter_time,
+            'wall_time': time.time() - start_time, 'cpu_time': time.process_time() - start_cpu, 'worker': os.getpid()}
+
+# the input and output files of each reach, after the reach name
+DEFAULT_SUFFIXES = {'points': '_final_terrace_info.csv', 'polygons': '_terraces.shp', 'relief': '_final_terrace_relief_final.bil',
+                    'out_points': '_final_terrace_info_filtered.csv', 'out_relief': '_terrace_relief_masked.tif'}
+
+def find_reaches(DataDirectory, pattern='*', polygon_suffix=DEFAULT_SUFFIXES['polygons']):
+    """
+    Find the reaches: the sub-directories of the data directory that match the
+    pattern and have a polygon shapefile
+
+    Args:
+        DataDirectory (str): the data directory
+        pattern (str): the pattern of the reach names, e.g. UMV_DEM5m_*
+        polygon_suffix (str): the end of the name of the polygon shapefile
+
+    Returns:
+        sorted list of the reach names
+
+    Author: FJC
+    """
+    subdirs = next(os.walk(DataDirectory))[1]
+    return sorted(reach for reach in subdirs if fnmatch.fnmatch(reach, pattern)
+                  and os.path.isfile(os.path.join(DataDirectory, reach, reach+polygon_suffix)))
+
+def filter_reaches(DataDirectory, reaches, lookup_method='geometry', mask_raster=True, chunksize=1000000, n_workers=1,
+                   suffixes=None, log_fname=None, windowed=False, block_size=256):
+    """
+    This function filters the points and masks the relief raster of each reach,
+    either one reach after the other or in a pool of worker processes.
+
+    Args:
+        DataDirectory (str): the directory with a sub-directory for each reach
+        reaches: list of the reach names (the sub-directories)
+        lookup_method (str): 'raster' or 'geometry', see filter_points
+        mask_raster (bool): if true, mask the relief raster to the polygons
+        chunksize (int): the number of rows of the points csv to read at once
+        n_workers (int): the number of worker processes. Default = 1 (no pool)
+        suffixes: dict of the file suffixes. Default = DEFAULT_SUFFIXES
+        log_fname (str): if given, write the number of points and time taken for each reach to this csv
+        windowed (bool): if true, burn the polygons and mask the raster one block at a time, so the
+        memory is set by the block size rather than by the size of the reach
+        block_size (int): the size of the blocks in windowed mode (a multiple of 16)
+
+    Returns:
+        dataframe with the number of points and time taken for each reach
+
+    Author: FJC
+    """
+    suffixes = dict(DEFAULT_SUFFIXES, **(suffixes or {}))
+    jobs = [(DataDirectory, reach, lookup_method, mask_raster, chunksize, suffixes, windowed, block_size) for reach in reaches]
+    results = [None]*len(jobs)
+
+    def _report(i, n_done):
+        result = results[i]
+        print("Filtered reach %d of %d: %s (%d of %d points kept, %.1f s)" %(n_done, len(jobs), result['reach'], result['n_kept'], result['n_points'], result['wall_time']))
+
+    if n_workers > 1 and len(jobs) > 1:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = {pool.submit(filter_reach, job): i for i, job in enumerate(jobs)}
+            for n_done, future in enumerate(as_completed(futures)):
+                results[futures[future]] = future.result()
+                _report(futures[future], n_done+1)
+    else:
+        for i, job in enumerate(jobs):
+            results[i] = filter_reach(job)
+            _report(i, i+1)
+
+    timing_df = pd.DataFrame(results, columns=['reach', 'n_polygons', 'n_points', 'n_kept', 'n_masked_cells', 'lookup_method',
+                                               'index_time', 'mask_time', 'filter_time', 'wall_time', 'cpu_time', 'worker'])
+    if log_fname:
+        timing_df.to_csv(log_fname, index=False)
+    return timing_df
+
+#=============================================================================
+# This is the main function that runs the whole thing
+#=============================================================================
+def main(argv):
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-dir", "--base_directory", type=str, help="The directory with a sub-directory for each reach. If this isn't defined I'll assume it's the same as the current directory.")
+    parser.add_argument("-reaches", "--reach_pattern", type=str, default='*', help="The pattern of the reach sub-directories to filter, e.g. 'UMV_DEM5m_*'. Default = all the sub-directories with a polygon shapefile")
+    parser.add_argument("-method", "--lookup_method", type=str, default='geometry', help="How to find the polygon of each point: 'geometry' (test the points against the polygons) or 'raster' (look the points up on the grid of the relief raster, which is faster but only the same if the points are at the cell centres). Default = geometry")
+    parser.add_argument("-no_mask", "--no_mask", type=bool, default=False, help="If this is true, I won't mask the relief raster to the polygons, just filter the points")
+    parser.add_argument("-windowed", "--windowed", type=bool, default=False, help="If this is true, I'll mask the relief raster one block at a time and write it as a tiled, compressed GeoTIFF, so that long reaches don't need the whole raster in memory")
+    parser.add_argument("-block", "--block_size", type=int, default=256, help="The size of the blocks (in pixels) in windowed mode. Must be a multiple of 16. Default = 256")
+    parser.add_argument("-chunk", "--chunksize", type=int, default=1000000, help="The number of rows of the points csv to read at once. Default = 1000000")
+    parser.add_argument("-nw", "--n_workers", type=int, default=1, help="The number of processes used to filter the reaches. Default = 1")
+    parser.add_argument("-points", "--points_suffix", type=str, default=DEFAULT_SUFFIXES['points'], help="The end of the name of the points csv of each reach. Default = "+DEFAULT_SUFFIXES['points'])
+    parser.add_argument("-shp", "--polygons_suffix", type=str, default=DEFAULT_SUFFIXES['polygons'], help="The end of the name of the polygon shapefile of each reach. Default = "+DEFAULT_SUFFIXES['polygons'])
+    parser.add_argument("-relief", "--relief_suffix", type=str, default=DEFAULT_SUFFIXES['relief'], help="The end of the name of the relief raster of each reach. Default = "+DEFAULT_SUFFIXES['relief'])
+    parser.add_argument("-log", "--log_fname", type=str, default=None, help="If given, write the number of points and time taken for each reach to this csv")
+    args = parser.parse_args(argv)
+
+    if args.lookup_method not in ['raster', 'geometry']:
+        print("WARNING! The lookup method must be 'raster' or 'geometry'")
+        sys.exit()
+    if args.block_size <= 0 or args.block_size % 16:
+        print("WARNING! The block size must be a multiple of 16")
+        sys.exit()
+    this_dir = args.base_directory if args.base_directory else os.getcwd()+os.path.sep
+
+    reaches = find_reaches(this_dir, args.reach_pattern, args.polygons_suffix)
+    if not reaches:
+        print("WARNING! There aren't any reaches matching "+args.reach_pattern+" in "+this_dir)
+        sys.exit()
+    print("Filtering %d reaches: %s" %(len(reaches), ', '.join(reaches)))
+
+    suffixes = {'points': args.points_suffix, 'polygons': args.polygons_suffix, 'relief': args.relief_suffix}
+    filter_reaches(this_dir, reaches, args.lookup_method, not args.no_mask, args.chunksize, args.n_workers, suffixes, args.log_fname,
+                   args.windowed, args.block_size)
+
+#=============================================================================
+if __name__ == "__main__":
+    main(sys.argv[1:])
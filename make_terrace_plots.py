@@ -10,22 +10,18 @@
 #-----------------------------------------------------------------------------------------#
 # FJC 15/01/21
 
-# import modules
-import matplotlib
-matplotlib.use('Agg')
-import pandas as pd
+# import modules. The analysis modules are imported in main once the arguments have been
+# parsed, so that the help and the welcome screen don't wait for matplotlib, pandas and scipy.
 import sys
 import os
 
-import TerracePlotter
-
 #=============================================================================
 # This is the main function that runs the whole thing
 #=============================================================================
 def main(argv):
 
     # If there are no arguments, send to the welcome screen
-    if not len(sys.argv) > 1:
+    if not len(argv) > 0:
         full_paramfile = print_welcome()
         sys.exit()
 
@@ -44,17 +40,33 @@ def main(argv):
 
     # What sort of analyses you want to do
     parser.add_argument("-LP", "--long_profiler", type=bool, default=False, help="If this is true, I'll make plots of the terrace long profiles (Default = true)")
+    parser.add_argument("-BP", "--binned_profiles", type=bool, default=False, help="If this is true, I'll plot the long profile of each terrace with its median elevation in bins along the baseline, and write the binned medians and percentiles to _terrace_binned_profiles.csv")
+    parser.add_argument("-bin", "--bin_width", type=float, default=100., help="The width of the bins along the baseline (in metres) for the binned profiles. Default = 100")
     parser.add_argument("-compiled", "--compiled", type=bool, default=False, help="If this is true, I'll combine all reaches to make a super-plot for the whole river")
+    parser.add_argument("-stream", "--streaming", type=bool, default=False, help="If this is true, I'll read the terrace csv in chunks and only calculate the terrace means (and the long profile plot if -LP is true), so the whole table is never in memory. Use this for very big DEMs.")
+    parser.add_argument("-chunk", "--chunksize", type=int, default=1000000, help="The number of rows to read at once in streaming mode. Default = 1000000")
+    parser.add_argument("-fit", "--fit_profiles", type=bool, default=False, help="If this is true, I'll fit paleo long profiles to groups of terraces at a similar height above the channel, and plot the best ones")
+    parser.add_argument("-fit_rmse", "--fit_rmse", type=float, default=2., help="The largest rmse (in metres) of a group of terraces for its paleo profile to be plotted. Default = 2")
     parser.add_argument("-PR", "--plot_rasters", type=bool, default=False, help="If this is true, I'll make raster plots of the terrace locations (Default=false)")
     parser.add_argument("-HM", "--heat_map", type=bool, default=False, help="if true I'll make a heat map of terrace locations along the river long profile")
+    parser.add_argument("-kde", "--kde_method", type=str, default='exact', help="How to calculate the heat map density. Can be 'exact' (evaluate the KDE at every grid position) or 'binned' (bin the pixels onto the grid and convolve with the kernel, much faster for big datasets). Default = exact")
+    parser.add_argument("-kde_err", "--kde_error", type=bool, default=False, help="If this is true and you use the binned heat map, I'll report the error compared to the exact KDE.")
     parser.add_argument("-dips", "--dips", type=bool,default=False, help="If this is true, I'll calculate the dip and dip direction of each terrace.")
     parser.add_argument("-3d", "--plot_3d", type=bool,default=False, help="If this is true, I'll make a 3d plot of each terrace surface.")
+    parser.add_argument("-plane_fit", "--plane_fit", type=str, default='lstsq', help="How to fit the planes for -dips and -3d. Can be 'lstsq' (least squares), 'huber' (robust, downweights pixels far from the surface) or 'ransac' (robust, best for lots of misclassified riser or hillslope pixels). The robust fits also report the fraction of inlier pixels of each terrace. Default = lstsq")
 
     # These control the format of your figures
     parser.add_argument("-fmt", "--FigFormat", type=str, default='png', help="Set the figure format for the plots. Default is png")
+    parser.add_argument("-io", "--table_format", type=str, default='csv', help="The format for reading and writing the terrace tables. Can be 'csv', 'npy' (one binary file per column), 'feather' or 'parquet' (these need pyarrow). If it isn't csv, I'll convert the csv files the first time I read them. Default = csv")
+    parser.add_argument("-typed", "--typed_tables", type=bool, default=False, help="If this is true, I'll store the terrace and baseline tables in smaller types (float32 where this changes the values by less than 1 mm except for the X and Y coordinates, int32 IDs and categorical reaches) to use less memory")
+    parser.add_argument("-nw", "--n_workers", type=int, default=1, help="The number of processes used to render the per-terrace figures, fit the paleo profiles and load the reaches in compiled mode. Default = 1")
+    parser.add_argument("-nt", "--n_threads", type=int, default=1, help="The number of stages of the analysis that can run at the same time for a single reach. Default = 1")
+    parser.add_argument("-resume", "--resume", type=bool, default=False, help="If this is true, in compiled mode I'll read the reaches that were finished by an earlier run from their checkpoints instead of loading and projecting them again")
+    parser.add_argument("-force", "--force", type=bool, default=False, help="If this is true, I'll rerun all the stages of the analysis even if their outputs are up to date")
+    parser.add_argument("-prof", "--profile_stage", type=str, default=None, help="The name of a stage to run under cProfile, e.g. 'summarize' or 'heat_map'. The stats are written to <fname_prefix>_<stage>.prof and <fname_prefix>_<stage>_cprofile.txt. The time and memory of every stage are always written to <fname_prefix>_profile.json and .csv")
     parser.add_argument("-size", "--size_format", type=str, default='ESURF', help="Set the size format for the figure. Can be 'big' (16 inches wide), 'geomorphology' (6.25 inches wide), or 'ESURF' (4.92 inches wide) (defualt esurf).")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     # get the base directory
     if args.base_directory:
@@ -72,88 +84,94 @@ def main(argv):
     # check if you supplied the DEM prefix
     if not args.fname_prefix:
         print("WARNING! You haven't supplied your DEM name. Please specify this with the flag '-fname'")
-        sys.exit()
+        sys.exit(1)
     # print the arguments that you used to an output file for reproducibility
-    with open(this_dir+args.fname_prefix+'_report.csv', 'w') as output:
+    report_fname = this_dir+args.fname_prefix+'_report.csv'
+    with open(report_fname, 'w') as output:
         for arg in vars(args):
             output.write(str(arg)+','+str(getattr(args, arg))+'\n')
         output.close()
 
+    # now import the analysis modules
+    import matplotlib
+    matplotlib.use('Agg')
+    import TerracePlotter
+    import TerraceIO
+    import TerracePipeline
+    from LSDPlottingTools import instrumentation
+
+    # record the time and memory of each stage of this run
+    instrumentation.reset()
+    instrumentation.enable_cprofile(args.profile_stage, this_dir+args.fname_prefix+'_')
+
     # This statement checks whether you want to run the plots for a single reach, or whether you want to loop through
     # all the reaches and make a combined plot of all the terrace locations.
-    # the first condition is if you just want to plot a single reach
-    if not args.compiled:
-        # read in the baseline channel csv
-        lp = pd.read_csv(this_dir+args.fname_prefix+'_baseline_channel_info.csv')
+    # the first condition is if you just want the terrace means for a single reach, streaming through the terrace csv
+    if args.streaming and not args.compiled:
+        lp = TerraceIO.load_table(this_dir+args.fname_prefix+'_baseline_channel_info', args.table_format, typed=args.typed_tables)
         lp = lp[lp['Elevation'] != -9999]
 
-        # read in the terrace csv
-        terraces = pd.DataFrame()
-        dist_file = this_dir+args.fname_prefix+'_terrace_info_dist.csv'
-        # check if you have already calculated the distance along the baseline for each point
-        if os.path.isfile(dist_file):
-            terraces = pd.read_csv(this_dir+args.fname_prefix+'_terrace_info_dist.csv')
-        else:
-            terraces = pd.read_csv(this_dir+args.fname_prefix+'terrace_info.csv')
-            # find the nearest point along the baseline for each terrace ID
-            terraces = TerracePlotter.get_distance_along_baseline_points(terraces, lp)
-            terraces.to_csv(this_dir+args.fname_prefix+'_terrace_info_dist.csv', index=False)
-
-        # this function makes a plot of the long profile and the terrace elevations. For each terrace it plots the distance
-        # as the middle of each terrace and the mean elevation of the terrace surface.
+        master_df = TerracePlotter.stream_terrace_means(this_dir+args.fname_prefix+'_terrace_info.csv', lp, this_dir+args.fname_prefix+'_terrace_means.csv', chunksize=args.chunksize)
         if args.long_profiler:
-            TerracePlotter.long_profiler_all_terraces(this_dir, args.fname_prefix, terraces, lp)
-
-        # this function makes 3d plots of each terrace surface
-        if args.plot_3d:
-            TerracePlotter.PlotTerraceSurfaces(this_dir, args.fname_prefix, terraces)
+            TerracePlotter.plot_terrace_means(this_dir, args.fname_prefix, master_df, lp, FigFormat=args.FigFormat)
+
+    # the next condition is if you just want to plot a single reach. The analysis is run as a set of stages:
+    # loading the tables, projecting the terraces onto the baseline, summarising each terrace, the dips,
+    # the heat map and the plots. Only the stages that you asked for, and that are out of date, are run,
+    # and the stages are recorded in the _run_manifest.json.
+    elif not args.compiled:
+        # this makes a plot of the long profile and the terrace elevations (-LP). For each terrace it plots the distance
+        # as the middle of each terrace and the mean elevation of the terrace surface.
+        # -fit fits paleo long profiles to groups of terraces, -BP plots each terrace long profile with the median
+        # elevation in bins along the baseline, -3d makes 3d plots of each terrace surface, -dips gets the dip and
+        # dip direction of each terrace surface and -HM makes a heat map showing where the majority of terrace pixels
+        # are located compared to the long profile.
+        stages = TerracePipeline.get_reach_stages(this_dir, args.fname_prefix, args, report_fname)
+        targets = TerracePipeline.get_reach_targets(args)
+        TerracePipeline.run_pipeline(stages, targets, this_dir+args.fname_prefix+'_run_manifest.json', n_threads=args.n_threads, force=args.force)
 
         # DEPRECATED - function to make shaded relief plots of the terrace surfaces.
         # if args.plot_rasters:
         #     TerracePlotter.MakeRasterPlotTerraceIDs(this_dir, args.fname_prefix, args.FigFormat, args.size_format)
         #     TerracePlotter.MakeRasterPlotTerraceElev(this_dir, args.fname_prefix, args.FigFormat, args.size_format)
-        # DEPRECATED - function to get the dip and dip direction of each terrace surface.
-        #if args.dips:
-            #TerracePlotter.write_dip_and_dipdir_to_csv(this_dir,args.fname_prefix, args.digitised_terraces, args.shapefile_name)
-            # TerracePlotter.MakeRasterPlotTerraceDips(this_dir,args.fname_prefix,FigFormat=args.FigFormat,size_format=args.size_format)
-        # this function makes a heat map showing where the majority of terrace pixels are located compared to the long profile.
-        if args.heat_map:
-            TerracePlotter.MakeTerraceHeatMap(this_dir, args.fname_prefix, prec=100, bw_method=0.03, FigFormat=args.FigFormat, ages="")
 
     # this condition checks if you want make a combined plot of all the reaches.
     else:
         lp = this_dir+'UMV_combined'+path_sep+args.fname_prefix+'_points.csv'
-        dist_file = this_dir+'UMV_combined'+path_sep+args.fname_prefix+'_terrace_info_filtered_dist.csv'
+        dist_file = this_dir+'UMV_combined'+path_sep+args.fname_prefix+'_terrace_info_filtered_dist'
 
         # read in the long profile csv
-        lp_file = this_dir+'UMV_combined'+path_sep+args.fname_prefix+'_baseline_channel_info.csv'
-        lp_df = pd.DataFrame()
-        if os.path.isfile(lp_file):
-            lp_df = pd.read_csv(lp_file)
-        else:
-            lp_df = TerracePlotter.merge_baselines(lp, lp_file)
+        lp_file = this_dir+'UMV_combined'+path_sep+args.fname_prefix+'_baseline_channel_info'
+        # merge the baselines of each reach if this hasn't been done yet. The merged baseline is always read
+        # back from the file, so the coordinates are exactly the same as in later runs and the caches match.
+        if not (TerraceIO.table_exists(lp_file, 'csv') or TerraceIO.table_exists(lp_file, args.table_format)):
+            TerracePlotter.merge_baselines(lp, lp_file+'.csv')
+        lp_df = TerraceIO.load_table(lp_file, args.table_format, typed=args.typed_tables)
         lp_df = lp_df[lp_df['Elevation'] != -9999]
 
-        # check if you have already calculated the distance along the baseline for each point
-        if os.path.isfile(dist_file):
-            terraces = pd.read_csv(dist_file)
-            print(terraces['DistAlongBaseline_new'])
-        else:
-            # find each sub-directory and get the distance from the shapefile
-            subdirs = next(os.walk(this_dir))[1]
-            master_df = pd.DataFrame()
-            for dir in subdirs:
-                if 'UMV_DEM5m_' in dir:
-                    terraces = pd.read_csv(this_dir+dir+path_sep+dir+'_final_terrace_info_filtered.csv')
-                    # find the nearest point along the baseline for each terrace ID
-                    terraces = TerracePlotter.get_distance_along_baseline_points(terraces, lp_df)
-                    terraces['reach'] = dir
-                    master_df = master_df.append(terraces)
-            master_df.to_csv(dist_file, index=False)
+        # find each sub-directory and get the distance along the baseline for each point. The reaches are loaded
+        # in a pool of -nw processes. Each reach is cached separately, so only reaches where the terraces or the
+        # baseline have changed are recalculated. The projected table of each reach is also saved as a checkpoint,
+        # so if the run stops part of the way through, -resume reads the finished reaches from their checkpoints.
+        cache_dir = this_dir+'UMV_combined'+path_sep+args.fname_prefix+'_cache'+path_sep
+        # make sure the saved index matches the baseline before the reaches use it
+        TerracePlotter.get_baseline_index(lp_df['X'].values, lp_df['Y'].values, lp_file+'_index')
+        subdirs = sorted([dir for dir in next(os.walk(this_dir))[1] if 'UMV_DEM5m_' in dir], key=TerracePlotter.natural_sort_key)
+        terraces, reach_timings = TerraceIO.load_reaches(this_dir, subdirs, lp_df, cache_dir, args.table_format, n_workers=args.n_workers,
+                                                         log_fname=this_dir+'UMV_combined'+path_sep+args.fname_prefix+'_reach_timings.csv',
+                                                         index_dir=lp_file+'_index', typed=args.typed_tables, resume=args.resume)
+        for reach, cache_status in zip(reach_timings['reach'], reach_timings['cache']):
+            TerraceIO.append_to_report(report_fname, 'cache_'+reach, cache_status)
+        # write the joined table unless it was written from exactly the same reach tables. The projection
+        # caches only check the coordinates, so they can't tell if anything else in a reach has changed.
+        reaches_key = TerraceIO.get_reaches_key(this_dir, subdirs, lp_df, args.table_format, args.typed_tables)
+        TerraceIO.update_table(terraces, dist_file, args.table_format, reaches_key)
         #
         # make the long profile plot
         TerracePlotter.long_profiler_all_reaches(this_dir+'UMV_combined'+path_sep, args.fname_prefix, terraces, lp_df)
 
+    # write the time and memory of each stage
+    instrumentation.write_profile(this_dir+args.fname_prefix+'_profile')
 
 
 #=============================================================================
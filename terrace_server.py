@@ -0,0 +1,450 @@
+# Local server for exploring the terraces of one DEM interactively.
+# Running make_terrace_plots.py to try a different KDE bandwidth, bin width or elevation range means reading the
+# tables and projecting the terraces onto the baseline every time. This script loads them once, keeps them in memory
+# and serves the terrace summaries, binned profiles, KDE grids and figures over HTTP. The results for each set of
+# parameters are cached, so asking for the same thing again is instant.
+#
+# The server only listens on the loopback interface (127.0.0.1) or on a Unix socket, so it doesn't need a network
+# and can't be reached from other machines.
+#
+# python terrace_server.py -dir /path/to/data/ -fname DEM -port 8050
+# curl "http://127.0.0.1:8050/summary?min_elev=100&max_elev=200"
+# curl "http://127.0.0.1:8050/heat_map.png?bw_method=0.05&prec=200" -o heat_map.png
+#
+# or with a Unix socket:
+# python terrace_server.py -dir /path/to/data/ -fname DEM -socket /tmp/terraces.sock
+# curl --unix-socket /tmp/terraces.sock "http://localhost/kde?bw_method=0.05"
+#
+# The endpoints are listed at /, and the parameters are given in the query string:
+#     /info                 the size and extent of the dataset
+#     /summary              the summary of each terrace (res, filters, format=json or csv)
+#     /binned_profiles      the binned elevations along each terrace (bin_width, filters, format)
+#     /kde                  the KDE grid of the pixels (prec, bw_method, kde_method, filters)
+#     /heat_map.png         the heat map (prec, bw_method, kde_method, filters, dpi)
+#     /means.png            the mean elevation of each terrace against the long profile (res, filters, dpi)
+#     /profile.png          the long profile of one terrace (id, bin_width, filters)
+#     /stats                the number of cache hits and misses, and of requests that waited for the same result
+# The filters are min_elev, max_elev, min_relief and max_relief, which select the pixels by their elevation and
+# their relief above the channel.
+#-----------------------------------------------------------------------------------------#
+# FJC 20/01/21
+
+# import modules
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import io
+import json
+import os
+import socketserver
+import stat
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import TerracePlotter
+import TerraceIO
+import TerracePipeline
+from LSDPlottingTools import instrumentation
+
+#=============================================================================
+# Parameters
+#=============================================================================
+def _parse_bw_method(value):
+    """
+    The KDE bandwidth can be a number or the name of a method
+    """
+    if value in ['scott', 'silverman']:
+        return value
+    return float(value)
+
+def _parse_kde_method(value):
+    if value not in ['exact', 'binned']:
+        raise ValueError("kde_method must be exact or binned")
+    return value
+
+def _parse_format(value):
+    if value not in ['json', 'csv']:
+        raise ValueError("format must be json or csv")
+    return value
+
+# the parameters that can be passed in the query string: the function that parses each one and its default
+PARAMETERS = {'res': (float, 5.), 'bin_width': (float, 100.), 'prec': (int, 100), 'bw_method': (_parse_bw_method, 0.03),
+              'kde_method': (_parse_kde_method, 'binned'), 'min_elev': (float, None), 'max_elev': (float, None),
+              'min_relief': (float, None), 'max_relief': (float, None), 'id': (int, None), 'dpi': (int, 100),
+              'format': (_parse_format, 'json')}
+FILTERS = ['min_elev', 'max_elev', 'min_relief', 'max_relief']
+
+def parse_params(query, names):
+    """
+    Get the parameters for an endpoint from the query string. Parameters that aren't
+    given get their default, so the same request always gives the same parameters
+    (and so the same cache key).
+
+    Args:
+        query (str): the query string of the request
+        names: list of the parameters that the endpoint uses
+
+    Returns:
+        dict of the parameters
+
+    Author: FJC
+    """
+    given = parse_qs(query)
+    unknown = [name for name in given if name not in names]
+    if unknown:
+        raise ValueError("Unknown parameters: "+', '.join(unknown)+". This endpoint takes: "+', '.join(names))
+    params = {}
+    for name in names:
+        parser, default = PARAMETERS[name]
+        if name in given:
+            try:
+                params[name] = parser(given[name][-1])
+            except ValueError:
+                raise ValueError("Bad value for "+name+": "+given[name][-1])
+        else:
+            params[name] = default
+    return params
+
+#=============================================================================
+# The dataset
+#=============================================================================
+class TerraceDataset(object):
+    """
+    The terrace and baseline tables of one DEM, loaded once and kept in memory,
+    with a cache of the results for each set of parameters.
+
+    Args:
+        DataDirectory (str): the data directory
+        fname_prefix (str): the prefix of the DEM
+        table_format (str): the format of the tables, one of csv, npy, feather or parquet
+        typed (bool): if true, store the tables in smaller types (see TerraceIO.downcast_table)
+        cache_size (int): the most results to keep in the cache
+
+    Author: FJC
+    """
+    def __init__(self, DataDirectory, fname_prefix, table_format='csv', typed=False, cache_size=64):
+        self.DataDirectory = DataDirectory
+        self.fname_prefix = fname_prefix
+        self.cache_size = cache_size
+
+        # read the tables and get the distance along the baseline of each pixel (this is cached on disk)
+        stem = DataDirectory+fname_prefix
+        lp = TerraceIO.load_table(stem+'_baseline_channel_info', table_format, typed=typed)
+        lp = lp[lp['Elevation'] != -9999]
+        lp = lp.assign(DistAlongBaseline_new=TerracePlotter.build_baseline_index(lp['X'].values, lp['Y'].values)['cum_dist'])
+        terraces = TerraceIO.load_table(stem+'_terrace_info', table_format, typed=typed)
+        terraces, cache_status = TerraceIO.cached_distance_along_baseline(terraces, lp, stem+'_cache'+os.path.sep, fname_prefix)
+        self.lp = lp
+        self.terraces = terraces
+
+        self._cache = OrderedDict()
+        # the results that are being worked out, so the same result isn't worked out twice at once
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+
+    def cached(self, name, params, function):
+        """
+        Get a result from the cache, or work it out and add it to the cache. The least
+        recently used results are dropped when the cache is full. If another request is
+        already working out the same result, this one waits for it instead of doing it
+        again (and gets the same error if it fails).
+
+        Args:
+            name (str): the name of the result
+            params: dict of the parameters that the result depends on
+            function: the function that works out the result from the parameters
+
+        Returns:
+            the result
+
+        Author: FJC
+        """
+        key = (name, tuple(sorted(params.items())))
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = Future()
+                self.misses += 1
+                leader = True
+            else:
+                self.waits += 1
+                leader = False
+        if not leader:
+            return pending.result()
+
+        try:
+            result = function(params)
+        except BaseException as e:
+            with self._lock:
+                del self._pending[key]
+            pending.set_exception(e)
+            raise
+        with self._lock:
+            del self._pending[key]
+            self._cache[key] = result
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        pending.set_result(result)
+        return result
+
+    def get_filtered(self, params):
+        """
+        Get the pixels that pass the elevation and relief filters. With no filters
+        this is the whole table, without a copy.
+        """
+        filters = dict((name, params[name]) for name in FILTERS)
+        if all(value is None for value in filters.values()):
+            return self.terraces
+
+        def _filter(filters):
+            keep = np.ones(len(self.terraces), dtype=bool)
+            elevation = self.terraces['Elevation'].values
+            relief = self.terraces['ChannelRelief'].values
+            if filters['min_elev'] is not None:
+                keep &= elevation >= filters['min_elev']
+            if filters['max_elev'] is not None:
+                keep &= elevation <= filters['max_elev']
+            if filters['min_relief'] is not None:
+                keep &= relief >= filters['min_relief']
+            if filters['max_relief'] is not None:
+                keep &= relief <= filters['max_relief']
+            return self.terraces[keep]
+        return self.cached('filtered', filters, _filter)
+
+    def info(self, params):
+        return {'DataDirectory': self.DataDirectory, 'fname_prefix': self.fname_prefix, 'n_pixels': len(self.terraces),
+                'n_terraces': int(self.terraces['new_ID'].nunique()), 'n_baseline_points': len(self.lp),
+                'columns': [str(col) for col in self.terraces.columns],
+                'elevation_range': [float(self.terraces['Elevation'].min()), float(self.terraces['Elevation'].max())],
+                'baseline_length': float(self.lp['DistAlongBaseline_new'].max())}
+
+    def summary(self, params):
+        return self.cached('summary', params, lambda p: TerracePlotter.get_terrace_summary(self.get_filtered(p), res=p['res']))
+
+    def binned_profiles(self, params):
+        return self.cached('binned_profiles', params, lambda p: TerracePlotter.get_binned_profiles(self.get_filtered(p), bin_width=p['bin_width']))
+
+    def kde(self, params):
+        def _kde(p):
+            terraces = self.get_filtered(p)
+            on_baseline = terraces['BaselineNode'].values != -9999
+            kde = TerracePlotter.get_terrace_kde(terraces['DistAlongBaseline_new'].values[on_baseline]/1000., terraces['Elevation'].values[on_baseline],
+                                                 prec=p['prec'], bw_method=p['bw_method'], kde_method=p['kde_method'])
+            if kde is None:
+                raise ValueError("There aren't any terrace pixels with these filters")
+            return kde
+        return self.cached('kde', params, _kde)
+
+    def heat_map_png(self, params):
+        def _heat_map(p):
+            out_file = io.BytesIO()
+            with TerracePipeline.PYPLOT_LOCK:
+                TerracePlotter.MakeTerraceHeatMap(self.DataDirectory, self.fname_prefix, prec=p['prec'], bw_method=p['bw_method'],
+                                                  kde_method=p['kde_method'], terrace_df=self.get_filtered(p), lp=self.lp,
+                                                  out_file=out_file, dpi=p['dpi'])
+            return out_file.getvalue()
+        return self.cached('heat_map.png', params, _heat_map)
+
+    def means_png(self, params):
+        def _means(p):
+            terraces = self.get_filtered(p)
+            out_file = io.BytesIO()
+            with TerracePipeline.PYPLOT_LOCK:
+                TerracePlotter.plot_terrace_means(self.DataDirectory, self.fname_prefix, self.summary(dict((name, p[name]) for name in ['res']+FILTERS)), self.lp,
+                                                  relief_range=(terraces['ChannelRelief'].min(), terraces['ChannelRelief'].max()),
+                                                  out_file=out_file, dpi=p['dpi'])
+            return out_file.getvalue()
+        return self.cached('means.png', params, _means)
+
+    def profile_png(self, params):
+        def _profile(p):
+            if p['id'] is None:
+                raise ValueError("Give the terrace with id=<new_ID>")
+            terraces = self.get_filtered(p)
+            this_terrace = terraces['new_ID'].values == p['id']
+            if not this_terrace.any():
+                raise ValueError("There aren't any pixels for terrace %d with these filters" %p['id'])
+            profile_df = self.binned_profiles(dict((name, p[name]) for name in ['bin_width']+FILTERS))
+            these_bins = profile_df[profile_df['new_ID'] == p['id']]
+            distance = terraces['DistAlongBaseline_new'].values[this_terrace]
+            order = np.argsort(distance, kind='mergesort')
+            out_file = io.BytesIO()
+            with TerracePipeline.PYPLOT_LOCK:
+                TerracePlotter.plot_terrace_long_profile(out_file, distance[order]/1000, terraces['Elevation'].values[this_terrace][order],
+                                                         these_bins['bin_centre'].values/1000, these_bins['median_elevation'].values)
+            return out_file.getvalue()
+        return self.cached('profile.png', params, _profile)
+
+    def stats(self, params):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'waits': self.waits, 'cached': len(self._cache), 'cache_size': self.cache_size}
+
+# the endpoints: the method of the dataset, the parameters it takes and the type of the result
+ENDPOINTS = OrderedDict([
+    ('/info', ('info', [], 'json')),
+    ('/summary', ('summary', ['res', 'format']+FILTERS, 'table')),
+    ('/binned_profiles', ('binned_profiles', ['bin_width', 'format']+FILTERS, 'table')),
+    ('/kde', ('kde', ['prec', 'bw_method', 'kde_method']+FILTERS, 'kde')),
+    ('/heat_map.png', ('heat_map_png', ['prec', 'bw_method', 'kde_method', 'dpi']+FILTERS, 'png')),
+    ('/means.png', ('means_png', ['res', 'dpi']+FILTERS, 'png')),
+    ('/profile.png', ('profile_png', ['id', 'bin_width']+FILTERS, 'png')),
+    ('/stats', ('stats', [], 'json')),
+])
+
+#=============================================================================
+# The server
+#=============================================================================
+class TerraceRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles the requests. The dataset is server.dataset.
+    """
+    def address_string(self):
+        # there isn't a client address for Unix sockets
+        if isinstance(self.client_address, tuple) and self.client_address:
+            return str(self.client_address[0])
+        return 'unix'
+
+    def _send(self, status, body, content_type):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/':
+            self._send(200, json.dumps({'endpoints': dict((path, params) for path, (method, params, kind) in ENDPOINTS.items())}, indent=2), 'application/json')
+            return
+        if url.path not in ENDPOINTS:
+            self._send(404, json.dumps({'error': "Unknown endpoint "+url.path+", see / for the endpoints"}), 'application/json')
+            return
+
+        method, names, kind = ENDPOINTS[url.path]
+        start_time = time.time()
+        try:
+            params = parse_params(url.query, names)
+            # the format doesn't change the result, so it isn't part of the cache key
+            out_format = params.pop('format', 'json')
+            result = getattr(self.server.dataset, method)(params)
+        except ValueError as e:
+            self._send(400, json.dumps({'error': str(e)}), 'application/json')
+            return
+        except Exception:
+            self._send(500, json.dumps({'error': traceback.format_exc()}), 'application/json')
+            return
+
+        if kind == 'png':
+            self._send(200, result, 'image/png')
+        elif kind == 'table':
+            if out_format == 'csv':
+                self._send(200, result.to_csv(index=False), 'text/csv')
+            else:
+                self._send(200, result.to_json(orient='records'), 'application/json')
+        elif kind == 'kde':
+            self._send(200, json.dumps({'x_grid': result['x_grid'].tolist(), 'y_grid': result['y_grid'].tolist(),
+                                        'density': result['Z'].tolist(), 'extent': [float(x) for x in result['extent']]}), 'application/json')
+        else:
+            self._send(200, json.dumps(result), 'application/json')
+        print("%s took %.3f s" %(self.path, time.time() - start_time))
+
+class LoopbackHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def is_socket(path):
+    """
+    Check if there is a Unix socket at a path, without following symlinks
+    """
+    return os.path.lexists(path) and stat.S_ISSOCK(os.lstat(path).st_mode)
+
+def make_server(dataset, port=8050, socket_path=None):
+    """
+    Make the server for a dataset, listening on 127.0.0.1:port or on a Unix socket
+
+    Args:
+        dataset: the TerraceDataset
+        port (int): the port on the loopback interface. 0 picks a free port
+        socket_path (str): if given, listen on this Unix socket instead
+
+    Returns:
+        the server. Call serve_forever() to start it.
+
+    Author: FJC
+    """
+    if socket_path:
+        # remove the socket from an earlier run, but never anything else at the path
+        if is_socket(socket_path):
+            os.remove(socket_path)
+        elif os.path.lexists(socket_path):
+            raise ValueError(socket_path+" already exists and isn't a socket, so I won't remove it")
+        server = UnixHTTPServer(socket_path, TerraceRequestHandler)
+    else:
+        server = LoopbackHTTPServer(('127.0.0.1', port), TerraceRequestHandler)
+    server.dataset = dataset
+
+    # the server runs for a long time, so don't keep a record of every stage that
+    # it runs. The time of each request is printed instead.
+    instrumentation.enabled = False
+    return server
+
+#=============================================================================
+# This is the main function that runs the whole thing
+#=============================================================================
+def main(argv):
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-dir", "--base_directory", type=str, help="The base directory. If this isn't defined I'll assume it's the same as the current directory.")
+    parser.add_argument("-fname", "--fname_prefix", type=str, help="The prefix of your DEM WITHOUT EXTENSION!")
+    parser.add_argument("-io", "--table_format", type=str, default='csv', help="The format of the terrace tables: 'csv', 'npy', 'feather' or 'parquet'. Default = csv")
+    parser.add_argument("-typed", "--typed_tables", type=bool, default=False, help="If this is true, I'll store the tables in smaller types to use less memory")
+    parser.add_argument("-port", "--port", type=int, default=8050, help="The port to listen on, on 127.0.0.1. Default = 8050")
+    parser.add_argument("-socket", "--socket_path", type=str, default=None, help="If given, listen on this Unix socket instead of a port")
+    parser.add_argument("-cache", "--cache_size", type=int, default=64, help="The most results to keep in memory. Default = 64")
+    args = parser.parse_args(argv)
+
+    if not args.fname_prefix:
+        print("WARNING! You haven't supplied your DEM name. Please specify this with the flag '-fname'")
+        sys.exit()
+    this_dir = args.base_directory if args.base_directory else os.getcwd()+os.path.sep
+
+    dataset = TerraceDataset(this_dir, args.fname_prefix, args.table_format, args.typed_tables, args.cache_size)
+    try:
+        server = make_server(dataset, args.port, args.socket_path)
+    except ValueError as e:
+        print("WARNING! "+str(e)+". Please choose another path with the flag '-socket'")
+        sys.exit()
+    if args.socket_path:
+        print("Serving "+args.fname_prefix+" on the Unix socket "+args.socket_path)
+    else:
+        print("Serving "+args.fname_prefix+" on http://127.0.0.1:%d/" %server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket_path and is_socket(args.socket_path):
+            os.remove(args.socket_path)
+
+#=============================================================================
+if __name__ == "__main__":
+    main(sys.argv[1:])
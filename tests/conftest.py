@@ -0,0 +1,9 @@
+#------------------------------------------------------------------------------#
+# terrace-long-profiler
+# Let the tests import the modules from the top of the repository
+# Authors: F. Clubb
+#------------------------------------------------------------------------------#
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
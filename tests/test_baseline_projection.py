@@ -0,0 +1,40 @@
+#------------------------------------------------------------------------------#
+# terrace-long-profiler
+# Check the vectorised projection of points onto the baseline against shapely
+# Authors: F. Clubb
+#------------------------------------------------------------------------------#
+import numpy as np
+import pytest
+
+shapely_geometry = pytest.importorskip('shapely.geometry')
+pytest.importorskip('scipy')
+
+import TerracePlotter
+from benchmarks import synthetic
+
+def test_projection_matches_shapely():
+    baseline = synthetic.make_baseline(n_nodes=500, valley_length=20000.)
+    x = baseline['X'].values
+    y = baseline['Y'].values
+    line = shapely_geometry.LineString(np.column_stack([x, y]))
+
+    # points around the valley, including some past both ends of the baseline
+    rng = np.random.RandomState(0)
+    X = rng.uniform(x.min() - 3000, x.max() + 3000, 5000)
+    Y = rng.uniform(y.min() - 3000, y.max() + 3000, 5000)
+    X[:2] = [x[0] - 1000., x[-1] + 1000.]
+    Y[:2] = [y[0] + 50., y[-1] - 50.]
+
+    index = TerracePlotter.build_baseline_index(x, y)
+    chainage, offset, side = TerracePlotter.project_points_to_baseline(X, Y, index, chunk_size=1000)
+
+    points = [shapely_geometry.Point(px, py) for px, py in zip(X, Y)]
+    expected_chainage = np.array([line.project(p) for p in points])
+    expected_offset = np.array([line.distance(p) for p in points])
+
+    np.testing.assert_allclose(chainage, expected_chainage, rtol=0, atol=1e-6)
+    np.testing.assert_allclose(offset, expected_offset, rtol=0, atol=1e-6)
+    # the points past the ends are projected onto the end points
+    assert chainage[0] == 0
+    assert np.isclose(chainage[1], line.length)
+    assert set(np.unique(side)) <= {-1, 0, 1}
@@ -0,0 +1,20 @@
+#------------------------------------------------------------------------------#
+# terrace-long-profiler
+# Check that the batch driver records the jobs that fail
+# Authors: F. Clubb
+#------------------------------------------------------------------------------#
+import os
+
+import pytest
+
+pytest.importorskip('matplotlib')
+
+import batch_terrace_plots
+
+@pytest.mark.parametrize('job', [{'fname_prefix': ''},
+                                 {'fname_prefix': 'dem', 'options': '-not_an_option 1'}])
+def test_exits_are_failures(tmp_path, job):
+    job = dict(job, base_directory=str(tmp_path)+os.path.sep)
+    result = batch_terrace_plots.run_job(job)
+    assert result['status'] == 'failed'
+    assert result['error'].startswith('exit code')
@@ -0,0 +1,97 @@
+#------------------------------------------------------------------------------#
+# terrace-long-profiler
+# Check the plane fits and the dip and strike of the terrace surfaces
+# Authors: F. Clubb
+#------------------------------------------------------------------------------#
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import linalg
+
+import TerracePlotter
+from benchmarks import synthetic
+
+def get_dip_and_strike_scalar(C):
+    # the dip and strike of one plane, the way get_terrace_dip_and_dipdir used to work them out
+    a = -C[0]
+    b = -C[1]
+    c = 1
+    n_vec = np.array([a,b,c])
+    n_xy = np.array([a,b,0])
+    dip = np.arccos((np.dot(n_vec,n_xy))/(np.linalg.norm(n_vec)*np.linalg.norm(n_xy)))
+    dip = 90 - math.degrees(dip)
+    y_vec = np.array([0,1,0])
+    theta = np.arccos((np.dot(n_xy,y_vec))/(np.linalg.norm(n_xy)*np.linalg.norm(y_vec)))
+    theta = math.degrees(theta)
+    if a > 0 and b > 0:
+        strike = 270 + theta
+    elif a < 0:
+        strike = 270 - theta
+    elif a > 0 and b < 0:
+        strike = theta - 90
+    dip_dir = strike+90
+    if dip_dir > 359:
+        dip_dir = dip_dir - 360
+    return dip, dip_dir, strike
+
+def test_dip_and_strike_quadrants():
+    # planes dipping in every direction, with a and b both non zero as the old code needed
+    rng = np.random.RandomState(0)
+    C = np.column_stack([rng.uniform(-0.1, 0.1, 400), rng.uniform(-0.1, 0.1, 400), rng.uniform(0, 100, 400)])
+    for signs in [(1, 1), (1, -1), (-1, 1), (-1, -1)]:
+        assert np.any((np.sign(C[:,0]) == signs[0]) & (np.sign(C[:,1]) == signs[1]))
+
+    dips, dip_dirs, strikes = TerracePlotter.get_dip_and_strike(C)
+    expected = np.array([get_dip_and_strike_scalar(c) for c in C])
+    np.testing.assert_allclose(dips, expected[:,0], rtol=0, atol=1e-9)
+    np.testing.assert_allclose(dip_dirs, expected[:,1], rtol=0, atol=1e-9)
+    np.testing.assert_allclose(strikes, expected[:,2], rtol=0, atol=1e-9)
+
+def test_planes_match_lstsq():
+    baseline = synthetic.make_baseline()
+    terraces, _ = synthetic.make_terraces(baseline, 20000, n_terraces=30)
+    planes = TerracePlotter.fit_terrace_planes(terraces, by='TerraceID')
+
+    for i, id in enumerate(planes['keys']['TerraceID'].values):
+        this_terrace = terraces[terraces.TerraceID == id]
+        XY = np.vstack((this_terrace['X'].values, this_terrace['Y'].values, np.ones(len(this_terrace)))).transpose()
+        C, _, _, _ = linalg.lstsq(XY, this_terrace['Elevation'].values)
+        # the intercept is far from the data, so compare the slopes and the elevation at the centre
+        np.testing.assert_allclose(planes['C'][i][:2], C[:2], rtol=0, atol=1e-9)
+        Xc, Yc = planes['X_mean'][i], planes['Y_mean'][i]
+        assert abs(np.dot(planes['C'][i], [Xc, Yc, 1]) - np.dot(C, [Xc, Yc, 1])) < 1e-6
+
+def make_planes_with_outliers(n_terraces=20, n_pixels=3000, fraction=0.2, noise=0.2, seed=0):
+    # terraces on known planes, with a fraction of the pixels raised above them like riser pixels
+    rng = np.random.RandomState(seed)
+    terraces = []
+    slopes = np.zeros((n_terraces, 2))
+    for id in range(n_terraces):
+        x0, y0 = rng.uniform(0, 1e5, 2) + [5e5, 4e6]
+        X = x0 + rng.uniform(-300, 300, n_pixels)
+        Y = y0 + rng.uniform(-150, 150, n_pixels)
+        slopes[id] = rng.uniform(-0.01, 0.01, 2)
+        Z = slopes[id, 0]*(X - x0) + slopes[id, 1]*(Y - y0) + rng.uniform(50, 100) + rng.normal(0, noise, n_pixels)
+        terraces.append(pd.DataFrame({'new_ID': id, 'X': X, 'Y': Y, 'Elevation': Z}))
+    terraces = pd.concat(terraces, ignore_index=True)
+    outliers = rng.uniform(0, 1, len(terraces)) < fraction
+    terraces.loc[outliers, 'Elevation'] += rng.uniform(2, 20, outliers.sum())
+    return terraces, slopes, outliers
+
+@pytest.mark.parametrize('method', ['huber', 'ransac'])
+def test_robust_planes_ignore_outliers(method):
+    terraces, slopes, outliers = make_planes_with_outliers()
+    planes = TerracePlotter.fit_terrace_planes(terraces, method=method)
+    lstsq_planes = TerracePlotter.fit_terrace_planes(terraces, method='lstsq')
+    assert list(planes['keys']['new_ID']) == list(range(len(slopes)))
+
+    error = np.abs(planes['C'][:,:2] - slopes).max()
+    lstsq_error = np.abs(lstsq_planes['C'][:,:2] - slopes).max()
+    assert error < 5e-4
+    assert error < lstsq_error/4
+
+    # the inliers are the pixels that weren't raised, less the few in the tails of the noise
+    expected_fraction = 1 - np.bincount(terraces['new_ID'].values, weights=outliers)/np.bincount(terraces['new_ID'].values)
+    np.testing.assert_allclose(planes['inlier_fraction'], expected_fraction, rtol=0, atol=0.02)
@@ -0,0 +1,111 @@
+#------------------------------------------------------------------------------#
+# terrace-long-profiler
+# Check the polygon of each point and the masked relief raster of filter_points_by_shapefile
+# Authors: F. Clubb
+#------------------------------------------------------------------------------#
+import numpy as np
+import pytest
+
+shapely_geometry = pytest.importorskip('shapely.geometry')
+
+import filter_points_by_shapefile
+from benchmarks import synthetic
+
+def make_points_and_polygons(n_points=5000):
+    baseline = synthetic.make_baseline(n_nodes=200, valley_length=10000.)
+    terraces, outlines = synthetic.make_terraces(baseline, n_points, n_terraces=20)
+    polygons = synthetic.make_polygons(outlines)
+    # add two polygons that overlap some of the others, so some points are in more than one
+    x_min, y_min, x_max, y_max = terraces['X'].min(), terraces['Y'].min(), terraces['X'].max(), terraces['Y'].max()
+    polygons.insert(0, shapely_geometry.box(x_min, y_min, (x_min + x_max)/2, (y_min + y_max)/2))
+    polygons.append(shapely_geometry.box((x_min + x_max)/2, y_min, x_max, y_max))
+    return terraces['X'].values, terraces['Y'].values, polygons
+
+def get_polygon_index_by_loop(X, Y, polygons):
+    # the lowest index of the polygons that contain each point
+    polygon_index = np.full(len(X), -1, dtype=np.int64)
+    for i, (x, y) in enumerate(zip(X, Y)):
+        point = shapely_geometry.Point(x, y)
+        for j, polygon in enumerate(polygons):
+            if polygon.contains(point):
+                polygon_index[i] = j
+                break
+    return polygon_index
+
+def test_polygon_index_matches_loop():
+    X, Y, polygons = make_points_and_polygons()
+    expected = get_polygon_index_by_loop(X, Y, polygons)
+    assert (expected == 0).any() and (expected == len(polygons)-1).any() and (expected == -1).any()
+
+    polygon_index = filter_points_by_shapefile.get_polygon_index(X, Y, polygons, chunk_size=700)
+    np.testing.assert_array_equal(polygon_index, expected)
+
+    # the query for shapely < 2 gives the same result
+    query = filter_points_by_shapefile._get_prepared_query(polygons)
+    polygon_index = filter_points_by_shapefile.get_polygon_index(X, Y, polygons, chunk_size=700, query=query)
+    np.testing.assert_array_equal(polygon_index, expected)
+
+def test_no_points_or_polygons():
+    X, Y, polygons = make_points_and_polygons(n_points=2000)
+    assert len(filter_points_by_shapefile.get_polygon_index(X[:0], Y[:0], polygons)) == 0
+    assert (filter_points_by_shapefile.get_polygon_index(X, Y, []) == -1).all()
+
+def test_raster_matches_geometry_on_the_grid():
+    pytest.importorskip('rasterio')
+    from rasterio.transform import Affine
+
+    X, Y, polygons = make_points_and_polygons()
+    # a point at the centre of every cell of a 5 m grid over the polygons
+    res = 5.
+    x_min, y_max = X.min() - 100., Y.max() + 100.
+    out_shape = (int((Y.max() - Y.min() + 200.)/res), int((X.max() - X.min() + 200.)/res))
+    transform = Affine(res, 0., x_min, 0., -res, y_max)
+    rows, cols = np.mgrid[0:out_shape[0], 0:out_shape[1]]
+    grid_X = x_min + (cols.ravel() + 0.5)*res
+    grid_Y = y_max - (rows.ravel() + 0.5)*res
+
+    geometry_index = filter_points_by_shapefile.get_polygon_index(grid_X, grid_Y, polygons)
+    raster_index = filter_points_by_shapefile.get_raster_polygon_index(grid_X, grid_Y, polygons, transform, out_shape)
+
+    # only the points that are on the edge of a polygon can be different
+    boundaries = shapely_geometry.MultiLineString([line for polygon in polygons for line in [polygon.exterior.coords]])
+    different = np.flatnonzero(geometry_index != raster_index)
+    assert all(boundaries.distance(shapely_geometry.Point(grid_X[i], grid_Y[i])) < 1e-6 for i in different)
+    assert (geometry_index >= 0).sum() > 1000
+
+def test_windowed_mask_matches_mask(tmp_path):
+    rasterio = pytest.importorskip('rasterio')
+
+    # a 300 x 300 raster, and some overlapping polygons over it and past its edges
+    relief, x_min, y_max = synthetic.make_raster(300*300)
+    relief_fname = str(tmp_path / 'relief.tif')
+    synthetic.write_geotiff(relief_fname, relief, x_min, y_max)
+    polygons = [shapely_geometry.Point(x, y).buffer(r) for x, y, r in [(300., 1200., 150.), (400., 1100., 120.), (1000., 700., 300.)]]
+    polygons.append(shapely_geometry.box(1300., 200., 1600., 500.))
+
+    index = filter_points_by_shapefile.get_reach_index(polygons, relief_fname)
+    windowed_index = filter_points_by_shapefile.get_reach_index(polygons, relief_fname, str(tmp_path / 'labels.npy'), block_size=64)
+    np.testing.assert_array_equal(windowed_index['labels'], index['labels'])
+    assert windowed_index['window'] == index['window']
+
+    n_cells = filter_points_by_shapefile.mask_relief_raster(relief_fname, str(tmp_path / 'masked.tif'), index)
+    n_windowed = filter_points_by_shapefile.mask_relief_raster_windowed(relief_fname, str(tmp_path / 'masked_windowed.tif'), windowed_index, block_size=64)
+    assert n_windowed == n_cells == int((index['labels'] > 0).sum())
+
+    with rasterio.open(str(tmp_path / 'masked.tif')) as src:
+        masked = src.read(1)
+        transform = src.transform
+    with rasterio.open(str(tmp_path / 'masked_windowed.tif')) as src:
+        masked_windowed = src.read(1)
+        assert tuple(getattr(src.transform, c) for c in 'abcdef') == tuple(getattr(transform, c) for c in 'abcdef')
+    np.testing.assert_array_equal(masked_windowed, masked)
+
+    # the cells that are kept are the ones with their centres in the polygons
+    rows, cols = np.mgrid[0:masked.shape[0], 0:masked.shape[1]]
+    X = transform.c + (cols.ravel() + 0.5)*transform.a
+    Y = transform.f + (rows.ravel() + 0.5)*transform.e
+    in_polygons = filter_points_by_shapefile.get_polygon_index(X, Y, polygons).reshape(masked.shape) >= 0
+    window = index['window']
+    original = relief[window.row_off:window.row_off+window.height, window.col_off:window.col_off+window.width]
+    np.testing.assert_array_equal(masked[in_polygons], original[in_polygons])
+    assert (masked[~in_polygons] == -9999).all()
@@ -0,0 +1,31 @@
+#------------------------------------------------------------------------------#
+# terrace-long-profiler
+# Check the memory that is recorded for each stage
+# Authors: F. Clubb
+#------------------------------------------------------------------------------#
+import numpy as np
+import pytest
+
+from LSDPlottingTools import instrumentation
+
+def test_stage_memory():
+    if instrumentation.get_rss() is None:
+        pytest.skip("can't read the memory of the process on this system")
+    instrumentation.reset()
+
+    # a stage that keeps 200 MB, and one that frees it again
+    with instrumentation.stage('allocate'):
+        kept = np.ones(25*1000*1000)
+    with instrumentation.stage('free'):
+        del kept
+    records = {record['stage']: record for record in instrumentation.get_records()}
+    assert records['allocate']['rss_change_mb'] > 150
+    assert records['allocate']['peak_rss_increase_mb'] >= 0
+    assert records['free']['rss_change_mb'] < -150
+    # the process peak is the same for both, as it is the high-water mark of the whole process
+    assert records['free']['process_peak_rss_mb'] >= records['allocate']['process_peak_rss_mb']
+
+    summary = {s['stage']: s for s in instrumentation.summarise_records(instrumentation.get_records())}
+    assert summary['allocate']['rss_change_mb'] == records['allocate']['rss_change_mb']
+    assert summary['free']['max_rss_end_mb'] == records['free']['rss_end_mb']
+    instrumentation.reset()
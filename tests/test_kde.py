@@ -0,0 +1,44 @@
+#------------------------------------------------------------------------------#
+# terrace-long-profiler
+# Check the binned FFT KDE of the heat map against scipy's gaussian_kde
+# Authors: F. Clubb
+#------------------------------------------------------------------------------#
+import numpy as np
+import pytest
+import scipy.stats as st
+
+import TerracePlotter
+from benchmarks import synthetic
+
+@pytest.mark.parametrize('bw_method', [0.03, 0.1, 'scott'])
+def test_binned_kde_matches_gaussian_kde(bw_method):
+    baseline = synthetic.make_baseline()
+    terraces, _ = synthetic.make_terraces(baseline, 5000)
+    values = np.vstack([terraces['DistAlongBaseline'].values/1000, terraces['Elevation'].values])
+    KDE = st.gaussian_kde(values, bw_method=bw_method)
+
+    x_grid = np.linspace(0, values[0].max(), 100)
+    y_grid = np.linspace(0, values[1].max(), 80)
+    X, Y = np.meshgrid(x_grid, y_grid)
+    expected = KDE(np.vstack([X.ravel(), Y.ravel()])).reshape(X.shape)
+    density = TerracePlotter.get_binned_kde(KDE, x_grid, y_grid)
+
+    assert density.shape == expected.shape
+    # the error is a small fraction of the highest density
+    assert np.abs(density - expected).max() < 0.02*expected.max()
+    # and the total density is the same
+    assert abs(density.sum()/expected.sum() - 1) < 0.01
+
+def test_terrace_kde_methods_agree():
+    baseline = synthetic.make_baseline()
+    terraces, _ = synthetic.make_terraces(baseline, 5000)
+    flow_dist = terraces['DistAlongBaseline'].values/1000
+    elevation = terraces['Elevation'].values
+    exact = TerracePlotter.get_terrace_kde(flow_dist, elevation, kde_method='exact')
+    binned = TerracePlotter.get_terrace_kde(flow_dist, elevation, kde_method='binned', check_error=True)
+
+    assert exact['extent'] == binned['extent']
+    error = np.abs(exact['Z'] - binned['Z']).max()/exact['Z'].max()
+    assert error < 0.02
+    # the error that check_error reports is from a sample of the grid, so it can't be bigger
+    assert binned['kde_error']['max_error'] <= error + 1e-12
@@ -0,0 +1,28 @@
+#------------------------------------------------------------------------------#
+# terrace-long-profiler
+# Check that each per-terrace long profile gets the binned medians of its terrace
+# Authors: F. Clubb
+#------------------------------------------------------------------------------#
+import numpy as np
+
+import TerracePlotter
+from benchmarks import synthetic
+
+def test_long_profiler_bins(tmp_path, monkeypatch):
+    baseline = synthetic.make_baseline()
+    terraces, _ = synthetic.make_terraces(baseline, 20000, n_terraces=8)
+    terraces['DistAlongBaseline_new'] = terraces['DistAlongBaseline'] + terraces['X'] - terraces['X'].mean()
+
+    # keep the figure jobs rather than plotting them
+    jobs = []
+    monkeypatch.setattr(TerracePlotter, 'render_figures', lambda these_jobs, **kwargs: jobs.extend(these_jobs))
+    TerracePlotter.long_profiler(str(tmp_path)+'/', 'test', terraces, baseline)
+
+    profile_df = TerracePlotter.get_binned_profiles(terraces)
+    assert len(jobs) == terraces['new_ID'].nunique()
+    for _, fname, kwargs in jobs:
+        id = int(fname.rsplit('_', 1)[1].split('.')[0])
+        these_bins = profile_df[profile_df['new_ID'] == id]
+        assert len(kwargs['bin_medians']) > 0
+        np.testing.assert_array_equal(kwargs['bin_medians'], these_bins['median_elevation'].values)
+        np.testing.assert_array_equal(kwargs['bin_centres'], these_bins['bin_centre'].values/1000)
@@ -0,0 +1,104 @@
+#------------------------------------------------------------------------------#
+# terrace-long-profiler
+# Check that the joined table of the reaches is written again when a reach changes
+# Authors: F. Clubb
+#------------------------------------------------------------------------------#
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('scipy')
+
+import TerraceIO
+from benchmarks import synthetic
+
+def make_reaches(data_dir, reaches, n_points=2000):
+    baseline = synthetic.make_baseline(n_nodes=200, valley_length=10000.)
+    for i, reach in enumerate(reaches):
+        terraces, _ = synthetic.make_terraces(baseline, n_points, seed=i)
+        os.makedirs(os.path.join(data_dir, reach))
+        terraces.to_csv(TerraceIO.get_reach_fname(data_dir, reach)+'.csv', index=False)
+    return baseline
+
+def load_and_update(data_dir, reaches, baseline, dist_file):
+    terraces, timing_df = TerraceIO.load_reaches(data_dir, reaches, baseline, os.path.join(data_dir, 'cache'))
+    key = TerraceIO.get_reaches_key(data_dir, reaches, baseline)
+    return terraces, timing_df, TerraceIO.update_table(terraces, dist_file, 'csv', key)
+
+def test_joined_table_follows_the_reaches(tmp_path):
+    data_dir = str(tmp_path)+os.path.sep
+    reaches = ['reach_a', 'reach_b']
+    baseline = make_reaches(data_dir, reaches)
+    dist_file = data_dir+'terraces_dist'
+
+    _, timing_df, written = load_and_update(data_dir, reaches, baseline, dist_file)
+    assert written
+    assert (timing_df['cache'] == 'miss').all()
+
+    # nothing has changed, so the table is kept
+    _, timing_df, written = load_and_update(data_dir, reaches, baseline, dist_file)
+    assert not written
+    assert (timing_df['cache'] == 'hit').all()
+
+    # change the elevations of a reach but not its coordinates: the projection is still
+    # cached, but the joined table has to be written again
+    fname = TerraceIO.get_reach_fname(data_dir, 'reach_b')+'.csv'
+    df = pd.read_csv(fname)
+    df['Elevation'] += 10.
+    df.to_csv(fname, index=False)
+    terraces, timing_df, written = load_and_update(data_dir, reaches, baseline, dist_file)
+    assert (timing_df['cache'] == 'hit').all()
+    assert written
+    dist_df = TerraceIO.read_table(dist_file, 'csv')
+    np.testing.assert_allclose(dist_df['Elevation'].values, terraces['Elevation'].values)
+
+    # drop a reach
+    terraces, _, written = load_and_update(data_dir, reaches[:1], baseline, dist_file)
+    assert written
+    assert len(TerraceIO.read_table(dist_file, 'csv')) == len(terraces)
+
+    # a table without its manifest (e.g. if writing it was interrupted) is written again
+    os.remove(dist_file+'_manifest.json')
+    _, _, written = load_and_update(data_dir, reaches[:1], baseline, dist_file)
+    assert written
+
+def test_resume_rejects_broken_checkpoints(tmp_path):
+    data_dir = str(tmp_path)+os.path.sep
+    reaches = ['reach_a', 'reach_b']
+    baseline = make_reaches(data_dir, reaches)
+    cache_dir = os.path.join(data_dir, 'cache')
+    dist_file = data_dir+'terraces_dist'
+
+    expected, timing_df = TerraceIO.load_reaches(data_dir, reaches, baseline, cache_dir)
+    assert (timing_df['cache'] == 'miss').all()
+
+    # the checkpoints are complete, so both reaches are resumed from them
+    terraces, timing_df = TerraceIO.load_reaches(data_dir, reaches, baseline, cache_dir, resume=True)
+    assert (timing_df['cache'] == 'checkpoint').all()
+    pd.testing.assert_frame_equal(terraces, expected, check_dtype=False)
+    # and the joined table is still written, as it doesn't exist yet
+    assert TerraceIO.update_table(terraces, dist_file, 'csv', TerraceIO.get_reaches_key(data_dir, reaches, baseline))
+
+    # truncate the checkpoint of one reach, and corrupt the manifest of the other
+    checkpoint_a = os.path.join(cache_dir, 'reach_a')
+    checkpoint_b = os.path.join(cache_dir, 'reach_b')
+    fname = TerraceIO.get_table_file(checkpoint_a, 'csv')
+    with open(fname, 'rb') as f:
+        data = f.read()
+    with open(fname, 'wb') as f:
+        f.write(data[:len(data)//2])
+    with open(checkpoint_b+'_checkpoint.json', 'r+') as f:
+        f.truncate(10)
+
+    for reach, stem in zip(reaches, [checkpoint_a, checkpoint_b]):
+        key = TerraceIO.get_checkpoint_key(TerraceIO.get_reach_fname(data_dir, reach), 'csv', baseline)
+        assert TerraceIO.read_checkpoint(stem, key, 'csv') is None
+
+    # so they are both loaded and projected again (from the projection cache), and checkpointed again
+    terraces, timing_df = TerraceIO.load_reaches(data_dir, reaches, baseline, cache_dir, resume=True)
+    assert (timing_df['cache'] == 'hit').all()
+    pd.testing.assert_frame_equal(terraces, expected, check_dtype=False)
+    _, timing_df = TerraceIO.load_reaches(data_dir, reaches, baseline, cache_dir, resume=True)
+    assert (timing_df['cache'] == 'checkpoint').all()
@@ -0,0 +1,68 @@
+#------------------------------------------------------------------------------#
+# terrace-long-profiler
+# Check the cache of the terrace server and that it doesn't keep its figures open
+# Authors: F. Clubb
+#------------------------------------------------------------------------------#
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('scipy')
+plt = pytest.importorskip('matplotlib.pyplot')
+
+import terrace_server
+from benchmarks import synthetic
+
+@pytest.fixture
+def dataset(tmp_path):
+    baseline = synthetic.make_baseline(n_nodes=200, valley_length=10000.)
+    terraces, _ = synthetic.make_terraces(baseline, 5000)
+    data_dir = str(tmp_path)+'/'
+    baseline.to_csv(data_dir+'dem_baseline_channel_info.csv', index=False)
+    terraces.to_csv(data_dir+'dem_terrace_info.csv', index=False)
+    return terrace_server.TerraceDataset(data_dir, 'dem')
+
+def test_identical_requests_are_worked_out_once(dataset):
+    calls = []
+    def _slow(params):
+        calls.append(params)
+        time.sleep(0.2)
+        return params['n']*2
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(dataset.cached('slow', {'n': 4}, _slow))) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [8]*8
+    assert len(calls) == 1
+    assert dataset.misses == 1 and dataset.hits + dataset.waits == 7
+
+def test_failures_are_shared_and_not_cached(dataset):
+    def _fail(params):
+        time.sleep(0.2)
+        raise ValueError("no pixels")
+
+    errors = []
+    def _request():
+        try:
+            dataset.cached('fail', {}, _fail)
+        except ValueError as e:
+            errors.append(str(e))
+    threads = [threading.Thread(target=_request) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == ['no pixels']*4
+    assert dataset.cached('fail', {}, lambda params: 'ok') == 'ok'
+
+def test_figures_are_closed(dataset):
+    plt.close('all')
+    params = terrace_server.parse_params('', ['prec', 'bw_method', 'kde_method', 'dpi']+terrace_server.FILTERS)
+    assert dataset.heat_map_png(params)[:4] == b'\x89PNG'
+    params = terrace_server.parse_params('', ['res', 'dpi']+terrace_server.FILTERS)
+    assert dataset.means_png(params)[:4] == b'\x89PNG'
+    assert plt.get_fignums() == []
@@ -0,0 +1,98 @@
+#------------------------------------------------------------------------------#
+# terrace-long-profiler
+# Check that the terrace tables are the same after writing and reading them back
+# Authors: F. Clubb
+#------------------------------------------------------------------------------#
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import TerraceIO
+from benchmarks import synthetic
+
+def make_table(n_points=5000):
+    baseline = synthetic.make_baseline(n_nodes=200, valley_length=10000.)
+    terraces, _ = synthetic.make_terraces(baseline, n_points)
+    terraces['reach'] = np.where(np.arange(len(terraces)) % 3 == 0, 'reach_a', 'reach_b')
+    return terraces
+
+def skip_without_pyarrow(table_format):
+    if table_format in ['feather', 'parquet']:
+        pytest.importorskip('pyarrow')
+
+@pytest.mark.parametrize('table_format', TerraceIO.TABLE_FORMATS)
+def test_round_trip(tmp_path, table_format):
+    skip_without_pyarrow(table_format)
+    terraces = make_table()
+    fname_stem = str(tmp_path / 'terraces')
+    TerraceIO.write_table(terraces, fname_stem, table_format)
+    assert TerraceIO.table_exists(fname_stem, table_format)
+
+    df = TerraceIO.read_table(fname_stem, table_format)
+    assert list(df.columns) == list(terraces.columns)
+    # the binary formats keep the types, the csv is read with the default types
+    pd.testing.assert_frame_equal(df, terraces, check_dtype=(table_format != 'csv'), check_exact=(table_format != 'csv'))
+
+    # only some of the columns
+    df = TerraceIO.read_table(fname_stem, table_format, columns=['X', 'Elevation'])
+    assert sorted(df.columns) == ['Elevation', 'X']
+    np.testing.assert_allclose(df['Elevation'].values, terraces['Elevation'].values, rtol=1e-14)
+
+@pytest.mark.parametrize('table_format', TerraceIO.TABLE_FORMATS)
+def test_typed_round_trip(tmp_path, table_format):
+    skip_without_pyarrow(table_format)
+    terraces = TerraceIO.downcast_table(make_table())
+    fname_stem = str(tmp_path / 'terraces')
+    TerraceIO.write_table(terraces, fname_stem, table_format)
+    df = TerraceIO.read_table(fname_stem, table_format)
+    if table_format == 'csv':
+        df = TerraceIO.downcast_table(df)
+    pd.testing.assert_frame_equal(df, terraces, check_categorical=False)
+    assert df['Elevation'].dtype == np.float32
+    assert df['X'].dtype == np.float64
+
+@pytest.mark.parametrize('table_format', ['npy', 'feather', 'parquet'])
+def test_load_table_converts_the_csv(tmp_path, table_format):
+    skip_without_pyarrow(table_format)
+    terraces = make_table()
+    fname_stem = str(tmp_path / 'terraces')
+    TerraceIO.write_table(terraces, fname_stem, 'csv')
+
+    df = TerraceIO.load_table(fname_stem, table_format)
+    assert TerraceIO.table_exists(fname_stem, table_format)
+    # the second time the binary version is read
+    mtime = os.path.getmtime(TerraceIO.get_table_file(fname_stem, table_format))
+    pd.testing.assert_frame_equal(TerraceIO.load_table(fname_stem, table_format), df)
+    assert os.path.getmtime(TerraceIO.get_table_file(fname_stem, table_format)) == mtime
+
+def test_downcast_error_bounds():
+    terraces = make_table()
+    rng = np.random.RandomState(0)
+    # distances in metres along a long valley change by more than 1 mm as float32
+    terraces['DistAlongBaseline'] = rng.uniform(1e6, 2e6, len(terraces))
+    terraces['new_ID'] = terraces['new_ID'].astype(np.float64)
+    original = terraces.copy()
+
+    df = TerraceIO.downcast_table(terraces, tolerance=1e-3)
+    assert df['Elevation'].dtype == np.float32
+    assert np.abs(df['Elevation'].values.astype(np.float64) - original['Elevation'].values).max() <= 1e-3
+    assert df['DistAlongBaseline'].dtype == np.float64
+    np.testing.assert_array_equal(df['DistAlongBaseline'].values, original['DistAlongBaseline'].values)
+    # the coordinates are never downcast
+    assert df['X'].dtype == np.float64 and df['Y'].dtype == np.float64
+    np.testing.assert_array_equal(df['X'].values, original['X'].values)
+    # whole number IDs are stored as int32, and the reach names as a categorical
+    assert df['new_ID'].dtype == np.int32
+    np.testing.assert_array_equal(df['new_ID'].values, original['new_ID'].values)
+    assert isinstance(df['reach'].dtype, pd.CategoricalDtype)
+    assert list(df['reach'].astype(str)) == list(original['reach'])
+
+def test_downcast_ids_only_if_they_fit():
+    ids = pd.Series([1.5, 2., 3.])
+    assert TerraceIO.downcast_column(ids, 'id').dtype == np.float64
+    ids = pd.Series([1, 2, np.iinfo(np.int32).max + 1], dtype=np.int64)
+    assert TerraceIO.downcast_column(ids, 'id').dtype == np.int64
+    ids = pd.Series([1., np.nan])
+    assert TerraceIO.downcast_column(ids, 'id').dtype == np.float64
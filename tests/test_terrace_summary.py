@@ -0,0 +1,60 @@
+#------------------------------------------------------------------------------#
+# terrace-long-profiler
+# Check the summary statistics of each terrace against a loop over the terraces
+# Authors: F. Clubb
+#------------------------------------------------------------------------------#
+import numpy as np
+import pandas as pd
+
+import TerracePlotter
+from benchmarks import synthetic
+
+def make_terraces(n_points=20000, n_terraces=40):
+    baseline = synthetic.make_baseline()
+    terraces, _ = synthetic.make_terraces(baseline, n_points, n_terraces=n_terraces)
+    # distances without ties, so the pixel in the middle of each terrace is well defined
+    rng = np.random.RandomState(1)
+    terraces['DistAlongBaseline_new'] = terraces['DistAlongBaseline'] + rng.uniform(-500, 500, len(terraces))
+    return baseline, terraces
+
+def get_summary_by_loop(terraces, res=5):
+    # the summary the way long_profiler_all_terraces used to work it out, one terrace at a time
+    data = []
+    for id in terraces.new_ID.unique():
+        this_df = terraces[terraces.new_ID == id]
+        sorted_df = this_df.sort_values(by='DistAlongBaseline_new')
+        x = sorted_df['DistAlongBaseline_new'].values/1000
+        z = sorted_df['Elevation'].values
+        data.append([id, np.mean(z), np.std(z), np.take(x, x.size // 2), np.mean(sorted_df['ChannelRelief'].values),
+                     z.min(), z.max(), len(z), len(z)*res*res])
+    return pd.DataFrame(data, columns=['new_ID', 'mean_elevation', 'std_elevation', 'flow_dist', 'mean_relief',
+                                       'min_elevation', 'max_elevation', 'n_pixels', 'area'])
+
+def test_summary_matches_loop():
+    _, terraces = make_terraces()
+    summary_df = TerracePlotter.get_terrace_summary(terraces, res=5)
+    expected = get_summary_by_loop(terraces, res=5)
+
+    assert list(summary_df['new_ID']) == list(expected['new_ID'])
+    for col in expected.columns:
+        np.testing.assert_allclose(summary_df[col].values, expected[col].values, rtol=1e-10, atol=1e-10, err_msg=col)
+
+def test_stream_matches_summary(tmp_path):
+    baseline = synthetic.make_baseline()
+    terraces, _ = synthetic.make_terraces(baseline, 50000, n_terraces=60)
+    terrace_fname = str(tmp_path / 'terrace_info.csv')
+    terraces.to_csv(terrace_fname, index=False)
+
+    # read it back in small chunks, so the terraces are split between chunks
+    stream_df = TerracePlotter.stream_terrace_means(terrace_fname, baseline, chunksize=7000)
+
+    terraces = pd.read_csv(terrace_fname)
+    index = TerracePlotter.build_baseline_index(baseline['X'].values, baseline['Y'].values)
+    terraces['DistAlongBaseline_new'], _, _ = TerracePlotter.project_points_to_baseline(terraces['X'].values, terraces['Y'].values, index)
+    summary_df = TerracePlotter.get_terrace_summary(terraces).sort_values(by='new_ID').reset_index(drop=True)
+
+    stream_df = stream_df.sort_values(by='new_ID').reset_index(drop=True)
+    assert list(stream_df['new_ID']) == list(summary_df['new_ID'])
+    for col in summary_df.columns:
+        np.testing.assert_allclose(stream_df[col].values, summary_df[col].values, rtol=0, atol=1e-10, err_msg=col)
+    assert not (tmp_path / 'terrace_info.csv.dist.tmp').exists()